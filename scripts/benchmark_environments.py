@@ -0,0 +1,154 @@
+"""
+Compare the JSON list of environments built in memory, then sent at once,
+with the list streamed from a server-side cursor, as catalogues grow.
+
+    python scripts/benchmark_environments.py
+    python scripts/benchmark_environments.py --sizes 1000 10000 100000
+
+For each size, the peak memory allocated while serving the list, the time to
+the first byte and the total time are reported. A temporary SQLite database
+is used.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from uuid import uuid4
+
+import httpx
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from tljh_repo2docker.base import BaseHandler
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.dbutil import async_session_context_factory
+from tljh_repo2docker.environments import write_image_list
+
+
+class BufferedHandler(BaseHandler):
+    """The list as it was sent before it was streamed."""
+
+    async def get(self):
+        images = await self.get_images_from_db()
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps({"images": images}))
+
+
+class StreamedHandler(BaseHandler):
+    async def get(self):
+        await write_image_list(self)
+
+
+def _entry(i):
+    return DockerImageCreateSchema(
+        uid=uuid4(),
+        name=f"bench-{i}:HEAD",
+        status=BuildStatusType.BUILT,
+        log="",
+        image_meta=ImageMetadataType(
+            display_name=f"bench-{i}",
+            repo="https://github.com/org/repo",
+            ref="HEAD",
+            creation_date="01/01/2025",
+            owner="admin",
+            cpu_limit="2",
+            mem_limit="4G",
+            node_selector={},
+        ),
+    )
+
+
+async def _fill(db_context, manager, count):
+    async with db_context() as db:
+        await (await db.connection()).run_sync(BaseSQL.metadata.create_all)
+        # One transaction: `manager.create` commits each entry.
+        db.add_all(manager._table(**_entry(i).model_dump()) for i in range(count))
+        await db.commit()
+
+
+async def _get(client, url):
+    start = time.perf_counter()
+    first_byte = None
+    async with client.stream("GET", url) as response:
+        async for _ in response.aiter_raw():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+    return first_byte, time.perf_counter() - start
+
+
+async def _peak_memory(client, url):
+    # Traced apart: tracing the allocations slows the requests down.
+    tracemalloc.start()
+    try:
+        await _get(client, url)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def run(tmp, size, args):
+    db_context = async_session_context_factory(
+        f"sqlite+aiosqlite:///{Path(tmp) / f'bench-{size}.sqlite'}"
+    )
+    manager = ImagesDatabaseManager()
+    await _fill(db_context, manager, size)
+
+    app = web.Application(
+        [(r"/buffered", BufferedHandler), (r"/streamed", StreamedHandler)],
+        db_context=db_context,
+        image_db_manager=manager,
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+
+    results = {}
+    async with httpx.AsyncClient(timeout=None) as client:
+        for mode in ("buffered", "streamed"):
+            url = f"http://127.0.0.1:{port}/{mode}"
+            await _get(client, url)
+            samples = [await _get(client, url) for _ in range(args.repeat)]
+            first_byte, total = (statistics.median(s) for s in zip(*samples))
+            results[mode] = {
+                "peak MiB": await _peak_memory(client, url) / 2**20,
+                "first byte ms": first_byte * 1000,
+                "total ms": total * 1000,
+            }
+    server.stop()
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3, help="requests per mode")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for mode, results in (await run(tmp, size, args)).items():
+                rows.append((size, mode, results))
+
+    columns = list(rows[0][2])
+    print(f"{'size':>8}  {'mode':<10}" + "".join(f"{c:>15}" for c in columns))
+    for size, mode, results in rows:
+        print(
+            f"{size:>8}  {mode:<10}" + "".join(f"{results[c]:>15.2f}" for c in columns)
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+# Write the precompressed variants of the JavaScript bundles, served by the
+# service to the clients accepting them.
+set -eux
+
+cd tljh_repo2docker/static/js
+for bundle in *.js; do
+    gzip -9 --keep --force "$bundle"
+    if command -v brotli >/dev/null; then
+        brotli -q 11 --keep --force "$bundle"
+    fi
+done
@@ -132,7 +132,7 @@ function _EnvironmentList(props: IEnvironmentListProps) {
               />
             );
           }
-          if (params.value === 'failed') {
+          if (params.value === 'failed' || params.value === 'cancelled') {
             return (
               <EnvironmentLogButton name={name} image={image} status="failed" />
             );
@@ -149,7 +149,11 @@ function _EnvironmentList(props: IEnvironmentListProps) {
         hideable: false,
         renderCell: params => {
           const status = params.row.status;
-          if (status !== 'built' && status !== 'failed') {
+          if (
+            status !== 'built' &&
+            status !== 'failed' &&
+            status !== 'cancelled'
+          ) {
             return null;
           }
           return (
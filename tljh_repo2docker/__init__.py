@@ -1,9 +1,12 @@
-from aiodocker import Docker
+import asyncio
+
+from docker import APIClient
+from docker.tls import TLSConfig
 from dockerspawner import DockerSpawner
 from jinja2 import BaseLoader, Environment
 from jupyter_client.localinterfaces import public_ips
 from jupyterhub.traitlets import ByteSpecification
-from traitlets import Unicode
+from traitlets import Dict, List, Unicode
 from traitlets.config import Configurable
 
 try:
@@ -12,6 +15,7 @@ except ModuleNotFoundError:
     hookimpl = None
 
 from .docker import list_images
+from .docker_hosts import DockerHost, HostUsage, host_resources, rank_hosts
 
 # Default CPU period
 # See: https://docs.docker.com/config/containers/resource_constraints/#limit-a-containers-access-to-memory#configure-the-default-cfs-scheduler
@@ -51,11 +55,117 @@ class SpawnerMixin(Configurable):
         """,
     )
 
+    docker_hosts = List(
+        Dict(),
+        default_value=[],
+        config=True,
+        help="""
+        Docker hosts to start servers on, as a list of dicts with a unique
+        `name`, a `url` ("unix:///var/run/docker.sock",
+        "tcp://10.0.0.2:2376"...) and optional `tls_ca`, `tls_cert` and
+        `tls_key` paths, in the format of the service's `docker_hosts`.
+        A server starts on the host holding its image with the most free
+        CPU and memory. By default, the local Docker daemon is used.
+        """,
+    )
+
+    # Name of the Docker host running the server, persisted in the state.
+    docker_host = Unicode("")
+
+    # Servers started on each Docker host, shared by all the spawners.
+    host_usage = HostUsage()
+
+    _host_clients = {}
+
+    def get_docker_hosts(self):
+        """
+        Return the configured Docker hosts, `None` for the local daemon.
+        """
+        if not self.docker_hosts:
+            return None
+        return [DockerHost(**host) for host in self.docker_hosts]
+
+    def get_docker_host(self):
+        """
+        Return the Docker host running the server (the local daemon if unset).
+        """
+        for host in self.get_docker_hosts() or []:
+            if host.name == self.docker_host:
+                return host
+        return DockerHost()
+
+    @property
+    def client(self):
+        """
+        Docker client of the host running the server
+        """
+        host = self.get_docker_host()
+        if not host.url:
+            return super().client
+        if host.name not in self._host_clients:
+            kwargs = {"version": "auto", **self.client_kwargs, "base_url": host.url}
+            if host.tls_cert:
+                kwargs["tls"] = TLSConfig(
+                    client_cert=(host.tls_cert, host.tls_key),
+                    ca_cert=host.tls_ca,
+                    verify=bool(host.tls_ca),
+                )
+            self._host_clients[host.name] = APIClient(**kwargs)
+        return self._host_clients[host.name]
+
+    async def choose_docker_host(self):
+        """
+        Pick the Docker host to start the server on, among the hosts holding
+        the selected image, and record it in `docker_host`.
+        """
+        hosts = self.get_docker_hosts()
+        if not hosts:
+            return
+        image = self.user_options.get("image") or self.image
+        resources = await asyncio.gather(
+            *(host_resources(host, image) for host in hosts)
+        )
+        candidates = [(h, r) for h, r in zip(hosts, resources) if r is not None]
+        if not candidates:
+            raise RuntimeError(f"No Docker host holds the image {image}")
+
+        labels = candidates[0][1]["labels"]
+        cpu = float(labels.get("tljh_repo2docker.cpu_limit") or self.cpu_limit or 0)
+        memory = ByteSpecification().validate(
+            self, labels.get("tljh_repo2docker.mem_limit") or self.mem_limit or 0
+        )
+        host = rank_hosts(candidates, self.host_usage, cpu, memory)[0]
+        self.log.info("Starting %s on Docker host %s", self.object_name, host.name)
+        self.docker_host = host.name
+        # Count the server right away, so concurrent spawns see it.
+        self.host_usage.add(self.object_name, host.name, cpu, memory)
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.docker_host = state.get("docker_host", "")
+        if self.docker_host and "docker_host_usage" in state:
+            cpu, memory = state["docker_host_usage"]
+            self.host_usage.add(self.object_name, self.docker_host, cpu, memory)
+
+    def get_state(self):
+        state = super().get_state()
+        if self.docker_host and self.object_id:
+            state["docker_host"] = self.docker_host
+            state["docker_host_usage"] = [self.cpu_limit or 0, self.mem_limit or 0]
+        return state
+
+    def clear_state(self):
+        super().clear_state()
+        # A container kept on its host (remove=False) is restarted there.
+        if not self.object_id:
+            self.host_usage.remove(self.object_name)
+            self.docker_host = ""
+
     async def list_images(self):
         """
         Return the list of available images
         """
-        return await list_images()
+        return await list_images(self.get_docker_hosts())
 
     async def get_options_form(self):
         """
@@ -93,7 +203,7 @@ class SpawnerMixin(Configurable):
         Set the user environment limits if they are defined in the image
         """
         imagename = self.user_options.get("image")
-        async with Docker() as docker:
+        async with self.get_docker_host().docker() as docker:
             image = await docker.images.inspect(imagename)
         label = {
             **(image.get("ContainerConfig", {}).get("Labels") or {}),
@@ -124,8 +234,15 @@ class Repo2DockerSpawner(SpawnerMixin, DockerSpawner):
     """
 
     async def start(self, *args, **kwargs):
-        await self.set_limits()
-        return await super().start(*args, **kwargs)
+        if not self.docker_host:
+            await self.choose_docker_host()
+        try:
+            await self.set_limits()
+            return await super().start(*args, **kwargs)
+        except Exception:
+            if not self.object_id:
+                self.clear_state()
+            raise
 
 
 if hookimpl:
@@ -9,8 +9,10 @@ from sqlalchemy.ext.asyncio import AsyncEngine
 # Alembic Config object, which provides access to values within the .ini file
 config = alembic.context.config
 
-# Interpret the config file for logging
-fileConfig(config.config_file_name)
+# Interpret the config file for logging, when run from the command line: in
+# the service, the migrations log with the service.
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
 logger = logging.getLogger("alembic.env")
 
 
@@ -36,7 +38,11 @@ def run_migrations_online() -> None:
 
 
 def do_run_migrations(connection):
-    alembic.context.configure(connection=connection, target_metadata=None)
+    # One transaction per migration, owned by alembic: a migration may
+    # commit it to run statements outside of a transaction block.
+    alembic.context.configure(
+        connection=connection, target_metadata=None, transaction_per_migration=True
+    )
     with alembic.context.begin_transaction():
         alembic.context.run_migrations()
 
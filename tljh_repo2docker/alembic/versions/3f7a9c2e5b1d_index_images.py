@@ -0,0 +1,26 @@
+"""Index the images by name and status
+
+Revision ID: 3f7a9c2e5b1d
+Revises: 8d2e6f4a1c3b
+Create Date: 2026-10-19 16:21:44.902113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "3f7a9c2e5b1d"
+down_revision = "8d2e6f4a1c3b"
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa  # noqa
+from alembic import op  # noqa
+
+
+def upgrade():
+    op.create_index("ix_images_name", "images", ["name"], mysql_length=255)
+    op.create_index("ix_images_status", "images", ["status"])
+
+
+def downgrade():
+    op.drop_index("ix_images_status", table_name="images")
+    op.drop_index("ix_images_name", table_name="images")
@@ -0,0 +1,51 @@
+"""Add the cancelled build status
+
+Revision ID: 5b1f0e2c9d7a
+Revises: ac1b4e7e52f3
+Create Date: 2026-10-19 10:12:41.503127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "5b1f0e2c9d7a"
+down_revision = "ac1b4e7e52f3"
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa  # noqa
+from alembic import op  # noqa
+
+OLD_VALUES = ("built", "building", "failed")
+NEW_VALUES = OLD_VALUES + ("cancelled",)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        # ALTER TYPE ... ADD VALUE cannot run inside a transaction block.
+        with op.get_context().autocommit_block():
+            op.execute(
+                "ALTER TYPE build_status_enum ADD VALUE IF NOT EXISTS 'cancelled'"
+            )
+    elif dialect == "mysql":
+        op.alter_column(
+            "images",
+            "status",
+            existing_type=sa.Enum(*OLD_VALUES, name="build_status_enum"),
+            type_=sa.Enum(*NEW_VALUES, name="build_status_enum"),
+            existing_nullable=False,
+        )
+    # SQLite stores the enum as plain text: nothing to migrate.
+
+
+def downgrade():
+    op.execute("UPDATE images SET status = 'failed' WHERE status = 'cancelled'")
+    if op.get_bind().dialect.name == "mysql":
+        op.alter_column(
+            "images",
+            "status",
+            existing_type=sa.Enum(*NEW_VALUES, name="build_status_enum"),
+            type_=sa.Enum(*OLD_VALUES, name="build_status_enum"),
+            existing_nullable=False,
+        )
+    # PostgreSQL cannot drop a value from an enum type; it is left unused.
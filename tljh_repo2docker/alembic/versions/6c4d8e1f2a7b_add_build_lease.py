@@ -0,0 +1,27 @@
+"""Add the lease of the builds in progress
+
+Revision ID: 6c4d8e1f2a7b
+Revises: 3f7a9c2e5b1d
+Create Date: 2026-10-19 18:37:05.614829
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "6c4d8e1f2a7b"
+down_revision = "3f7a9c2e5b1d"
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa  # noqa
+from alembic import op  # noqa
+
+
+def upgrade():
+    op.add_column("images", sa.Column("lease_owner", sa.Unicode(255), nullable=True))
+    op.add_column("images", sa.Column("lease_expires", sa.DateTime, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("images") as batch_op:
+        batch_op.drop_column("lease_expires")
+        batch_op.drop_column("lease_owner")
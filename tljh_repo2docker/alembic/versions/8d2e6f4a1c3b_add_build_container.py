@@ -0,0 +1,27 @@
+"""Track the build container of local builds
+
+Revision ID: 8d2e6f4a1c3b
+Revises: 5b1f0e2c9d7a
+Create Date: 2026-10-19 14:02:17.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "8d2e6f4a1c3b"
+down_revision = "5b1f0e2c9d7a"
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa  # noqa
+from alembic import op  # noqa
+
+
+def upgrade():
+    op.add_column("images", sa.Column("container_id", sa.Unicode(128), nullable=True))
+    op.add_column("images", sa.Column("log_cursor", sa.Unicode(64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("images") as batch_op:
+        batch_op.drop_column("log_cursor")
+        batch_op.drop_column("container_id")
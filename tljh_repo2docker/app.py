@@ -1,26 +1,54 @@
+import asyncio
 import logging
 import os
+import signal
 import socket
 import typing as tp
+from functools import partial
 from pathlib import Path
 from urllib.parse import urlparse
 
 from jinja2 import Environment, PackageLoader
-from jupyterhub.app import DATA_FILES_PATH
+from jupyterhub._data import DATA_FILES_PATH
 from jupyterhub.handlers.static import LogoHandler
+from jupyterhub.traitlets import ByteSpecification
 from jupyterhub.utils import url_path_join
 from tornado import ioloop, web
-from traitlets import Dict, Int, List, Unicode, default, validate
+from traitlets import (
+    Bool,
+    Dict,
+    Enum,
+    Float,
+    Int,
+    List,
+    TraitError,
+    Unicode,
+    default,
+    validate,
+)
 from traitlets.config.application import Application
 
-from .binderhub_builder import BinderHubBuildHandler
-from .binderhub_log import BinderHubLogsHandler
-from .builder import BuildHandler
-from .database.manager import ImagesDatabaseManager
-from .database.schemas import BuildStatusType, DockerImageUpdateSchema
-from .dbutil import async_session_context_factory, sync_to_async_url, upgrade_if_needed
+from .build_jobs import BuildJobs
+from .compression import ContentEncoding, PrecompressedStaticFileHandler
+from .database.manager import DEFAULT_READ_YOUR_WRITES_WINDOW, ImagesDatabaseManager
+from .database.schemas import BuildStatusType
+from .database.writer import DEFAULT_BATCH_SIZE, DatabaseWriter
+from .dbutil import (
+    DB_PROFILES,
+    async_session_context_factory,
+    db_engine_options,
+    sync_to_async_url,
+    upgrade_if_needed,
+)
+from .docker import PROXY_BUILD_ARGS
+from .docker_hosts import DockerHostPool
 from .environments import EnvironmentsHandler
-from .logs import LogsHandler
+from .git_cache import GitMirrorCache
+from .http_clients import ServiceClient, make_client
+from .leases import DEFAULT_LEASE_TTL, BuildLeases, utcnow
+from .logs import BuildLogWatchers, LogsHandler
+from .metrics import MetricsHandler
+from .notifications import make_notifier
 from .servers import ServersHandler
 from .servers_api import ServersAPIHandler
 
@@ -154,6 +182,120 @@ class TljhRepo2Docker(Application):
         config=True,
     )
 
+    db_read_url = Unicode(
+        "",
+        help="""
+        url of a read replica of the database, e.g. a PostgreSQL hot standby.
+        The lists of environments and the build log polls are read from it,
+        except the entries this process wrote in the last
+        `db_read_your_writes_window` seconds, read from `db_url`.
+        """,
+        config=True,
+    )
+
+    db_read_your_writes_window = Float(
+        DEFAULT_READ_YOUR_WRITES_WINDOW,
+        help="""
+        Seconds during which the environments written by this process are
+        read from `db_url` rather than `db_read_url`. It should exceed the
+        replication lag of the replica.
+        """,
+        config=True,
+    )
+
+    db_profile = Enum(
+        list(DB_PROFILES),
+        "default",
+        help="""
+        Tuning profile of the database connections. `performance` sets larger
+        connection pools with pre-ping and recycling on PostgreSQL and MySQL,
+        and faster pragmas on SQLite (`synchronous=NORMAL`, memory-mapped
+        I/O, a larger page cache). The `db_pool_*` and `db_sqlite_pragmas`
+        settings override the profile.
+        """,
+        config=True,
+    )
+
+    db_pool_size = Int(
+        None,
+        allow_none=True,
+        help="""
+        Number of connections kept open to the database.
+        """,
+        config=True,
+    )
+
+    db_max_overflow = Int(
+        None,
+        allow_none=True,
+        help="""
+        Number of connections opened beyond `db_pool_size` under load.
+        """,
+        config=True,
+    )
+
+    db_pool_pre_ping = Bool(
+        None,
+        allow_none=True,
+        help="""
+        Test the database connections when they are taken from the pool, to
+        replace the ones closed by the server.
+        """,
+        config=True,
+    )
+
+    db_pool_recycle = Int(
+        None,
+        allow_none=True,
+        help="""
+        Seconds after which the database connections are replaced.
+        """,
+        config=True,
+    )
+
+    db_sqlite_pragmas = Dict(
+        {},
+        help="""
+        Pragmas set on each SQLite connection, e.g.
+        `{"synchronous": "NORMAL", "mmap_size": 268435456, "cache_size": -65536,
+        "busy_timeout": 5000}`.
+        """,
+        config=True,
+    )
+
+    db_notifications = Bool(
+        True,
+        help="""
+        Notify the changes of the environments (status, build log) as they
+        are committed, so that the log streams follow them without polling
+        the database every 3 seconds. On PostgreSQL, the changes reach every
+        replica of the service (LISTEN/NOTIFY, with the `asyncpg` driver);
+        on other databases, only this process is notified, and the changes
+        of other processes are still polled.
+        """,
+        config=True,
+    )
+
+    serialize_db_writes = Bool(
+        False,
+        help="""
+        Serialize the database writes through a single writer, which commits
+        the writes queued meanwhile (e.g. the logs of parallel builds) in one
+        transaction. Meant for SQLite, which lets one connection write at a
+        time: the writes no longer wait for the database lock.
+        """,
+        config=True,
+    )
+
+    db_write_batch_size = Int(
+        DEFAULT_BATCH_SIZE,
+        help="""
+        Maximum number of writes committed in one transaction, with
+        `serialize_db_writes`.
+        """,
+        config=True,
+    )
+
     cookie_secret_file = Unicode(
         "tljh_repo2docker_cookie_secret",
         help=(
@@ -179,6 +321,288 @@ class TljhRepo2Docker(Application):
         None, help="URL of the binderhub service.", allow_none=True, config=True
     )
 
+    git_mirror_cache_dir = Unicode(
+        "",
+        help="""
+        Directory holding bare git mirrors of the built repositories.
+
+        When set, local builds refresh the mirror with an incremental fetch and
+        repo2docker clones from it, so a rebuild only downloads new objects.
+        The directory is bind-mounted in the build container, so it must be a
+        path on the Docker host: the builds on remote Docker hosts (``tcp://``
+        in `docker_hosts`) clone directly. Leave empty to disable the cache.
+        """,
+        config=True,
+    )
+
+    git_mirror_cache_size = ByteSpecification(
+        "10G",
+        help="""
+        Maximum disk usage of the git mirror cache. Least recently used
+        mirrors are evicted once the cache grows beyond it. 0 means unbounded.
+        """,
+        config=True,
+    )
+
+    build_env = Dict(
+        {},
+        help="""
+        Proxy variables (`HTTP_PROXY`, `HTTPS_PROXY`, `FTP_PROXY`,
+        `NO_PROXY`, `ALL_PROXY`, or their lowercase forms) set on the
+        repo2docker build container and forwarded to the image build with
+        `--build-arg`.
+
+        Docker makes these build args available to every build step without
+        an `ARG` declaration, so a caching HTTP proxy set here serves the
+        packages downloaded by pip, conda and npm across builds. Other
+        variables would not reach the build steps, and are refused.
+        """,
+        config=True,
+    )
+
+    @validate("build_env")
+    def _validate_build_env(self, proposal):
+        unsupported = sorted(set(proposal["value"]) - set(PROXY_BUILD_ARGS))
+        if unsupported:
+            raise TraitError(
+                f"build_env only accepts the proxy variables, not {unsupported}"
+            )
+        return proposal["value"]
+
+    build_scratch_tmpfs_size = ByteSpecification(
+        0,
+        help="""
+        Size of a tmpfs mounted on /tmp in the repo2docker build container,
+        where the repository is checked out. It counts towards the memory of
+        the host. 0 disables it.
+        """,
+        config=True,
+    )
+
+    build_stop_grace_period = Int(
+        30,
+        help="""
+        Seconds a cancelled build container is given to exit before it is
+        killed.
+        """,
+        config=True,
+    )
+
+    build_timeout = Int(
+        0,
+        help="""
+        Wall-clock limit in seconds for a local build. A build still running
+        past it is stopped and marked as failed. 0 disables the limit.
+        """,
+        config=True,
+    )
+
+    build_cpu_limit = Float(
+        0,
+        help="""
+        Number of CPUs the repo2docker client container may use, while it
+        fetches the repository and drives the build. The image build steps
+        (e.g. the conda solve) run in the host Docker daemon and are not
+        limited. 0 leaves it unlimited.
+        """,
+        config=True,
+    )
+
+    build_cpu_shares = Int(
+        0,
+        help="""
+        Relative CPU weight of the repo2docker client container under
+        contention (Docker's default is 1024). It does not apply to the image
+        build steps, which run in the host Docker daemon. 0 keeps Docker's
+        default.
+        """,
+        config=True,
+    )
+
+    build_memory_limit = ByteSpecification(
+        0,
+        help="""
+        Memory limit of the repo2docker build container, also applied to the
+        steps of the image build. 0 leaves it unlimited.
+        """,
+        config=True,
+    )
+
+    build_pids_limit = Int(
+        0,
+        help="""
+        Maximum number of processes in the repo2docker client container.
+        It does not apply to the image build steps, which run in the host
+        Docker daemon. 0 leaves it unlimited.
+        """,
+        config=True,
+    )
+
+    docker_hosts = List(
+        Dict(),
+        default_value=[],
+        help="""
+        Docker hosts local builds are spread over, as a list of dicts with a
+        unique `name`, a `url` ("unix:///var/run/docker.sock",
+        "tcp://10.0.0.2:2376"...), optional `labels` matched against the
+        node selector of an environment, and optional `tls_ca`, `tls_cert`
+        and `tls_key` paths for TLS endpoints.
+        By default, the local Docker daemon is used.
+        """,
+        config=True,
+    )
+
+    docker_host_placement = Enum(
+        ["least-builds", "least-disk"],
+        default_value="least-builds",
+        help="""
+        How a build is placed among the `docker_hosts` matching its node
+        selector: on the host running the fewest builds, or on the host
+        whose environment images use the least disk space.
+        """,
+        config=True,
+    )
+
+    warm_images = Int(
+        0,
+        help="""
+        Number of most recently used environment images kept warm in the
+        page cache of the Docker hosts holding them, to speed up the first
+        start of a server. 0 disables it.
+        """,
+        config=True,
+    )
+
+    warm_images_interval = Int(
+        600,
+        help="""
+        Seconds between two rounds of the image warmer.
+        """,
+        config=True,
+    )
+
+    image_gc_interval = Int(
+        0,
+        help="""
+        Seconds between two rounds of the image collector, which removes the
+        dangling images left by rebuilds and, above `image_disk_budget`, the
+        least recently used environments. 0 disables it.
+        """,
+        config=True,
+    )
+
+    replica_id = Unicode(
+        help="""
+        Identifier of this replica of the service, owning the builds it
+        drives (defaults to the host name). Each replica sharing the
+        database must have its own. A replica restarted with the same
+        identifier picks its builds up again at once; the builds of other
+        replicas are only taken over once their lease expired.
+        """,
+        config=True,
+    )
+
+    @default("replica_id")
+    def _default_replica_id(self):
+        return socket.gethostname()
+
+    build_lease_ttl = Int(
+        DEFAULT_LEASE_TTL,
+        help="""
+        Seconds after which the builds of a replica of the service which
+        stopped renewing their lease (e.g. it died) are taken over by another
+        replica: local builds are resumed from their build container, others
+        are marked as failed. The leases are renewed three times per period.
+        """,
+        config=True,
+    )
+
+    reconcile_interval = Int(
+        300,
+        help="""
+        Seconds between two rounds of the reconciler, which keeps the
+        environments of the database in line with the Docker images and
+        build containers of local builds. It also runs on startup. 0 disables
+        the periodic rounds.
+        """,
+        config=True,
+    )
+
+    image_disk_budget = ByteSpecification(
+        0,
+        help="""
+        Disk space the image layers of a Docker host may use before the image
+        collector removes the least recently used environments. 0 disables
+        the eviction.
+        """,
+        config=True,
+    )
+
+    pinned_environments = List(
+        Unicode(),
+        default_value=[],
+        help="""
+        Names or image names of the environments the image collector never
+        removes.
+        """,
+        config=True,
+    )
+
+    hub_client_options = Dict(
+        {},
+        help="""
+        Options of the HTTP client for the JupyterHub API:
+
+        - `max_connections` (default 100) and `max_keepalive_connections`
+          (default 20): the size of its connection pool.
+        - `keepalive_expiry` (default 5): seconds an idle connection is kept.
+        - `http2` (default False): use HTTP/2, requires the `h2` package.
+        - `timeout` (default 30) and `connect_timeout` (default 10): in
+          seconds.
+        - `route_timeouts`: timeouts in seconds of some kinds of requests,
+          `spawn` (default 10) for starting a server.
+        """,
+        config=True,
+    )
+
+    binderhub_client_options = Dict(
+        {},
+        help="""
+        Options of the HTTP client for BinderHub, which has its own connection
+        pool. The keys are those of `hub_client_options`; its `route_timeouts`
+        are `build` (default 120), the time a build stream may stay silent
+        before it is reopened.
+        """,
+        config=True,
+    )
+
+    compress_responses = Bool(
+        True,
+        help="""
+        Compress the HTML, JSON and build log responses with brotli (if the
+        `brotli` package is installed) or gzip, as accepted by the client.
+        """,
+        config=True,
+    )
+
+    compression_min_length = Int(
+        1024,
+        help="""
+        Size in bytes from which a response is compressed. The build log
+        streams are always compressed.
+        """,
+        config=True,
+    )
+
+    max_log_streams_per_user = Int(
+        10,
+        help="""
+        Maximum number of build logs a user may follow at the same time.
+        0 means unlimited.
+        """,
+        config=True,
+    )
+
     repo_providers = List(
         default_value=[
             {"label": "Git", "value": "git"},
@@ -209,6 +633,7 @@ class TljhRepo2Docker(Application):
         "db_url": "TljhRepo2Docker.db_url",
         "cookie_secret_file": "TljhRepo2Docker.cookie_secret_file",
         "custom_links": "TljhRepo2Docker.custom_links",
+        "git_mirror_cache_dir": "TljhRepo2Docker.git_mirror_cache_dir",
     }
 
     def _load_cookie_secret(self) -> bytes:
@@ -249,6 +674,7 @@ class TljhRepo2Docker(Application):
             template_path=str(HERE / "templates"),
             static_path=static_path,
             static_url_prefix=static_url_prefix,
+            service_static_path=str(HERE / "static"),
             jinja2_env=env,
             cookie_secret=self._load_cookie_secret(),
             base_url=self.base_url,
@@ -262,17 +688,208 @@ class TljhRepo2Docker(Application):
             repo_providers=self.repo_providers,
             logo_url=self.logo_url,
             custom_links=self.custom_links,
+            git_mirror_cache=self.init_git_mirror_cache(),
+            build_env=self.build_env,
+            build_scratch_tmpfs_size=self.build_scratch_tmpfs_size,
+            build_stop_grace_period=self.build_stop_grace_period,
+            build_timeout=self.build_timeout,
+            build_limits={
+                "cpu": self.build_cpu_limit,
+                "cpu_shares": self.build_cpu_shares,
+                "memory": self.build_memory_limit,
+                "pids": self.build_pids_limit,
+            },
+            build_jobs=BuildJobs(log=self.log),
+            hub_client=self.init_hub_client(),
+            binderhub_client=self.init_binderhub_client(),
+            docker_hosts=self.init_docker_hosts(),
         )
         if hasattr(self, "db_context"):
             settings["db_context"] = self.db_context
         if hasattr(self, "image_db_manager"):
             settings["image_db_manager"] = self.image_db_manager
+        settings["log_watchers"] = BuildLogWatchers(
+            settings.get("db_context"),
+            settings.get("image_db_manager"),
+            max_streams_per_user=self.max_log_streams_per_user,
+            log=self.log,
+            notifier=getattr(self, "change_notifier", None),
+        )
+        if hasattr(self, "db_context") and hasattr(self, "image_db_manager"):
+            settings["build_leases"] = BuildLeases(
+                self.replica_id,
+                self.db_context,
+                self.image_db_manager,
+                settings["build_jobs"],
+                ttl=self.build_lease_ttl,
+                log=self.log,
+            )
+        if not self.binderhub_url:
+            from .image_gc import ImageCollector
+            from .reconciler import Reconciler
+
+            settings["image_collector"] = ImageCollector(
+                settings["docker_hosts"],
+                settings.get("db_context"),
+                settings.get("image_db_manager"),
+                disk_budget=self.image_disk_budget,
+                pinned=self.pinned_environments,
+                log=self.log,
+            )
+            settings["reconciler"] = Reconciler(
+                settings["docker_hosts"],
+                settings.get("db_context"),
+                settings.get("image_db_manager"),
+                build_jobs=settings["build_jobs"],
+                log=self.log,
+            )
         return settings
 
+    def _api_headers(self) -> tp.Dict[str, str]:
+        api_token = os.environ.get("JUPYTERHUB_API_TOKEN", None)
+        return {"Authorization": f"Bearer {api_token}"}
+
+    def init_hub_client(self) -> ServiceClient:
+        """Create the HTTP client of the JupyterHub API."""
+        return make_client(
+            "hub",
+            self.hub_client_options,
+            route_timeouts={"spawn": 10},
+            log=self.log,
+            base_url=os.environ.get("JUPYTERHUB_API_URL", ""),
+            headers=self._api_headers(),
+        )
+
+    def init_binderhub_client(self) -> tp.Optional[ServiceClient]:
+        """Create the HTTP client of BinderHub, if it is used."""
+        if not self.binderhub_url:
+            return None
+        from .binderhub_builder import STREAM_IDLE_TIMEOUT
+
+        # BinderHub runs as a JupyterHub service and accepts the API token.
+        return make_client(
+            "binderhub",
+            self.binderhub_client_options,
+            route_timeouts={"build": STREAM_IDLE_TIMEOUT},
+            log=self.log,
+            headers=self._api_headers(),
+        )
+
+    async def close_db_writer(self) -> None:
+        """Commit the queued database writes."""
+        if self.db_writer is not None:
+            await self.db_writer.close()
+
+    async def close_notifier(self) -> None:
+        """Stop listening to the changes of the environments."""
+        if self.change_notifier is not None:
+            await self.change_notifier.close()
+
+    async def close_clients(self) -> None:
+        """Close the connections of the HTTP clients."""
+        for name in ("hub_client", "binderhub_client"):
+            client = self.app.settings.get(name)
+            if client is not None:
+                await client.aclose()
+
+    def init_transforms(self) -> tp.List:
+        """Return the output transforms compressing the responses, if enabled."""
+        if not self.compress_responses:
+            return []
+        return [partial(ContentEncoding, min_length=self.compression_min_length)]
+
+    def init_docker_hosts(self) -> tp.Optional[DockerHostPool]:
+        """Create the pool of Docker hosts used by local builds, if configured."""
+        if self.binderhub_url or not self.docker_hosts:
+            return None
+        return DockerHostPool.from_config(
+            self.docker_hosts, self.docker_host_placement, log=self.log
+        )
+
+    def init_image_warmer(self) -> None:
+        """Start warming the most used images periodically, if configured."""
+        if self.binderhub_url or not self.warm_images:
+            return
+        if not hasattr(self, "db_context"):
+            # The usage of the images is recorded in the database.
+            return
+        from .image_warmer import ImageWarmer
+
+        settings = self.app.settings
+        warmer = ImageWarmer(
+            settings.get("docker_hosts"),
+            settings.get("db_context"),
+            settings.get("image_db_manager"),
+            self.warm_images,
+            log=self.log,
+        )
+        self.image_warmer_callback = ioloop.PeriodicCallback(
+            warmer.run, self.warm_images_interval * 1000
+        )
+        self.ioloop.add_callback(self._start_image_warmer, warmer)
+
+    async def _start_image_warmer(self, warmer) -> None:
+        # The usage is read from the database, once its schema is upgraded.
+        try:
+            await self.app.settings["db_ready"]
+        except Exception:
+            return
+        await warmer.run()
+        self.image_warmer_callback.start()
+
+    def init_image_collector(self) -> None:
+        """Run the image collector periodically, if configured."""
+        collector = self.app.settings.get("image_collector")
+        if collector is None or not self.image_gc_interval:
+            return
+        self.image_collector_callback = ioloop.PeriodicCallback(
+            collector.run, self.image_gc_interval * 1000
+        )
+        self.image_collector_callback.start()
+
+    def init_reconciler(self) -> None:
+        """Run the reconciler periodically, if configured."""
+        reconciler = self.app.settings.get("reconciler")
+        if reconciler is None or not self.reconcile_interval:
+            return
+        self.reconciler_callback = ioloop.PeriodicCallback(
+            reconciler.run, self.reconcile_interval * 1000
+        )
+        self.reconciler_callback.start()
+
+    def init_build_leases(self) -> None:
+        """
+        Renew the leases of the builds, and take over orphaned builds. The
+        callback is started by `_on_startup`, once the schema is upgraded.
+        """
+        self._takeover_lock = asyncio.Lock()
+        self.leases_callback = None
+        if self.app.settings.get("build_leases") is None:
+            return
+        self.leases_callback = ioloop.PeriodicCallback(
+            self._maintain_builds, self.build_lease_ttl * 1000 / 3
+        )
+
+    async def _maintain_builds(self):
+        await self.app.settings["build_leases"].run()
+        try:
+            await self._cleanup_stale_builds()
+        except Exception:
+            self.log.exception("Failed to take over the orphaned builds")
+
+    def init_git_mirror_cache(self) -> tp.Optional[GitMirrorCache]:
+        """Create the git mirror cache used by local builds, if configured."""
+        if self.binderhub_url or not self.git_mirror_cache_dir:
+            return None
+        return GitMirrorCache(
+            self.git_mirror_cache_dir,
+            max_size=self.git_mirror_cache_size,
+            log=self.log,
+        )
+
     def init_handlers(self) -> tp.List:
         """Initialize handlers for service application."""
         handlers = []
-        static_path = str(HERE / "static")
         server_url = url_path_join(self.service_prefix, r"servers")
         handlers.extend(
             [
@@ -283,8 +900,8 @@ class TljhRepo2Docker(Application):
                 ),
                 (
                     url_path_join(self.service_prefix, r"/service_static/(.*)"),
-                    web.StaticFileHandler,
-                    {"path": static_path},
+                    PrecompressedStaticFileHandler,
+                    {"path": str(HERE / "static")},
                 ),
                 (
                     url_path_join(self.service_prefix, "oauth_callback"),
@@ -300,9 +917,17 @@ class TljhRepo2Docker(Application):
                     url_path_join(self.service_prefix, r"environments"),
                     EnvironmentsHandler,
                 ),
+                (url_path_join(self.service_prefix, r"metrics"), MetricsHandler),
             ]
         )
+        # Only the modules of the build backend in use are imported.
         if self.binderhub_url:
+            from .binderhub_builder import (
+                BinderHubBuildCancelHandler,
+                BinderHubBuildHandler,
+            )
+            from .binderhub_log import BinderHubLogsHandler
+
             handlers.extend(
                 [
                     (
@@ -311,6 +936,12 @@ class TljhRepo2Docker(Application):
                         ),
                         BinderHubLogsHandler,
                     ),
+                    (
+                        url_path_join(
+                            self.service_prefix, r"api/environments/([^/]+)/cancel"
+                        ),
+                        BinderHubBuildCancelHandler,
+                    ),
                     (
                         url_path_join(self.service_prefix, r"api/environments"),
                         BinderHubBuildHandler,
@@ -318,6 +949,10 @@ class TljhRepo2Docker(Application):
                 ]
             )
         else:
+            from .builder import BuildCancelHandler, BuildHandler
+            from .image_gc import ImageCollectorHandler
+            from .reconciler import ReconcilerHandler
+
             handlers.extend(
                 [
                     (
@@ -326,6 +961,22 @@ class TljhRepo2Docker(Application):
                         ),
                         LogsHandler,
                     ),
+                    (
+                        url_path_join(
+                            self.service_prefix, r"api/environments/([^/]+)/cancel"
+                        ),
+                        BuildCancelHandler,
+                    ),
+                    (
+                        url_path_join(self.service_prefix, r"api/environments/gc"),
+                        ImageCollectorHandler,
+                    ),
+                    (
+                        url_path_join(
+                            self.service_prefix, r"api/environments/reconcile"
+                        ),
+                        ReconcilerHandler,
+                    ),
                     (
                         url_path_join(self.service_prefix, r"api/environments"),
                         BuildHandler,
@@ -336,24 +987,82 @@ class TljhRepo2Docker(Application):
 
     def init_db(self):
         async_db_url = sync_to_async_url(self.db_url)
+        db_log_url = self._db_log_url(async_db_url)
+        self.log.info("Connecting to db: %s", db_log_url)
+        try:
+            self.db_context = async_session_context_factory(
+                async_db_url, *self.init_db_options(async_db_url)
+            )
+        except Exception:
+            self.log.error("Failed to connect to db: %s", db_log_url)
+            self.log.debug("Database error was:", exc_info=True)
+
+        self.db_writer = None
+        if self.serialize_db_writes and hasattr(self, "db_context"):
+            self.db_writer = DatabaseWriter(
+                self.db_context, self.db_write_batch_size, log=self.log
+            )
+        self.change_notifier = None
+        if self.db_notifications:
+            self.change_notifier = make_notifier(async_db_url, log=self.log)
+        self.image_db_manager = ImagesDatabaseManager(
+            writer=self.db_writer,
+            read_context=self.init_db_read_context(),
+            read_your_writes_window=self.db_read_your_writes_window,
+            notifier=self.change_notifier,
+        )
+
+    def init_db_schema(self) -> asyncio.Future:
+        """
+        Upgrade the schema of the database if needed, in a thread: the
+        service starts listening meanwhile, and the handlers wait for it.
+        """
+        async_db_url = sync_to_async_url(self.db_url)
+        return self.ioloop.run_in_executor(
+            None, partial(upgrade_if_needed, async_db_url, log=self.log)
+        )
+
+    def init_db_read_context(self):
+        """Create the sessions of the read replica, if configured."""
+        if not self.db_read_url:
+            return None
+        async_db_url = sync_to_async_url(self.db_read_url)
+        db_log_url = self._db_log_url(async_db_url)
+        self.log.info("Reading from db: %s", db_log_url)
+        try:
+            return async_session_context_factory(
+                async_db_url, *self.init_db_options(async_db_url)
+            )
+        except Exception:
+            self.log.error("Failed to connect to db: %s", db_log_url)
+            self.log.debug("Database error was:", exc_info=True)
+            return None
+
+    @staticmethod
+    def _db_log_url(async_db_url: str) -> str:
         urlinfo = urlparse(async_db_url)
         if urlinfo.password:
             # avoid logging the database password
             urlinfo = urlinfo._replace(
                 netloc=f"{urlinfo.username}:[redacted]@{urlinfo.hostname}:{urlinfo.port}"
             )
-            db_log_url = urlinfo.geturl()
-        else:
-            db_log_url = async_db_url
-        self.log.info("Connecting to db: %s", db_log_url)
-        upgrade_if_needed(async_db_url, log=self.log)
-        try:
-            self.db_context = async_session_context_factory(async_db_url)
-        except Exception:
-            self.log.error("Failed to connect to db: %s", db_log_url)
-            self.log.debug("Database error was:", exc_info=True)
+            return urlinfo.geturl()
+        return async_db_url
 
-        self.image_db_manager = ImagesDatabaseManager()
+    def init_db_options(self, async_db_url: str) -> tp.Tuple[tp.Dict, tp.Dict]:
+        """Return the engine options and SQLite pragmas of the database."""
+        pool_options = {
+            "pool_size": self.db_pool_size,
+            "max_overflow": self.db_max_overflow,
+            "pool_pre_ping": self.db_pool_pre_ping,
+            "pool_recycle": self.db_pool_recycle,
+        }
+        return db_engine_options(
+            async_db_url,
+            self.db_profile,
+            {k: v for k, v in pool_options.items() if v is not None},
+            self.db_sqlite_pragmas,
+        )
 
     def make_app(self) -> web.Application:
         """Create the tornado web application.
@@ -365,43 +1074,137 @@ class TljhRepo2Docker(Application):
         application.listen(self.port, self.ip)
         return application
 
+    async def _on_startup(self):
+        """Resume or fail the interrupted builds, then reconcile with Docker."""
+        try:
+            await self.app.settings["db_ready"]
+        except Exception:
+            self.log.exception("Failed to upgrade the database")
+            self.ioloop.stop()
+            return
+        if self.leases_callback is not None:
+            self.leases_callback.start()
+        await self._cleanup_stale_builds()
+        reconciler = self.app.settings.get("reconciler")
+        if reconciler is not None:
+            await reconciler.run()
+
     async def _cleanup_stale_builds(self):
-        """Mark BUILDING entries as FAILED on startup (server was restarted mid-build)."""
+        """
+        Resume the BUILDING entries no replica of the service drives (server
+        was restarted mid-build, or a replica died): reattach to the build
+        container of local builds that still have one, and mark the others
+        as FAILED. It runs on startup, and periodically to take over the
+        builds whose lease expired.
+
+        Only the BUILDING entries are read, the build containers are listed
+        once per Docker host, and the interrupted builds are marked in a
+        single statement.
+        """
         if not hasattr(self, "db_context") or not hasattr(self, "image_db_manager"):
             return
+        async with self._takeover_lock:
+            await self._take_over_builds()
+
+    async def _take_over_builds(self):
         async with self.db_context() as db:
-            all_entries = await self.image_db_manager.read_all(db)
-        stale = [e for e in all_entries if e.status == BuildStatusType.BUILDING]
+            stale = await self.image_db_manager.read_by_status(
+                db, BuildStatusType.BUILDING
+            )
+        build_jobs = self.app.settings["build_jobs"]
+        stale = [entry for entry in stale if entry.uid not in build_jobs]
+        build_leases = self.app.settings.get("build_leases")
+        if stale and build_leases is not None:
+            # Compare-and-set: of the replicas seeing an expired lease, only
+            # one takes the build over.
+            now = utcnow()
+            orphaned = {e.uid: e for e in stale if build_leases.claimable(e, now)}
+            claimed = await build_leases.claim(list(orphaned))
+            stale = [orphaned[uid] for uid in claimed]
         if not stale:
             return
-        self.log.warning(
-            "Found %d build(s) stuck in BUILDING state — marking as FAILED", len(stale)
-        )
+        build_hosts = {}
+        if not self.binderhub_url and any(e.container_id for e in stale):
+            try:
+                from .docker import find_build_containers
+
+                build_hosts = await find_build_containers(
+                    stale, self.app.settings.get("docker_hosts")
+                )
+            except Exception:
+                self.log.exception("Failed to list the build containers")
+        interrupted = []
         for entry in stale:
-            async with self.db_context() as db:
-                await self.image_db_manager.update(
-                    db,
-                    DockerImageUpdateSchema(
-                        uid=entry.uid,
-                        status=BuildStatusType.FAILED,
-                        log=(entry.log or "")
-                        + "\n[Build interrupted: server restarted]\n",
-                    ),
+            if entry.uid in build_hosts:
+                build_jobs.start(
+                    entry.uid, self._resume_build(entry, build_hosts[entry.uid])
                 )
+            else:
+                interrupted.append(entry.uid)
+        if interrupted:
+            self.log.warning(
+                "Found %d build(s) stuck in BUILDING state — marking as FAILED",
+                len(interrupted),
+            )
+            await self._mark_interrupted(interrupted)
+
+    async def _resume_build(self, entry, docker_host):
+        """Reattach to a local build, or mark it as FAILED if it is gone."""
+        from .docker import resume_build
+
+        settings = self.app.settings
+        try:
+            resumed = await resume_build(
+                entry,
+                self.db_context,
+                self.image_db_manager,
+                docker_host=docker_host,
+                stop_timeout=self.build_stop_grace_period,
+                timeout=self.build_timeout,
+                limits=settings.get("build_limits"),
+                leases=settings.get("build_leases"),
+            )
+        except Exception:
+            self.log.exception("Failed to resume the build of %s", entry.name)
+            resumed = False
+        if not resumed:
+            await self._mark_interrupted([entry.uid])
+
+    async def _mark_interrupted(self, uids):
+        async with self.db_context() as db:
+            # Appended in the statement, after whatever log a resumed build
+            # saved; builds that ended meanwhile are left alone.
+            await self.image_db_manager.mark_status(
+                db,
+                where={"uid": uids, "status": BuildStatusType.BUILDING},
+                set=BuildStatusType.FAILED,
+                append_log="\n[Build interrupted: server restarted]\n",
+            )
 
     def start(self):
         """Start the server."""
         self.init_db()
         settings = self.init_settings()
 
-        self.app = web.Application(**settings)
+        self.app = web.Application(transforms=self.init_transforms(), **settings)
         self.app.settings.update(self.tornado_settings)
         handlers = self.init_handlers()
         self.app.add_handlers(".*$", handlers)
 
         self.app.listen(self.port, self.ip)
         self.ioloop = ioloop.IOLoop.current()
-        self.ioloop.add_callback(self._cleanup_stale_builds)
+        self.app.settings["db_ready"] = self.init_db_schema()
+        # JupyterHub stops its services with SIGTERM.
+        self.ioloop.asyncio_loop.add_signal_handler(
+            signal.SIGTERM, self._stop_on_signal
+        )
+        if self.change_notifier is not None:
+            self.ioloop.add_callback(self.change_notifier.start)
+        self.init_build_leases()
+        self.ioloop.add_callback(self._on_startup)
+        self.init_image_warmer()
+        self.init_image_collector()
+        self.init_reconciler()
         try:
             self.log.info(
                 f"tljh-repo2docker service listening on {self.ip}:{self.port}"
@@ -410,6 +1213,13 @@ class TljhRepo2Docker(Application):
             self.ioloop.start()
         except KeyboardInterrupt:
             self.log.info("Stopping...")
+        self.ioloop.run_sync(self.close_db_writer)
+        self.ioloop.run_sync(self.close_notifier)
+        self.ioloop.run_sync(self.close_clients)
+
+    def _stop_on_signal(self):
+        self.log.info("Received SIGTERM, stopping...")
+        self.ioloop.stop()
 
 
 main = TljhRepo2Docker.launch_instance
@@ -1,10 +1,10 @@
 import functools
 import json
-import os
 import sys
 from contextlib import _AsyncGeneratorContextManager
 from http.client import responses
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
 
 from httpx import AsyncClient
 from jinja2 import Template
@@ -16,7 +16,9 @@ from tornado.log import app_log
 
 from tljh_repo2docker import TLJH_R2D_ADMIN_SCOPE
 from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.schemas import BuildStatusType, DockerImageUpdateSchema
 
+from .compression import PrecompressedStaticFileHandler
 from .model import UserModel
 
 if sys.version_info >= (3, 9):
@@ -46,36 +48,35 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
     Base handler for tljh_repo2docker service
     """
 
-    _client = None
-
-    # Default timeout (seconds) applied to every request that does not pass
-    # its own ``timeout=`` argument. Bounded so a stuck JupyterHub API cannot
-    # block a handler indefinitely. Long-running calls (build log streaming)
-    # are expected to override this explicitly.
-    DEFAULT_REQUEST_TIMEOUT = 30.0
-
     @property
     def log(self):
         return self.settings.get("log", app_log)
 
     @property
-    def client(self):
+    def client(self) -> AsyncClient:
         """
-        Get the asynchronous HTTP client with valid authorization token.
+        Get the asynchronous HTTP client of the JupyterHub API, with a valid
+        authorization token.
 
-        The client is a process-wide singleton. The JupyterHub API token is
-        captured the first time the property is read; rotating the token
-        therefore requires a service restart.
+        The JupyterHub API token is read when the service starts; rotating
+        the token therefore requires a service restart.
         """
-        if not BaseHandler._client:
-            api_url = os.environ.get("JUPYTERHUB_API_URL", "")
-            api_token = os.environ.get("JUPYTERHUB_API_TOKEN", None)
-            BaseHandler._client = AsyncClient(
-                base_url=api_url,
-                headers={"Authorization": f"Bearer {api_token}"},
-                timeout=self.DEFAULT_REQUEST_TIMEOUT,
-            )
-        return BaseHandler._client
+        return self.settings["hub_client"]
+
+    @property
+    def binderhub_client(self) -> AsyncClient:
+        """
+        Get the asynchronous HTTP client of BinderHub. It has its own
+        connection pool, so long build streams do not hold the connections
+        of the JupyterHub API calls.
+        """
+        return self.settings["binderhub_client"]
+
+    async def prepare(self):
+        # The service listens while the schema of the database is checked.
+        db_ready = self.settings.get("db_ready")
+        if db_ready is not None and not db_ready.done():
+            await db_ready
 
     async def fetch_user(self) -> UserModel:
         user = self.current_user
@@ -121,6 +122,7 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
                 "logout_url", url_path_join(base_url, "logout")
             ),
             static_url=self.static_url,
+            service_static_url=self.service_static_url,
             xsrf_token=self.xsrf_token.decode("ascii"),
             user=user,
             admin_access=user.admin,
@@ -130,6 +132,21 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
         template = self.get_template(name)
         return template.render(**template_ns)
 
+    def service_static_url(self, path: str) -> str:
+        """Return the versioned URL of a file of the service static directory.
+        Args:
+            path: Path of the file, relative to the static directory
+        Returns:
+            The URL, with the content hash of the file as `v` argument
+        """
+        url = url_path_join(
+            self.settings.get("service_prefix", "/"), "service_static", path
+        )
+        version = PrecompressedStaticFileHandler.get_version(
+            {"static_path": self.settings["service_static_path"]}, path
+        )
+        return f"{url}?v={version}" if version else url
+
     def get_json_body(self):
         """Return the body of the request as JSON data."""
         if not self.request.body:
@@ -231,6 +248,16 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
         else:
             return None, None
 
+    def build_lease(self) -> Dict:
+        """
+        Return the lease columns of a build started by this replica of the
+        service, to save with its entry (none if leases are not used).
+        """
+        build_leases = self.settings.get("build_leases")
+        if build_leases is None:
+            return {}
+        return build_leases.values()
+
     async def get_images_from_db(self) -> List[Dict]:
         """
         Retrieve images from the database.
@@ -253,23 +280,98 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
                 - mem_limit (str): Memory limit.
 
         Note:
-            If `use_binderhub` flag is set to True and valid database context
-            and image database manager are available, it retrieves image
-            information; otherwise, an empty list is returned.
+            If a valid database context and image database manager are
+            available, it retrieves image information; otherwise, an empty
+            list is returned. The build logs are not loaded.
         """
-        db_context, image_db_manager = self.get_db_handlers()
+        db_context = self.settings.get("db_context")
+        image_db_manager = self.settings.get("image_db_manager")
         all_images = []
-        if self.use_binderhub and db_context and image_db_manager:
+        if db_context and image_db_manager:
             async with db_context() as db:
-                docker_images = await image_db_manager.read_all(db)
-                all_images = [
-                    dict(
-                        image_name=image.name,
-                        uid=str(image.uid),
-                        status=image.status,
-                        **image.image_meta.model_dump(),
-                    )
-                    for image in docker_images
-                ]
+                docker_images = await image_db_manager.read_all(db, with_log=False)
+                all_images = [self._image_dict(image) for image in docker_images]
 
         return all_images
+
+    async def stream_images_from_db(self) -> AsyncIterator[List[Dict]]:
+        """
+        Iterate over the images of the database, as `get_images_from_db`
+        lists them, in batches: the rows are read through a server-side
+        cursor, without holding the whole list in memory.
+        """
+        db_context = self.settings.get("db_context")
+        image_db_manager = self.settings.get("image_db_manager")
+        if not (db_context and image_db_manager):
+            return
+        async with db_context() as db:
+            async for images in image_db_manager.stream_all(db, with_log=False):
+                yield [self._image_dict(image) for image in images]
+
+    @staticmethod
+    def _image_dict(image) -> Dict:
+        return dict(
+            image_name=image.name,
+            uid=str(image.uid),
+            status=image.status,
+            **image.image_meta.model_dump(),
+        )
+
+    async def cancel_build(
+        self,
+        image_uid: str,
+        stop_container: Optional[Callable[[str], Awaitable]] = None,
+    ) -> None:
+        """
+        Cancel the build of an image and mark it as cancelled.
+
+        The build task of this process is cancelled if there is one. Otherwise
+        (e.g. the build was started before a restart of the service),
+        `stop_container` is awaited with the image name to stop it. The
+        environment entry and its build log are kept.
+
+        Parameters:
+        - image_uid (str): The UID of the image whose build is cancelled.
+        - stop_container: Coroutine function stopping an orphaned build.
+
+        Raises:
+        - web.HTTPError: If the UID is badly formed, the image is not found
+          or it is not being built.
+        """
+        try:
+            uid = UUID(image_uid)
+        except ValueError:
+            raise web.HTTPError(400, "Badly formed hexadecimal UUID string")
+
+        db_context = self.settings.get("db_context")
+        image_db_manager = self.settings.get("image_db_manager")
+        if not db_context or not image_db_manager:
+            raise web.HTTPError(500, "Database not configured")
+
+        async with db_context() as db:
+            image = await image_db_manager.read(db, uid, primary=True)
+        if not image:
+            raise web.HTTPError(404, "Image not found")
+        if image.status != BuildStatusType.BUILDING:
+            raise web.HTTPError(409, "Environment is not building")
+
+        build_jobs = self.settings.get("build_jobs")
+        cancelled = build_jobs is not None and await build_jobs.cancel(uid)
+        if not cancelled and stop_container is not None:
+            await stop_container(image.name)
+
+        user = self.current_user.get("name", "unknown")
+        async with db_context() as db:
+            # Re-read the log: the build may have flushed more lines while
+            # it was being stopped.
+            image = await image_db_manager.read(db, uid, primary=True) or image
+            # Unless the build ended meanwhile.
+            await image_db_manager.update(
+                db,
+                DockerImageUpdateSchema(
+                    uid=uid,
+                    status=BuildStatusType.CANCELLED,
+                    log=(image.log or "") + f"\n[Build cancelled by {user}]\n",
+                ),
+                where={"status": BuildStatusType.BUILDING},
+            )
@@ -1,29 +1,50 @@
+import asyncio
+from collections import Counter
 from datetime import datetime
 import json
+import random
 import re
+import time
+from typing import Optional
 from urllib.parse import quote
 from uuid import UUID, uuid4
 
 from aiodocker import Docker
+import httpx
 from jupyterhub.utils import url_path_join
 from tornado import web
+from tornado.log import app_log
 
 from .base import BaseHandler, require_admin_role
 from .database.schemas import (
     BuildStatusType,
     DockerImageCreateSchema,
     DockerImageUpdateSchema,
+    FINISHED_STATUSES,
     ImageMetadataType,
 )
 from .docker import split_url_credentials
-from .environments import build_image_list
+from .environments import write_image_list
+from .http_clients import ServiceClient
 
 IMAGE_NAME_RE = r"^[a-z0-9-_]+$"
 
-# Max time we'll keep the BinderHub SSE connection open for a single build.
-# Builds longer than this should be killed; this also bounds DB session reuse.
+# Max time we'll keep following a single build. Once it is over, a dropped
+# build stream is no longer reopened and the build is marked as failed.
 BUILD_STREAM_TIMEOUT = 60 * 60  # 1h
 
+# BinderHub sends a keepalive comment every 25s, so a build stream silent for
+# longer than this has been dropped (e.g. by a proxy) and is reopened. This is
+# the default timeout of the "build" route of the BinderHub client.
+STREAM_IDLE_TIMEOUT = 120
+
+# Backoff between the attempts to reopen a dropped build stream. The attempts
+# are counted again once a new message is received.
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+BUILT_PHASES = ("ready", "built")
+
 # Caps for the buffered build log (chars). The BinderHub SSE stream can emit
 # arbitrarily many messages, so without these bounds images.log could grow
 # without limit and exhaust the DB. Total persisted log size is at most
@@ -63,9 +84,7 @@ class BinderHubBuildHandler(BaseHandler):
     @web.authenticated
     @require_admin_role
     async def get(self):
-        images = await build_image_list(self)
-        self.set_header("content-type", "application/json")
-        self.finish(json.dumps({"images": images}))
+        await write_image_list(self)
 
     @web.authenticated
     @require_admin_role
@@ -89,7 +108,7 @@ class BinderHubBuildHandler(BaseHandler):
 
         deleted = False
         async with db_context() as db:
-            image = await image_db_manager.read(db, uid)
+            image = await image_db_manager.read(db, uid, primary=True)
             if image:
                 try:
                     async with Docker() as docker:
@@ -181,7 +200,9 @@ class BinderHubBuildHandler(BaseHandler):
             except (ValueError, AttributeError, TypeError):
                 raise web.HTTPError(400, "Invalid uid")
             async with db_context() as db:
-                existing_entry = await image_db_manager.read(db, rebuild_uid)
+                existing_entry = await image_db_manager.read(
+                    db, rebuild_uid, primary=True
+                )
             if existing_entry is None:
                 raise web.HTTPError(404, "Environment not found")
             if existing_entry.status == BuildStatusType.BUILDING.value:
@@ -212,9 +233,16 @@ class BinderHubBuildHandler(BaseHandler):
                     owner=existing_entry.image_meta.owner,
                     node_selector=node_selector,
                 ),
+                **self.build_lease(),
             )
             async with db_context() as db:
-                await image_db_manager.update(db, update_in)
+                # Compare-and-set: another request (or replica) may have
+                # started a build of the entry since it was read.
+                rebuilding = await image_db_manager.update(
+                    db, update_in, fetch=False, where={"status": FINISHED_STATUSES}
+                )
+            if not rebuilding:
+                raise web.HTTPError(409, "Environment is already building")
         else:
             uid = uuid4()
             creation_date = datetime.now().strftime("%d/%m/%Y")
@@ -233,6 +261,7 @@ class BinderHubBuildHandler(BaseHandler):
                     owner=owner,
                     node_selector=node_selector,
                 ),
+                **self.build_lease(),
             )
             async with db_context() as db:
                 await image_db_manager.create(db, image_in)
@@ -241,11 +270,116 @@ class BinderHubBuildHandler(BaseHandler):
         self.set_header("content-type", "application/json")
         self.finish(json.dumps({"uid": str(uid), "status": "ok"}))
 
-        log_buf = _BoundedLog()
-        # Open a short-lived session per write so a slow BinderHub stream
-        # cannot keep a DB transaction open for the entire build.
+        build = BinderHubBuild(
+            self.binderhub_client,
+            url,
+            params,
+            uid,
+            name,
+            db_context,
+            image_db_manager,
+            log=self.log,
+        ).run()
+        build_jobs = self.settings.get("build_jobs")
+        if build_jobs is not None:
+            build_jobs.start(uid, build)
+        else:
+            await build
+
+
+class BinderHubBuild:
+    """
+    Follow a BinderHub build to completion, persisting its log and status.
+
+    The build stream is reopened with an exponential backoff when it drops
+    (connection error, or no data for `STREAM_IDLE_TIMEOUT` seconds).
+    BinderHub attaches the new stream to the build in progress and replays
+    its log, so the messages already persisted are skipped. The stream is
+    reopened until the build ends or `BUILD_STREAM_TIMEOUT` is over: the
+    build endpoint is never called for any other purpose, since BinderHub
+    starts a new build when the image is missing.
+    """
+
+    def __init__(
+        self,
+        client: ServiceClient,
+        url: str,
+        params: dict,
+        uid: UUID,
+        name: str,
+        db_context,
+        image_db_manager,
+        log=None,
+    ) -> None:
+        self.client = client
+        self.url = url
+        self.params = params
+        self.uid = uid
+        self.name = name
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.log = log or app_log
+        self.log_buf = _BoundedLog()
+        # Fingerprints of the messages persisted, with their number of
+        # occurrences, to recognize the ones replayed by a new stream.
+        self._seen = Counter()
+        self._received = 0
+
+    async def run(self) -> None:
+        """
+        Follow the build, marking it as failed on any unexpected error so
+        that it is never left building. Cancelling the task closes the stream.
+        """
+        try:
+            await self.follow()
+        except Exception as e:
+            self.log.exception("Lost track of the BinderHub build of %s", self.name)
+            await self._finish(BuildStatusType.FAILED, f"\n[Build failed: {e}]\n")
+
+    async def follow(self) -> None:
+        deadline = time.monotonic() + BUILD_STREAM_TIMEOUT
+        attempts = 0
+        while True:
+            received = self._received
+            try:
+                if await self._stream():
+                    return
+                error = "the build stream ended"
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            if self._received > received:
+                attempts = 0
+            delay = min(RECONNECT_DELAY * 2**attempts, RECONNECT_MAX_DELAY)
+            delay *= random.uniform(0.5, 1)
+            attempts += 1
+            if time.monotonic() + delay >= deadline:
+                break
+            self.log.warning(
+                "Build stream of %s dropped (%s), reconnecting in %.1fs",
+                self.name,
+                error,
+                delay,
+            )
+            await asyncio.sleep(delay)
+
+        await self._finish(
+            BuildStatusType.FAILED,
+            f"\n[Lost the connection to BinderHub: {error}]\n",
+        )
+
+    async def _stream(self) -> bool:
+        """
+        Read the build stream until it ends.
+
+        Returns:
+            bool: `True` if the build is over and its status was saved.
+        """
+        occurrences = Counter()
         async with self.client.stream(
-            "GET", url, params=params, timeout=BUILD_STREAM_TIMEOUT
+            "GET",
+            self.url,
+            params=self.params,
+            timeout=self.client.route_timeout("build"),
         ) as r:
             async for line in r.aiter_lines():
                 if not line.startswith("data:"):
@@ -253,19 +387,68 @@ class BinderHubBuildHandler(BaseHandler):
                 json_log = json.loads(line.split(":", 1)[1])
                 phase = json_log.get("phase", None)
                 message = json_log.get("message", "")
-                if phase != "unknown":
-                    log_buf.append(message)
-                update_data = DockerImageUpdateSchema(uid=uid, log=log_buf.render())
-                stop = False
-                if phase == "ready" or phase == "built":
-                    image_name = json_log.get("imageName", name)
-                    update_data.status = BuildStatusType.BUILT
-                    update_data.name = image_name
-                    stop = True
-                elif phase == "failed":
-                    update_data.status = BuildStatusType.FAILED
-                    stop = True
-                async with db_context() as db:
-                    await image_db_manager.update(db, update_data)
-                if stop:
-                    return
+                if phase in BUILT_PHASES:
+                    self.log_buf.append(message)
+                    await self._finish(
+                        BuildStatusType.BUILT,
+                        name=json_log.get("imageName", self.name),
+                    )
+                    return True
+                if phase == "failed":
+                    self.log_buf.append(message)
+                    await self._finish(BuildStatusType.FAILED)
+                    return True
+                if phase == "unknown":
+                    continue
+                key = hash((phase, message))
+                occurrences[key] += 1
+                if occurrences[key] <= self._seen[key]:
+                    continue
+                self._seen[key] += 1
+                self._received += 1
+                self.log_buf.append(message)
+                # Open a short-lived session per write so a slow BinderHub
+                # stream cannot keep a DB transaction open for the build.
+                async with self.db_context() as db:
+                    await self.image_db_manager.update(
+                        db,
+                        DockerImageUpdateSchema(
+                            uid=self.uid, log=self.log_buf.render()
+                        ),
+                        fetch=False,
+                    )
+        return False
+
+    async def _finish(
+        self, status: BuildStatusType, note: str = "", name: Optional[str] = None
+    ) -> None:
+        if note:
+            self.log_buf.append(note)
+        update_data = DockerImageUpdateSchema(
+            uid=self.uid, status=status, log=self.log_buf.render()
+        )
+        if name is not None:
+            update_data.name = name
+        async with self.db_context() as db:
+            # Unless the build was cancelled meanwhile.
+            await self.image_db_manager.update(
+                db,
+                update_data,
+                fetch=False,
+                where={"status": BuildStatusType.BUILDING},
+            )
+
+
+class BinderHubBuildCancelHandler(BaseHandler):
+    """
+    Cancel a BinderHub build in progress by closing its build stream, keeping
+    the environment entry and its log
+    """
+
+    @web.authenticated
+    @require_admin_role
+    async def post(self, image_uid: str):
+        await self.cancel_build(image_uid)
+        self.set_status(200)
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps({"status": "ok"}))
@@ -0,0 +1,57 @@
+import asyncio
+from typing import Awaitable, Dict, Iterator, Optional
+from uuid import UUID
+
+from tornado.log import app_log
+
+
+class BuildJobs:
+    """
+    Registry of the builds running in this process, keyed by image uid.
+
+    Builds run as background tasks so that they outlive the request that
+    started them and can be cancelled from another request.
+    """
+
+    def __init__(self, log=None) -> None:
+        self.log = log or app_log
+        self._tasks: Dict[UUID, asyncio.Task] = {}
+
+    def __contains__(self, uid: UUID) -> bool:
+        return uid in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __iter__(self) -> Iterator[UUID]:
+        return iter(list(self._tasks))
+
+    def start(self, uid: UUID, coro: Awaitable) -> asyncio.Task:
+        """Run ``coro`` in the background as the build of ``uid``."""
+        task = asyncio.ensure_future(coro)
+        self._tasks[uid] = task
+        task.add_done_callback(lambda t: self._done(uid, t))
+        return task
+
+    def get(self, uid: UUID) -> Optional[asyncio.Task]:
+        return self._tasks.get(uid)
+
+    async def cancel(self, uid: UUID) -> bool:
+        """
+        Cancel the build of ``uid`` and wait for it to wind down.
+
+        Returns:
+            bool: `True` if a build was running in this process.
+        """
+        task = self._tasks.get(uid)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.wait([task])
+        return True
+
+    def _done(self, uid: UUID, task: asyncio.Task) -> None:
+        if self._tasks.get(uid) is task:
+            del self._tasks[uid]
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error("Build %s failed", uid, exc_info=task.exception())
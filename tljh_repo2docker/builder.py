@@ -3,7 +3,7 @@ import re
 from datetime import datetime
 from uuid import UUID, uuid4
 
-from aiodocker import Docker, DockerError
+from aiodocker import DockerError
 from tornado import web
 
 from .base import BaseHandler, require_admin_role
@@ -11,10 +11,18 @@ from .database.schemas import (
     BuildStatusType,
     DockerImageCreateSchema,
     DockerImageUpdateSchema,
+    FINISHED_STATUSES,
     ImageMetadataType,
 )
-from .docker import build_image, compute_image_name, split_url_credentials
-from .environments import build_image_list
+from .docker import (
+    build_image,
+    compute_image_name,
+    delete_image,
+    split_url_credentials,
+    stop_build_containers,
+)
+from .docker_hosts import NoDockerHostError
+from .environments import write_image_list
 
 IMAGE_NAME_RE = r"^[a-z0-9-_]+$"
 
@@ -27,9 +35,7 @@ class BuildHandler(BaseHandler):
     @web.authenticated
     @require_admin_role
     async def get(self):
-        images = await build_image_list(self)
-        self.set_header("content-type", "application/json")
-        self.finish(json.dumps({"images": images}))
+        await write_image_list(self)
 
     @web.authenticated
     @require_admin_role
@@ -44,37 +50,26 @@ class BuildHandler(BaseHandler):
         if db_context and image_db_manager:
             async with db_context() as db:
                 try:
-                    entry = await image_db_manager.read(db, UUID(image_name))
+                    entry = await image_db_manager.read(
+                        db, UUID(image_name), primary=True
+                    )
                 except ValueError:
-                    entry = await image_db_manager.read_by_image_name(db, image_name)
+                    entry = await image_db_manager.read_by_image_name(
+                        db, image_name, primary=True
+                    )
                 if entry:
                     image_name = entry.name
                     await image_db_manager.delete(db, entry.uid)
                     db_entry_deleted = True
 
-        async with Docker() as docker:
-            # Kill any in-progress build container for this image. Without
-            # this, deleting an environment mid-build leaves the repo2docker
-            # container running: list_containers() keeps showing it as
-            # "building" while the DB row (and its log) is gone.
-            containers = await docker.containers.list(
-                filters=json.dumps(
-                    {"label": [f"repo2docker.build={image_name}"]}
-                )
+        try:
+            deleted = await delete_image(
+                image_name, hosts=self.settings.get("docker_hosts")
             )
-            for container in containers:
-                try:
-                    await container.delete(force=True)
-                except DockerError:
-                    self.log.exception(
-                        "Failed to delete build container for %s", image_name
-                    )
-
-            try:
-                await docker.images.delete(image_name)
-            except DockerError as e:
-                if e.status != 404 or not db_entry_deleted:
-                    raise web.HTTPError(e.status, e.message)
+        except DockerError as e:
+            raise web.HTTPError(e.status, e.message)
+        if not deleted and not db_entry_deleted:
+            raise web.HTTPError(404, "Image not found")
 
         self.set_status(200)
         self.set_header("content-type", "application/json")
@@ -150,7 +145,9 @@ class BuildHandler(BaseHandler):
             except (ValueError, AttributeError, TypeError):
                 raise web.HTTPError(400, "Invalid uid")
             async with db_context() as db:
-                existing_entry = await image_db_manager.read(db, rebuild_uid)
+                existing_entry = await image_db_manager.read(
+                    db, rebuild_uid, primary=True
+                )
             if existing_entry is None:
                 raise web.HTTPError(404, "Environment not found")
             if existing_entry.status == BuildStatusType.BUILDING.value:
@@ -160,6 +157,21 @@ class BuildHandler(BaseHandler):
                     400, "Environment name does not match the rebuilt entry"
                 )
 
+        docker_host = None
+        docker_hosts = self.settings.get("docker_hosts")
+        if docker_hosts:
+            previous_host = None
+            if existing_entry and existing_entry.image_meta.build_info:
+                previous_host = existing_entry.image_meta.build_info.get(
+                    "docker_host"
+                )
+            try:
+                docker_host = await docker_hosts.choose(
+                    node_selector, prefer=previous_host
+                )
+            except NoDockerHostError as e:
+                raise web.HTTPError(400, str(e))
+
         uid = None
         if db_context and image_db_manager:
             if rebuild_uid is not None:
@@ -173,20 +185,32 @@ class BuildHandler(BaseHandler):
                     name=image_name,
                     status=BuildStatusType.BUILDING,
                     log="",
-                    image_meta=ImageMetadataType(
-                        display_name=name_norm,
-                        repo=repo,
-                        ref=ref_norm,
-                        cpu_limit=cpu or "",
-                        mem_limit=memory or "",
-                        creation_date=creation_date,
-                        owner=existing_entry.image_meta.owner,
-                        node_selector=node_selector,
-                        buildargs=buildargs or None,
+                    # The rest of the metadata, such as `last_used`, is kept.
+                    image_meta=existing_entry.image_meta.model_copy(
+                        update=dict(
+                            display_name=name_norm,
+                            repo=repo,
+                            ref=ref_norm,
+                            cpu_limit=cpu or "",
+                            mem_limit=memory or "",
+                            creation_date=creation_date,
+                            node_selector=node_selector,
+                            buildargs=buildargs or None,
+                            # The previous image is not an environment of its
+                            # own anymore (see `Reconciler`).
+                            build_info={"cache_from": [existing_entry.name]},
+                        )
                     ),
+                    **self.build_lease(),
                 )
                 async with db_context() as db:
-                    await image_db_manager.update(db, update_in)
+                    # Compare-and-set: another request (or replica) may have
+                    # started a build of the entry since it was read.
+                    rebuilding = await image_db_manager.update(
+                        db, update_in, fetch=False, where={"status": FINISHED_STATUSES}
+                    )
+                if not rebuilding:
+                    raise web.HTTPError(409, "Environment is already building")
             else:
                 uid = uuid4()
                 creation_date = datetime.now().strftime("%d/%m/%Y")
@@ -206,6 +230,7 @@ class BuildHandler(BaseHandler):
                         node_selector=node_selector,
                         buildargs=buildargs or None,
                     ),
+                    **self.build_lease(),
                 )
                 async with db_context() as db:
                     await image_db_manager.create(db, image_in)
@@ -217,8 +242,10 @@ class BuildHandler(BaseHandler):
             response["uid"] = str(uid)
         self.finish(json.dumps(response))
 
-        try:
-            await build_image(
+        build = self._build(
+            image_name,
+            uid,
+            build_image(
                 repo,
                 ref,
                 node_selector,
@@ -232,7 +259,29 @@ class BuildHandler(BaseHandler):
                 uid=uid,
                 db_context=db_context,
                 image_db_manager=image_db_manager,
-            )
+                git_cache=self.settings.get("git_mirror_cache"),
+                build_env=self.settings.get("build_env"),
+                scratch_tmpfs_size=self.settings.get("build_scratch_tmpfs_size", 0),
+                cache_from=[existing_entry.name] if existing_entry else None,
+                stop_timeout=self.settings.get("build_stop_grace_period"),
+                timeout=self.settings.get("build_timeout"),
+                limits=self.settings.get("build_limits"),
+                docker_host=docker_host,
+                leases=self.settings.get("build_leases"),
+            ),
+        )
+        build_jobs = self.settings.get("build_jobs")
+        if build_jobs is not None and uid is not None:
+            build_jobs.start(uid, build)
+        else:
+            await build
+
+    async def _build(self, image_name, uid, build):
+        """Run a build, recording an unexpected error as a failed build."""
+        db_context = self.settings.get("db_context")
+        image_db_manager = self.settings.get("image_db_manager")
+        try:
+            await build
         except Exception:
             # Log the full exception server-side, but persist a generic
             # message in the DB to avoid leaking credentials or repo URLs
@@ -247,4 +296,24 @@ class BuildHandler(BaseHandler):
                             status=BuildStatusType.FAILED,
                             log="Build failed. See service logs for details.",
                         ),
+                        where={"status": BuildStatusType.BUILDING},
                     )
+
+
+class BuildCancelHandler(BaseHandler):
+    """
+    Cancel a build in progress, keeping the environment entry and its log
+    """
+
+    @web.authenticated
+    @require_admin_role
+    async def post(self, image_uid: str):
+        timeout = self.settings.get("build_stop_grace_period")
+        hosts = self.settings.get("docker_hosts")
+        await self.cancel_build(
+            image_uid,
+            stop_container=lambda name: stop_build_containers(name, timeout, hosts),
+        )
+        self.set_status(200)
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps({"status": "ok"}))
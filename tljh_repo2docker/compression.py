@@ -0,0 +1,199 @@
+import mimetypes
+import os
+import re
+import zlib
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from tornado import httputil, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content codings the service compresses responses with, by preference.
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# Suffix of the precompressed variants of the static files.
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+
+GZIP_LEVEL = 6
+# Fast enough to compress responses on the fly.
+BROTLI_QUALITY = 4
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Parse an ``Accept-Encoding`` header into the q-value of each coding."""
+    encodings = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[coding] = q
+    return encodings
+
+
+def choose_encoding(header: str, available: Iterable[str]) -> Optional[str]:
+    """
+    Pick the content coding of a response.
+
+    Args:
+        header: The ``Accept-Encoding`` header of the request.
+        available: The codings the response can use, by preference.
+
+    Returns:
+        The accepted coding with the highest q-value, the first of
+        ``available`` on ties, or `None` to send the response as is.
+    """
+    accepted = accepted_encodings(header)
+    best = None
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, coding)
+    return best[1] if best else None
+
+
+def _compressor(encoding: str) -> Tuple[Callable, Callable, Callable]:
+    """Return the ``compress``, ``flush`` and ``finish`` functions of a coding."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+        compressor.flush,
+    )
+
+
+class ContentEncoding(web.OutputTransform):
+    """
+    Compress the text and JSON responses with brotli (when the ``brotli``
+    package is installed) or gzip, as negotiated with the client.
+
+    Responses sent at once are only compressed from ``min_length`` bytes.
+    Responses sent in several chunks, like the build log streams, are always
+    compressed, and each chunk is flushed so that every event reaches the
+    client as soon as it is written.
+    """
+
+    CONTENT_TYPES = web.GZipContentEncoding.CONTENT_TYPES
+
+    def __init__(
+        self,
+        request: httputil.HTTPServerRequest,
+        min_length: int = web.GZipContentEncoding.MIN_LENGTH,
+    ) -> None:
+        self.min_length = min_length
+        self._encoding = choose_encoding(
+            request.headers.get("Accept-Encoding", ""), ENCODINGS
+        )
+
+    def _compressible_type(self, ctype: str) -> bool:
+        return ctype.startswith("text/") or ctype in self.CONTENT_TYPES
+
+    def transform_first_chunk(
+        self,
+        status_code: int,
+        headers: httputil.HTTPHeaders,
+        chunk: bytes,
+        finishing: bool,
+    ) -> Tuple[int, httputil.HTTPHeaders, bytes]:
+        if "Vary" in headers:
+            headers["Vary"] += ", Accept-Encoding"
+        else:
+            headers["Vary"] = "Accept-Encoding"
+        if self._encoding is not None:
+            ctype = headers.get("Content-Type", "").split(";")[0]
+            if (
+                not self._compressible_type(ctype)
+                or (finishing and len(chunk) < self.min_length)
+                or "Content-Encoding" in headers
+            ):
+                self._encoding = None
+        if self._encoding is not None:
+            headers["Content-Encoding"] = self._encoding
+            self._compress, self._flush, self._finish = _compressor(self._encoding)
+            chunk = self.transform_chunk(chunk, finishing)
+            if "Content-Length" in headers:
+                if finishing:
+                    headers["Content-Length"] = str(len(chunk))
+                else:
+                    del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk: bytes, finishing: bool) -> bytes:
+        if self._encoding is None:
+            return chunk
+        chunk = self._compress(chunk)
+        return chunk + (self._finish() if finishing else self._flush())
+
+
+class PrecompressedStaticFileHandler(web.StaticFileHandler):
+    """
+    Serve static files, preferring their precompressed ``.br`` or ``.gz``
+    variant when there is one and the client accepts it.
+
+    Versioned URLs (with a ``v`` argument) and files with a content hash in
+    their name never change, so they are cached as immutable.
+    """
+
+    HASHED_NAME_RE = re.compile(r"[.-][0-9a-f]{8,}\.")
+
+    _encoding = None
+    _original_path = None
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None or not os.path.isfile(absolute_path):
+            return absolute_path
+        available = [
+            coding
+            for coding, suffix in PRECOMPRESSED.items()
+            if os.path.isfile(absolute_path + suffix)
+        ]
+        self._encoding = choose_encoding(
+            self.request.headers.get("Accept-Encoding", ""), available
+        )
+        if self._encoding is None:
+            return absolute_path
+        self._original_path = absolute_path
+        # Recent tornado versions keep the stat of the validated path to report
+        # its size: drop it so the size is the one of the variant.
+        self.__dict__.pop("_stat_result", None)
+        return absolute_path + PRECOMPRESSED[self._encoding]
+
+    def get_content_type(self) -> str:
+        if self._encoding is None:
+            return super().get_content_type()
+        mime_type, _ = mimetypes.guess_type(self._original_path)
+        return mime_type or "application/octet-stream"
+
+    def _immutable(self, path: str) -> bool:
+        return "v" in self.request.arguments or bool(
+            self.HASHED_NAME_RE.search(os.path.basename(path))
+        )
+
+    def get_cache_time(self, path: str, modified, mime_type: str) -> int:
+        if self._immutable(path):
+            return self.CACHE_MAX_AGE
+        return super().get_cache_time(path, modified, mime_type)
+
+    def set_extra_headers(self, path: str) -> None:
+        self.set_header("Vary", "Accept-Encoding")
+        if self._encoding is not None:
+            self.set_header("Content-Encoding", self._encoding)
+        if self._immutable(path):
+            self.set_header(
+                "Cache-Control", f"public, max-age={self.CACHE_MAX_AGE}, immutable"
+            )
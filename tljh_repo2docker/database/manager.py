@@ -1,21 +1,148 @@
+import functools
 import logging
-from typing import List, Optional, Type, Union
+import time
+from collections.abc import Collection
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Type, Union
+from uuid import UUID
 
 import sqlalchemy as sa
 from pydantic import UUID4
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import functions
 from tornado.web import HTTPError
 
+from ..notifications import change
 from .model import DockerImageSQL
 from .schemas import (
+    BuildStatusType,
     DockerImageCreateSchema,
+    DockerImageLogSchema,
     DockerImageOutSchema,
     DockerImageUpdateSchema,
 )
 
+# Seconds during which the entries written by this process are read from the
+# primary database, however late the read replica is.
+DEFAULT_READ_YOUR_WRITES_WINDOW = 30
+
+# Values of the lease columns of a build which is over.
+RELEASED_LEASE = {"lease_owner": None, "lease_expires": None}
+
+# Rows fetched at once from the server-side cursor of `stream_all`.
+STREAM_BATCH_SIZE = 200
+
+# Key of `AsyncSession.info` marking the sessions of a `DatabaseWriter`,
+# which commits the writes itself.
+BATCH = "tljh_repo2docker.batch"
+
+
+@compiles(functions.char_length, "sqlite")
+def _sqlite_char_length(element, compiler, **kw):
+    # SQLite has no CHAR_LENGTH, and its LENGTH counts characters.
+    return f"length({compiler.process(element.clauses, **kw)})"
+
+
+def _write(method):
+    """Run a write method through the writer of the manager, if it has one."""
+
+    @functools.wraps(method)
+    async def wrapper(self, db: AsyncSession, *args, **kwargs):
+        if self.writer is None or db.info.get(BATCH):
+            return await method(self, db, *args, **kwargs)
+        return await self.writer.submit(
+            lambda batch_db: method(self, batch_db, *args, **kwargs)
+        )
+
+    return wrapper
+
+
+def _read(by_uid: bool = False):
+    """
+    Run a read method on the read replica of the manager, if it has one.
+
+    The session passed in (on the primary database) is used instead when the
+    method is called with ``primary=True``, or, for the methods reading one
+    entry (``by_uid``), when this process wrote the entry recently: the
+    replica may not have the write yet.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(
+            self, db: AsyncSession, *args, primary: bool = False, **kwargs
+        ):
+            if (
+                self.read_context is None
+                or primary
+                or db.info.get(BATCH)
+                or (
+                    by_uid
+                    and self._written_recently(args[0] if args else kwargs["uid"])
+                )
+            ):
+                return await method(self, db, *args, **kwargs)
+            async with self.read_context() as read_db:
+                return await method(self, read_db, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
 
 class ImagesDatabaseManager:
+    def __init__(
+        self,
+        writer=None,
+        read_context=None,
+        read_your_writes_window: float = DEFAULT_READ_YOUR_WRITES_WINDOW,
+        notifier=None,
+    ) -> None:
+        # With a writer, the writes are serialized and committed in batches,
+        # in the sessions of the writer rather than the ones passed in.
+        self.writer = writer
+        # With a read context (sessions on a read replica), most reads go to
+        # the replica.
+        self.read_context = read_context
+        self.read_your_writes_window = read_your_writes_window
+        self._written: Dict[UUID, float] = {}
+        # With a notifier, the writes publish the changes they make, which
+        # are delivered once committed.
+        self.notifier = notifier
+
+    async def _notify(
+        self,
+        db: AsyncSession,
+        uid: Optional[UUID] = None,
+        status: Optional[str] = None,
+        offset: Optional[int] = None,
+    ) -> None:
+        if self.notifier is not None:
+            await self.notifier.publish(db, change(uid, status, offset))
+
+    def _wrote(self, *uids: UUID) -> None:
+        """Record that this process wrote the entries of ``uids``."""
+        if self.read_context is None:
+            return
+        now = time.monotonic()
+        if len(self._written) > 1000:
+            self._written = {
+                uid: written
+                for uid, written in self._written.items()
+                if now - written < self.read_your_writes_window
+            }
+        for uid in uids:
+            self._written[uid] = now
+
+    def _written_recently(self, uid: UUID) -> bool:
+        written = self._written.get(uid)
+        return (
+            written is not None
+            and time.monotonic() - written < self.read_your_writes_window
+        )
+
     @property
     def _table(self) -> Type[DockerImageSQL]:
         return DockerImageSQL
@@ -24,6 +151,7 @@ class ImagesDatabaseManager:
     def _schema_out(self) -> Type[DockerImageOutSchema]:
         return DockerImageOutSchema
 
+    @_write
     async def create(
         self, db: AsyncSession, obj_in: DockerImageCreateSchema
     ) -> DockerImageOutSchema:
@@ -40,12 +168,14 @@ class ImagesDatabaseManager:
         Raises:
             DatabaseError: If `db.commit()` failed.
         """
+        self._wrote(obj_in.uid)
         entry = self._table(**obj_in.model_dump())
 
         db.add(entry)
+        await self._notify(db, obj_in.uid, obj_in.status, len(obj_in.log or ""))
 
         try:
-            await db.commit()
+            await self._commit(db)
             # db.refresh(entry)
         except IntegrityError as e:
             logging.error(f"create: {e}")
@@ -56,6 +186,13 @@ class ImagesDatabaseManager:
 
         return self._schema_out.model_validate(entry)
 
+    async def _commit(self, db: AsyncSession) -> None:
+        if db.info.get(BATCH):
+            await db.flush()
+        else:
+            await db.commit()
+
+    @_read(by_uid=True)
     async def read(
         self, db: AsyncSession, uid: UUID4
     ) -> Union[DockerImageOutSchema, None]:
@@ -73,6 +210,7 @@ class ImagesDatabaseManager:
             return self._schema_out.model_validate(entry)
         return None
 
+    @_read()
     async def read_many(
         self, db: AsyncSession, uids: List[UUID4]
     ) -> List[DockerImageOutSchema]:
@@ -91,19 +229,94 @@ class ImagesDatabaseManager:
         ).scalars()
         return [self._schema_out.model_validate(r) for r in resources]
 
-    async def read_all(self, db: AsyncSession) -> List[DockerImageOutSchema]:
+    @_read()
+    async def read_all(
+        self, db: AsyncSession, with_log: bool = True
+    ) -> List[DockerImageOutSchema]:
         """
         Get all rows.
 
         Args:
             db: An asyncio version of SQLAlchemy session.
+            with_log: If `False`, do not load the build logs, which are by far
+            the largest column (the resources have an empty log).
 
         Returns:
             The list of resources retrieved.
         """
-        resources = (await db.execute(sa.select(self._table))).scalars().all()
+        if with_log:
+            resources = (await db.execute(sa.select(self._table))).scalars().all()
+            return [self._schema_out.model_validate(r) for r in resources]
+        columns = [c for c in self._table.__table__.columns if c.name != "log"]
+        rows = await db.execute(sa.select(*columns))
+        return [
+            self._schema_out.model_validate({**row._mapping, "log": ""}) for row in rows
+        ]
+
+    async def stream_all(
+        self,
+        db: AsyncSession,
+        with_log: bool = False,
+        primary: bool = False,
+        batch_size: int = STREAM_BATCH_SIZE,
+    ) -> AsyncIterator[List[DockerImageOutSchema]]:
+        """
+        Iterate over all rows through a server-side cursor, so that only
+        ``batch_size`` rows are held in memory at once.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            with_log: If `True`, load the build logs too.
+            primary: If `True`, read from ``db`` rather than the read replica.
+            batch_size: The number of rows fetched at once.
+
+        Yields:
+            The resources, in lists of at most ``batch_size``.
+        """
+        # As `_read`, for the whole iteration.
+        if self.read_context is None or primary or db.info.get(BATCH):
+            async for resources in self._stream_all(db, with_log, batch_size):
+                yield resources
+            return
+        async with self.read_context() as read_db:
+            async for resources in self._stream_all(read_db, with_log, batch_size):
+                yield resources
+
+    async def _stream_all(
+        self, db: AsyncSession, with_log: bool, batch_size: int
+    ) -> AsyncIterator[List[DockerImageOutSchema]]:
+        if with_log:
+            statement = sa.select(self._table).execution_options(yield_per=batch_size)
+            result = await db.stream_scalars(statement)
+            async for partition in result.partitions():
+                yield [self._schema_out.model_validate(r) for r in partition]
+            return
+        columns = [c for c in self._table.__table__.columns if c.name != "log"]
+        statement = sa.select(*columns).execution_options(yield_per=batch_size)
+        async for partition in (await db.stream(statement)).partitions():
+            yield [
+                self._schema_out.model_validate({**row._mapping, "log": ""})
+                for row in partition
+            ]
+
+    async def read_by_status(
+        self, db: AsyncSession, status: BuildStatusType
+    ) -> List[DockerImageOutSchema]:
+        """
+        Get the rows with a given status.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            status: The build status of the rows to retrieve.
+
+        Returns:
+            The list of resources retrieved.
+        """
+        statement = sa.select(self._table).where(self._table.status == status)
+        resources = (await db.execute(statement)).scalars().all()
         return [self._schema_out.model_validate(r) for r in resources]
 
+    @_read()
     async def read_by_image_name(
         self, db: AsyncSession, image: str
     ) -> Optional[DockerImageOutSchema]:
@@ -127,53 +340,337 @@ class ImagesDatabaseManager:
             return None
         return self._schema_out.model_validate(row)
 
+    @_read(by_uid=True)
+    async def read_log_since(
+        self, db: AsyncSession, uid: UUID4, offset: int
+    ) -> Optional[DockerImageLogSchema]:
+        """
+        Get the status of one resource and the end of its log, past the
+        first ``offset`` characters, without loading the rest of the row.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            uid: The primary key of the resource to retrieve.
+            offset: The length of the log already read.
+
+        Returns:
+            The status, the new part of the log and the length of the whole
+            log, `None` if the resource does not exist.
+        """
+        log = sa.func.coalesce(self._table.log, "")
+        statement = sa.select(
+            self._table.status,
+            # SQL strings are indexed from 1. Both count characters, as the
+            # offsets do: LENGTH counts bytes on MySQL.
+            sa.func.substr(log, offset + 1),
+            sa.func.char_length(log),
+        ).where(self._table.uid == uid)
+        row = (await db.execute(statement)).first()
+        if row is None:
+            return None
+        status, new_log, length = row
+        return DockerImageLogSchema(status=status, log=new_log or "", length=length)
+
+    @_write
     async def update(
-        self, db: AsyncSession, obj_in: DockerImageUpdateSchema, optimistic: bool = True
-    ) -> Union[DockerImageOutSchema, None]:
+        self,
+        db: AsyncSession,
+        obj_in: DockerImageUpdateSchema,
+        fetch: bool = True,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> Union[DockerImageOutSchema, bool, None]:
         """
-        Update one object.
+        Update one object with a single UPDATE statement.
+
+        The updated row is returned by the statement itself (UPDATE ...
+        RETURNING); on databases without RETURNING, it is read again after
+        the update. A finished build releases its lease.
 
         Args:
             db: An asyncio version of SQLAlchemy session.
             obj_in: A model containing values to update
-            optimistic: If `True`, assert the new model instance to be
-            `**{**obj_db.dict(), **obj_in.dict()}`
+            fetch: If `False`, do not return the updated model instance, which
+            saves building it (e.g. when flushing a build log).
+            where: The values the columns must have for the object to be
+            updated, as in `mark_status`, e.g. ``{"status": "building"}`` to
+            change the status atomically (compare-and-set).
 
         Returns:
-            The updated model instance on success, `None` if it does not exist
-            yet in database.
+            The updated model instance on success (`True` if ``fetch`` is
+            `False`), `None` if it does not exist yet in database or does not
+            match ``where``.
 
         Raises:
+            ValueError: If ``where`` names an unknown column.
             DatabaseError: If `db.commit()` failed.
         """
-        obj_db = await self.read(db=db, uid=obj_in.uid)
-        if obj_db is None:
-            # Row gone (e.g. deleted while a build was still in flight): do
-            # not silently re-create it from a partial update payload — that
-            # would resurrect a stale entry with NULL name/status.
-            return None
-
-        update_data = obj_in.model_dump(exclude_none=True)
-
-        await db.execute(
+        self._wrote(obj_in.uid)
+        update_data = obj_in.model_dump(exclude_none=True, exclude={"uid"})
+        status = update_data.get("status")
+        if status is not None and status != BuildStatusType.BUILDING:
+            update_data.update(RELEASED_LEASE)
+        statement = (
             sa.update(self._table)
-            .where(self._table.uid == obj_in.uid)
+            .where(self._table.uid == obj_in.uid, *self._conditions(where or {}))
             .values(**update_data)
         )
+        returning = fetch and db.get_bind().dialect.update_returning
+        if returning:
+            statement = statement.returning(*self._table.__table__.columns)
+
+        result = await db.execute(statement)
+        row = result.first() if returning else None
+        # Row gone (e.g. deleted while a build was still in flight): the
+        # update is a no-op, it never re-creates the row from a partial
+        # update payload.
+        missing = row is None if returning else result.rowcount == 0
+        if not missing:
+            await self._notify(
+                db,
+                obj_in.uid,
+                update_data.get("status"),
+                len(update_data["log"]) if "log" in update_data else None,
+            )
 
         try:
-            await db.commit()
+            await self._commit(db)
         except SQLAlchemyError as e:
             logging.error(f"update: {e}")
             raise e
 
-        if optimistic:
-            for field in update_data:
-                setattr(obj_db, field, update_data[field])
-            return self._schema_out.model_validate(obj_db)
-
+        if missing:
+            return None
+        if not fetch:
+            return True
+        if row is not None:
+            return self._schema_out.model_validate(dict(row._mapping))
         return await self.read(db=db, uid=obj_in.uid)
 
+    def _conditions(self, where: Dict[str, Any]) -> List:
+        conditions = []
+        for column, value in where.items():
+            if column not in self._table.__table__.columns:
+                raise ValueError(f"Unknown column: {column}")
+            attribute = getattr(self._table, column)
+            if isinstance(value, Collection) and not isinstance(value, str):
+                conditions.append(attribute.in_(value))
+            else:
+                conditions.append(attribute == value)
+        return conditions
+
+    @_write
+    async def mark_status(
+        self,
+        db: AsyncSession,
+        where: Dict[str, Any],
+        set: BuildStatusType,
+        append_log: str = "",
+    ) -> int:
+        """
+        Set the status of every object matching ``where`` with a single
+        UPDATE statement, without loading them.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            where: The values of the columns to match, a list of values
+            matching any of them (e.g. ``{"uid": uids, "status": "building"}``).
+            set: The new status.
+            append_log: A note to append to the log of the objects.
+
+        Returns:
+            int: The number of objects updated.
+
+        Raises:
+            ValueError: If ``where`` names an unknown column.
+            DatabaseError: If `db.commit()` failed.
+        """
+        conditions = self._conditions(where)
+        uids = where.get("uid", [])
+        self._wrote(*(uids if isinstance(uids, Collection) else [uids]))
+        values = {"status": set}
+        if set != BuildStatusType.BUILDING:
+            values.update(RELEASED_LEASE)
+        if append_log:
+            values["log"] = sa.func.coalesce(self._table.log, "") + append_log
+
+        result = await db.execute(
+            sa.update(self._table).where(*conditions).values(**values)
+        )
+        if result.rowcount:
+            if "uid" in where:
+                for uid in uids if isinstance(uids, Collection) else [uids]:
+                    await self._notify(db, uid, set)
+            else:
+                await self._notify(db, status=set)
+
+        try:
+            await self._commit(db)
+        except SQLAlchemyError as e:
+            logging.error(f"mark_status: {e}")
+            raise e
+
+        return result.rowcount
+
+    @_write
+    async def update_image_meta(self, db: AsyncSession, uid: UUID4, **fields) -> bool:
+        """
+        Merge fields into the image metadata of one object.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            uid: The primary key of the resource to update.
+            **fields: The metadata keys to set.
+
+        Returns:
+            bool: `True` if the object has been updated, `False` if it does
+            not exist.
+
+        Raises:
+            DatabaseError: If `db.commit()` failed.
+        """
+        self._wrote(uid)
+        entry = await db.get(self._table, uid)
+        if entry is None:
+            return False
+        entry.image_meta = {**(entry.image_meta or {}), **fields}
+        await self._notify(db, uid)
+
+        try:
+            await self._commit(db)
+        except SQLAlchemyError as e:
+            logging.error(f"update_image_meta: {e}")
+            raise e
+
+        return True
+
+    @_write
+    async def record_usage(
+        self, db: AsyncSession, image_names: List[str], last_used: str
+    ) -> int:
+        """
+        Set the last time the environments of ``image_names`` were used.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            image_names: The Docker image names of the environments.
+            last_used: The ISO 8601 date of the last use.
+
+        Returns:
+            int: The number of environments updated.
+
+        Raises:
+            DatabaseError: If `db.commit()` failed.
+        """
+        if not image_names:
+            return 0
+        statement = sa.select(self._table).where(self._table.name.in_(image_names))
+        entries = (await db.execute(statement)).scalars().all()
+        for entry in entries:
+            entry.image_meta = {**(entry.image_meta or {}), "last_used": last_used}
+
+        try:
+            await self._commit(db)
+        except SQLAlchemyError as e:
+            logging.error(f"record_usage: {e}")
+            raise e
+
+        return len(entries)
+
+    @_write
+    async def claim(
+        self, db: AsyncSession, uid: UUID4, owner: str, now: datetime, expires: datetime
+    ) -> bool:
+        """
+        Take the lease of a build in progress, if it is free: expired, never
+        taken, or already held by ``owner``.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            uid: The primary key of the building resource.
+            owner: The identifier of the replica taking the lease.
+            now: The current time (UTC).
+            expires: The expiry of the lease (UTC).
+
+        Returns:
+            bool: `True` if ``owner`` holds the lease, `False` if another
+            replica does or the build is over.
+
+        Raises:
+            DatabaseError: If `db.commit()` failed.
+        """
+        self._wrote(uid)
+        table = self._table
+        result = await db.execute(
+            sa.update(table)
+            .where(
+                table.uid == uid,
+                table.status == BuildStatusType.BUILDING,
+                sa.or_(
+                    table.lease_owner == owner,
+                    table.lease_expires.is_(None),
+                    table.lease_expires < now,
+                ),
+            )
+            .values(lease_owner=owner, lease_expires=expires)
+        )
+
+        try:
+            await self._commit(db)
+        except SQLAlchemyError as e:
+            logging.error(f"claim: {e}")
+            raise e
+
+        return result.rowcount == 1
+
+    @_write
+    async def renew_leases(
+        self, db: AsyncSession, uids: List[UUID4], owner: str, expires: datetime
+    ) -> List[UUID4]:
+        """
+        Extend the leases ``owner`` holds on the builds of ``uids``.
+
+        Args:
+            db: An asyncio version of SQLAlchemy session.
+            uids: The primary keys of the builds run by ``owner``.
+            owner: The identifier of the replica holding the leases.
+            expires: The new expiry of the leases (UTC).
+
+        Returns:
+            The uids of the builds still in progress whose lease is held by
+            another replica: they were taken over.
+
+        Raises:
+            DatabaseError: If `db.commit()` failed.
+        """
+        if not uids:
+            return []
+        table = self._table
+        building = sa.and_(
+            table.uid.in_(uids), table.status == BuildStatusType.BUILDING
+        )
+        result = await db.execute(
+            sa.update(table)
+            .where(building, table.lease_owner == owner)
+            .values(lease_expires=expires)
+        )
+        taken_over = []
+        if result.rowcount != len(uids):
+            # Some builds are over, or owned by another replica.
+            statement = sa.select(table.uid).where(
+                building,
+                sa.or_(table.lease_owner != owner, table.lease_owner.is_(None)),
+            )
+            taken_over = list((await db.execute(statement)).scalars())
+
+        try:
+            await self._commit(db)
+        except SQLAlchemyError as e:
+            logging.error(f"renew_leases: {e}")
+            raise e
+
+        return taken_over
+
+    @_write
     async def delete(self, db: AsyncSession, uid: UUID4) -> bool:
         """
         Delete one object.
@@ -188,10 +685,13 @@ class ImagesDatabaseManager:
         Raises:
             DatabaseError: If `db.commit()` failed.
         """
+        self._wrote(uid)
         results = await db.execute(sa.delete(self._table).where(self._table.uid == uid))
+        if results.rowcount:
+            await self._notify(db, uid, "deleted")
 
         try:
-            await db.commit()
+            await self._commit(db)
         except SQLAlchemyError as e:
             logging.error(f"delete: {e}")
             raise e
@@ -1,7 +1,7 @@
 import uuid
 
 from jupyterhub.orm import JSONDict
-from sqlalchemy import Column, String, Text
+from sqlalchemy import Column, DateTime, Index, String, Text
 from sqlalchemy.dialects.postgresql import ENUM, UUID
 from sqlalchemy.orm import DeclarativeMeta, declarative_base
 
@@ -39,4 +39,24 @@ class DockerImageSQL(BaseSQL):
 
     image_meta = Column(JSONDict, default={})
 
+    # Build container of a local build, to reattach to it after a restart.
+    container_id = Column(String(length=128), nullable=True)
+
+    # Docker timestamp of the last build log line saved in `log`.
+    log_cursor = Column(String(length=64), nullable=True)
+
+    # Lease of a build in progress: the replica of the service driving the
+    # build, which renews the lease until the build is over. Once the lease
+    # has expired (UTC), another replica may take the build over.
+    lease_owner = Column(String(length=255), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # The environments are listed, looked up by image name, and filtered
+        # by status (builds in progress). MySQL only indexes a prefix of
+        # long strings.
+        Index("ix_images_name", "name", mysql_length=255),
+        Index("ix_images_status", "status"),
+    )
+
     __mapper_args__ = {"eager_defaults": True}
@@ -1,5 +1,6 @@
+from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from pydantic import UUID4, BaseModel, ConfigDict
 
@@ -8,6 +9,15 @@ class BuildStatusType(str, Enum):
     BUILT = "built"
     BUILDING = "building"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+# The statuses of the builds which are over, and may be built again.
+FINISHED_STATUSES = [
+    BuildStatusType.BUILT,
+    BuildStatusType.FAILED,
+    BuildStatusType.CANCELLED,
+]
 
 
 class ImageMetadataType(BaseModel):
@@ -20,6 +30,8 @@ class ImageMetadataType(BaseModel):
     mem_limit: str
     node_selector: dict
     buildargs: Optional[str] = None
+    build_info: Optional[Dict[str, Any]] = None
+    last_used: Optional[str] = None
 
 
 class DockerImageCreateSchema(BaseModel):
@@ -28,6 +40,10 @@ class DockerImageCreateSchema(BaseModel):
     status: BuildStatusType
     log: str
     image_meta: ImageMetadataType
+    container_id: Optional[str] = None
+    log_cursor: Optional[str] = None
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[datetime] = None
 
     model_config = ConfigDict(use_enum_values=True)
 
@@ -44,3 +60,11 @@ class DockerImageUpdateSchema(DockerImageCreateSchema):
 
 class DockerImageOutSchema(DockerImageCreateSchema):
     model_config = ConfigDict(use_enum_values=True, from_attributes=True)
+
+
+class DockerImageLogSchema(BaseModel):
+    status: BuildStatusType
+    log: str
+    length: int
+
+    model_config = ConfigDict(use_enum_values=True)
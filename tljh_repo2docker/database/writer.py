@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..metrics import DB_WRITE_BATCH_SIZE, DB_WRITE_SECONDS
+from .manager import BATCH
+
+T = TypeVar("T")
+
+DEFAULT_BATCH_SIZE = 64
+
+Operation = Callable[[AsyncSession], Awaitable]
+
+
+class DatabaseWriter:
+    """
+    Run the database writes one batch at a time, from a single task.
+
+    SQLite lets one connection write at a time: concurrent writers wait on
+    the database lock, up to the busy timeout. Here, the write operations
+    are queued, and the writer runs the queued operations in a single
+    transaction, committed once. If an operation of a batch fails, the batch
+    is rolled back and its operations are run again one by one, so that only
+    the failing one reports the error.
+
+    Reads do not go through the writer.
+    """
+
+    def __init__(
+        self, db_context, batch_size: int = DEFAULT_BATCH_SIZE, log=None
+    ) -> None:
+        self.db_context = db_context
+        self.batch_size = batch_size
+        self.log = log or logging.getLogger(__name__)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, operation: Callable[[AsyncSession], Awaitable[T]]) -> T:
+        """
+        Queue a write operation and wait for it to be committed.
+
+        Args:
+            operation: A coroutine function running the write statements in
+            the session it is given, without committing them.
+
+        Returns:
+            The result of the operation, once its batch is committed.
+
+        Raises:
+            Exception: The error of the operation, or of the commit.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future, time.monotonic()))
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = None in batch
+            batch = [item for item in batch if item and not item[1].cancelled()]
+            if batch:
+                await self._write(batch)
+            if stop:
+                return
+
+    async def _write(self, batch: List[Tuple]) -> None:
+        DB_WRITE_BATCH_SIZE.observe(len(batch))
+        if len(batch) > 1:
+            try:
+                results = await self._transaction([item[0] for item in batch])
+            except Exception:
+                self.log.debug("Retrying a failed batch of %d writes", len(batch))
+            else:
+                for (_, future, queued), result in zip(batch, results):
+                    self._resolve(future, queued, result=result)
+                return
+        for item in batch:
+            await self._write_one(item)
+
+    async def _write_one(self, item: Tuple) -> None:
+        operation, future, queued = item
+        try:
+            (result,) = await self._transaction([operation])
+        except Exception as e:
+            self._resolve(future, queued, error=e)
+        else:
+            self._resolve(future, queued, result=result)
+
+    async def _transaction(self, operations: List[Operation]) -> List:
+        async with self.db_context() as db:
+            db.info[BATCH] = True
+            try:
+                results = [await operation(db) for operation in operations]
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return results
+
+    def _resolve(self, future, queued, result=None, error=None) -> None:
+        DB_WRITE_SECONDS.observe(time.monotonic() - queued)
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def close(self) -> None:
+        """Write the queued operations, then stop the writer."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
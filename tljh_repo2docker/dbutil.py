@@ -1,17 +1,14 @@
+import functools
 import os
 import shutil
 import sys
 from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
 from pathlib import Path
-from subprocess import check_call
 from tempfile import TemporaryDirectory
-from typing import AsyncGenerator, List
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
-import alembic
-import alembic.config
-from alembic.script import ScriptDirectory
 from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
@@ -67,17 +64,51 @@ def _temp_alembic_ini(db_url):
         yield alembic_ini
 
 
-def upgrade(db_url, revision="head"):
+def _alembic_config(db_url, connection=None):
+    """Return the alembic configuration of the database, without an ini file.
+
+    db_url: str
+        The SQLAlchemy database url.
+
+    connection: sqlalchemy.engine.Connection, optional
+        An open connection to the database the migrations run on, rather
+        than a new engine.
+    """
+    import alembic.config
+
+    cfg = alembic.config.Config()
+    cfg.set_main_option("script_location", str(ALEMBIC_DIR))
+    cfg.set_main_option("sqlalchemy.url", str(db_url).replace("%", "%%"))
+    if connection is not None:
+        cfg.attributes["connection"] = connection
+    return cfg
+
+
+@functools.lru_cache(maxsize=None)
+def head_revision():
+    """Return the head revision of the migrations, parsed once per process."""
+    from alembic.script import ScriptDirectory
+
+    return ScriptDirectory(str(ALEMBIC_DIR)).get_current_head()
+
+
+def upgrade(db_url, revision="head", connection=None):
     """Upgrade the given database to revision.
 
+    The migrations run in this process.
+
     db_url: str
         The SQLAlchemy database url.
 
     revision: str [default: head]
         The alembic revision to upgrade to.
+
+    connection: sqlalchemy.engine.Connection, optional
+        An open connection to the database, on which the migrations run.
     """
-    with _temp_alembic_ini(db_url) as alembic_ini:
-        check_call(["alembic", "-c", alembic_ini, "upgrade", revision])
+    import alembic.command
+
+    alembic.command.upgrade(_alembic_config(db_url, connection), revision)
 
 
 def backup_db_file(db_file, log=None):
@@ -98,33 +129,32 @@ def backup_db_file(db_file, log=None):
 
 def _alembic(db_url: str, alembic_arg: List[str]):
     """Run an alembic command with a temporary alembic.ini"""
+    import alembic.config
 
     with _temp_alembic_ini(db_url) as alembic_ini:
-        check_call(["alembic", "-c", alembic_ini] + alembic_arg)
+        alembic.config.main(["-c", str(alembic_ini)] + alembic_arg)
 
 
 def check_db_revision(engine):
     """Check the database revision"""
-    # Check database schema version
-    current_table_names = set(inspect(engine).get_table_names())
+    with engine.connect() as connection:
+        return _check_db_revision(connection)
 
-    # alembic needs the password if it's in the URL
-    engine_url = engine.url.render_as_string(hide_password=False)
+
+def _check_db_revision(connection):
+    # Check database schema version
+    current_table_names = set(inspect(connection).get_table_names())
 
     if "alembic_version" not in current_table_names:
         return True
 
-    with _temp_alembic_ini(engine_url) as ini:
-        cfg = alembic.config.Config(ini)
-        scripts = ScriptDirectory.from_config(cfg)
-        head = scripts.get_heads()[0]
+    head = head_revision()
 
     # check database schema version
     # it should always be defined at this point
-    with engine.begin() as connection:
-        alembic_revision = connection.execute(
-            text("SELECT version_num FROM alembic_version")
-        ).first()[0]
+    alembic_revision = connection.execute(
+        text("SELECT version_num FROM alembic_version")
+    ).first()[0]
     if alembic_revision == head:
         return False
     else:
@@ -141,9 +171,20 @@ def upgrade_if_needed(db_url, log=None):
     If the database is sqlite, a backup file will be created with a timestamp.
     Other database systems should perform their own backups prior to calling this.
     """
-    # run check-db-revision first
+    # run check-db-revision first, then upgrade on the same connection
     engine = create_engine(async_to_sync_url(db_url))
-    need_upgrade = check_db_revision(engine=engine)
+    try:
+        with engine.connect() as connection:
+            _upgrade_if_needed(db_url, connection, log)
+    finally:
+        engine.dispose()
+
+
+def _upgrade_if_needed(db_url, connection, log=None):
+    need_upgrade = _check_db_revision(connection)
+    # End the transaction of the check: the migrations manage their own,
+    # which some of them leave (see `autocommit_block`).
+    connection.rollback()
     if not need_upgrade:
         if log:
             log.info("Database schema is up-to-date")
@@ -161,7 +202,7 @@ def upgrade_if_needed(db_url, log=None):
     if log:
         log.info("Upgrading %s", db_log_url)
 
-    upgrade(db_url)
+    upgrade(db_url, connection=connection)
 
 
 def sync_to_async_url(db_url: str) -> str:
@@ -186,33 +227,128 @@ def async_to_sync_url(db_url: str) -> str:
     return db_url
 
 
-def async_session_context_factory(async_db_url: str):
+# Engine options and SQLite pragmas of each database tuning profile, by
+# backend, then by backend and driver for the options of a single driver.
+# The "default" profile keeps the SQLAlchemy defaults.
+DB_PROFILES = {
+    "default": {
+        "sqlite": {"pragmas": {"journal_mode": "WAL"}},
+    },
+    "performance": {
+        "sqlite": {
+            "pragmas": {
+                "journal_mode": "WAL",
+                # With WAL, only a power loss may lose the last commits, and
+                # the database stays consistent.
+                "synchronous": "NORMAL",
+                "mmap_size": 256 * 1024 * 1024,
+                # Negative sizes are in KiB.
+                "cache_size": -64 * 1024,
+                "busy_timeout": 5000,
+                "temp_store": "MEMORY",
+            },
+        },
+        "postgresql": {
+            "pool_size": 20,
+            "max_overflow": 10,
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        },
+        "postgresql+asyncpg": {
+            # The queries of the service are too short to gain from the JIT.
+            # Only asyncpg accepts server_settings.
+            "connect_args": {"server_settings": {"jit": "off"}},
+        },
+        "mysql": {
+            "pool_size": 20,
+            "max_overflow": 10,
+            "pool_pre_ping": True,
+            # Below the default wait_timeout of the server (8 hours) and of
+            # most proxies.
+            "pool_recycle": 3600,
+        },
+    },
+}
+
+
+def db_backend(db_url: str) -> str:
+    """Return the backend of a database URL: sqlite, postgresql, mysql..."""
+    return db_url.split(":", 1)[0].split("+", 1)[0]
+
+
+def db_engine_options(
+    async_db_url: str,
+    profile: str = "default",
+    engine_options: Optional[Dict[str, Any]] = None,
+    sqlite_pragmas: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Resolve the engine options and SQLite pragmas of a database.
+
+    Parameters:
+    - async_db_url (str): The URL for the asynchronous database connection.
+    - profile (str): The tuning profile, a key of `DB_PROFILES`.
+    - engine_options (dict): Options of `create_async_engine` overriding the
+      ones of the profile (e.g. `pool_size`).
+    - sqlite_pragmas (dict): Pragmas overriding the ones of the profile.
+
+    Returns:
+    - Tuple[dict, dict]: The keyword arguments of `create_async_engine`, and
+      the pragmas to set on each new SQLite connection.
+    """
+    if profile not in DB_PROFILES:
+        raise ValueError(f"Unknown database profile: {profile}")
+    backend = db_backend(async_db_url)
+    scheme = async_db_url.split(":", 1)[0]
+    options = dict(DB_PROFILES[profile].get(backend, {}))
+    if scheme != backend:
+        options.update(DB_PROFILES[profile].get(scheme, {}))
+    pragmas = options.pop("pragmas", {})
+    options.update(engine_options or {})
+    if backend == "sqlite":
+        pragmas = {**pragmas, **(sqlite_pragmas or {})}
+        for name in pragmas:
+            if not name.isidentifier():
+                raise ValueError(f"Invalid SQLite pragma: {name}")
+        # Allow up to 30 s of retrying on lock, unless busy_timeout is set.
+        options["connect_args"] = {
+            "timeout": 30,
+            "check_same_thread": False,
+            **options.get("connect_args", {}),
+        }
+    return options, pragmas
+
+
+def async_session_context_factory(
+    async_db_url: str,
+    engine_options: Optional[Dict[str, Any]] = None,
+    sqlite_pragmas: Optional[Dict[str, Any]] = None,
+):
     """
     Factory function to create an asynchronous session context manager.
 
     Parameters:
     - async_db_url (str): The URL for the asynchronous database connection.
+    - engine_options (dict): Keyword arguments of `create_async_engine`, e.g.
+      the pool settings.
+    - sqlite_pragmas (dict): Pragmas set on each new SQLite connection.
 
     Returns:
     - AsyncContextManager[AsyncSession]: An asynchronous context manager that yields
       an async session for database interactions within the context.
     """
-    connect_args = {}
-    if async_db_url.startswith("sqlite"):
-        # Allow up to 30 s of retrying on lock; enable WAL for concurrent access
-        connect_args = {"timeout": 30, "check_same_thread": False}
-
-    async_engine = create_async_engine(
-        async_db_url,
-        connect_args=connect_args,
-    )
+    if engine_options is None and sqlite_pragmas is None:
+        engine_options, sqlite_pragmas = db_engine_options(async_db_url)
+
+    async_engine = create_async_engine(async_db_url, **(engine_options or {}))
 
-    if async_db_url.startswith("sqlite"):
+    if sqlite_pragmas:
         from sqlalchemy import event as sa_event
 
         @sa_event.listens_for(async_engine.sync_engine, "connect")
-        def set_wal_mode(dbapi_conn, _):
-            dbapi_conn.execute("PRAGMA journal_mode=WAL")
+        def set_pragmas(dbapi_conn, _):
+            for name, value in sqlite_pragmas.items():
+                dbapi_conn.execute(f"PRAGMA {name}={value}")
 
     async_session_maker = async_sessionmaker(
         async_engine,
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import ssl
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiodocker import Docker, DockerError
+from tornado.log import app_log
+
+PLACEMENT_STRATEGIES = ("least-builds", "least-disk")
+
+
+class NoDockerHostError(Exception):
+    """Raised when no Docker host can take a build."""
+
+
+class DockerHost:
+    """
+    A Docker daemon images are built on and served from.
+
+    ``url`` is a ``unix://`` or ``tcp://`` endpoint; `None` uses the local
+    daemon (or ``DOCKER_HOST``). ``labels`` are matched against the
+    ``node_selector`` of an environment to decide where it may be built.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        url: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        tls_ca: Optional[str] = None,
+        tls_cert: Optional[str] = None,
+        tls_key: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.url = url
+        self.labels = labels or {}
+        self.tls_ca = tls_ca
+        self.tls_cert = tls_cert
+        self.tls_key = tls_key
+        self.active_builds = 0
+
+    def __repr__(self) -> str:
+        return f"<DockerHost {self.name or 'local'} {self.url or ''}>"
+
+    @property
+    def local(self) -> bool:
+        """Whether the daemon runs on the host of the service (unix socket)."""
+        url = self.url or os.environ.get("DOCKER_HOST")
+        return not url or url.startswith("unix://")
+
+    def docker(self) -> Docker:
+        """Return a new client for this host, to use as a context manager."""
+        ssl_context = None
+        if self.tls_cert:
+            ssl_context = ssl.create_default_context(cafile=self.tls_ca)
+            ssl_context.load_cert_chain(self.tls_cert, self.tls_key)
+        return Docker(url=self.url, ssl_context=ssl_context)
+
+    @contextmanager
+    def building(self) -> Iterator[None]:
+        """Count a build running on this host for the duration of the context."""
+        self.active_builds += 1
+        try:
+            yield
+        finally:
+            self.active_builds -= 1
+
+    def matches(self, node_selector: Optional[Dict]) -> bool:
+        """Whether this host carries every label of ``node_selector``."""
+        return all(
+            self.labels.get(key) == str(value)
+            for key, value in (node_selector or {}).items()
+        )
+
+
+class DockerHostPool:
+    """
+    The Docker hosts of a build farm and the strategy placing builds on them.
+
+    Strategies:
+        least-builds: the host running the fewest builds from this service.
+        least-disk: the host whose built images use the least disk space.
+
+    Only the hosts matching the ``node_selector`` of an environment are
+    considered; ties are broken by the order of the hosts.
+    """
+
+    def __init__(
+        self, hosts: List[DockerHost], strategy: str = "least-builds", log=None
+    ) -> None:
+        if not hosts:
+            raise ValueError("A Docker host pool needs at least one host")
+        if strategy not in PLACEMENT_STRATEGIES:
+            raise ValueError(f"Unknown placement strategy {strategy!r}")
+        names = [host.name for host in hosts]
+        if len(set(names)) != len(names) or not all(names):
+            raise ValueError("Docker hosts must have distinct, non-empty names")
+        self.hosts = hosts
+        self.strategy = strategy
+        self.log = log or app_log
+
+    @classmethod
+    def from_config(cls, hosts: List[Dict], strategy: str = "least-builds", log=None):
+        """Create a pool from the ``docker_hosts`` setting."""
+        return cls([DockerHost(**host) for host in hosts], strategy, log=log)
+
+    def __iter__(self) -> Iterator[DockerHost]:
+        return iter(self.hosts)
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    def get(self, name: str) -> Optional[DockerHost]:
+        return next((host for host in self.hosts if host.name == name), None)
+
+    async def choose(
+        self, node_selector: Optional[Dict] = None, prefer: Optional[str] = None
+    ) -> DockerHost:
+        """
+        Pick the host to run a build on.
+
+        Args:
+            node_selector: The labels the host must carry.
+            prefer: The name of the host that built the previous image of the
+            environment. It is kept when it still matches, so the rebuild
+            reuses its layers and replaces the image in place.
+
+        Returns:
+            The chosen host.
+
+        Raises:
+            NoDockerHostError: If no host matches ``node_selector``.
+        """
+        candidates = [host for host in self.hosts if host.matches(node_selector)]
+        if not candidates:
+            raise NoDockerHostError(
+                f"No Docker host matches the node selector {node_selector}"
+            )
+        preferred = next((host for host in candidates if host.name == prefer), None)
+        if preferred is not None:
+            return preferred
+        if self.strategy == "least-disk":
+            usage = await asyncio.gather(*(_images_size(host) for host in candidates))
+            ranked = [
+                (size, index, host)
+                for index, (size, host) in enumerate(zip(usage, candidates))
+                if size is not None
+            ]
+            if not ranked:
+                raise NoDockerHostError("No Docker host is reachable")
+            host = min(ranked)[2]
+        else:
+            host = min(candidates, key=lambda h: h.active_builds)
+        self.log.info("Placing build on Docker host %s", host.name)
+        return host
+
+
+async def _images_size(host: DockerHost) -> Optional[int]:
+    """Disk space used by the images built on ``host``, `None` if unreachable."""
+    try:
+        async with host.docker() as docker:
+            images = await docker.images.list(
+                filters=json.dumps({"label": ["tljh_repo2docker.image_name"]})
+            )
+    except (DockerError, OSError, asyncio.TimeoutError) as e:
+        app_log.warning("Docker host %s is unreachable: %s", host.name, e)
+        return None
+    return sum(image.get("Size", 0) for image in images)
+
+
+class HostUsage:
+    """
+    CPUs and memory committed to the servers started on each Docker host.
+
+    Servers are keyed by container name, so recording a server twice (e.g.
+    when the hub restarts and reloads its state) does not count it twice.
+    """
+
+    def __init__(self) -> None:
+        self._servers: Dict[str, Tuple[str, float, int]] = {}
+
+    def add(self, key: str, host: str, cpu: float, memory: int) -> None:
+        self._servers[key] = (host, cpu or 0.0, memory or 0)
+
+    def remove(self, key: str) -> None:
+        self._servers.pop(key, None)
+
+    def committed(self, host: str) -> Tuple[float, int]:
+        """Return the CPUs and bytes of memory committed on ``host``."""
+        cpu, memory = 0.0, 0
+        for server_host, server_cpu, server_memory in self._servers.values():
+            if server_host == host:
+                cpu += server_cpu
+                memory += server_memory
+        return cpu, memory
+
+
+async def host_resources(host: DockerHost, image: str) -> Optional[Dict]:
+    """
+    Return the capacity of ``host`` and the labels of ``image`` on it.
+
+    Returns:
+        A dict with the ``cpus``, ``memory`` (bytes) of the host and the
+        ``labels`` of the image, or `None` if the host does not hold the
+        image or is unreachable.
+    """
+    try:
+        async with host.docker() as docker:
+            try:
+                image_info = await docker.images.inspect(image)
+            except DockerError as e:
+                if e.status == 404:
+                    return None
+                raise
+            info = await docker.system.info()
+    except (DockerError, OSError, asyncio.TimeoutError) as e:
+        app_log.warning("Docker host %s is unreachable: %s", host.name, e)
+        return None
+    return {
+        "cpus": info.get("NCPU") or 1,
+        "memory": info.get("MemTotal") or 1,
+        "labels": (image_info.get("Config") or {}).get("Labels") or {},
+    }
+
+
+def rank_hosts(
+    candidates: List[Tuple[DockerHost, Dict]],
+    usage: HostUsage,
+    cpu: float,
+    memory: int,
+) -> List[DockerHost]:
+    """
+    Order the hosts holding an image from the most to the least headroom.
+
+    The headroom of a host is the smallest of its free CPU and free memory
+    fractions once a server using ``cpu`` CPUs and ``memory`` bytes is
+    added to the servers already committed on it. Ties keep the order of
+    the hosts.
+    """
+
+    def headroom(item):
+        index, (host, resources) = item
+        committed_cpu, committed_memory = usage.committed(host.name)
+        free_cpu = resources["cpus"] - committed_cpu - (cpu or 0)
+        free_memory = resources["memory"] - committed_memory - (memory or 0)
+        return (
+            -min(free_cpu / resources["cpus"], free_memory / resources["memory"]),
+            index,
+        )
+
+    return [host for _, (host, _) in sorted(enumerate(candidates), key=headroom)]
@@ -1,67 +1,48 @@
+import json
 from inspect import isawaitable
 
 from tornado import web
 
 from .base import BaseHandler, require_admin_role
-from .database.schemas import BuildStatusType
-from .docker import list_containers, list_images
+
+# Bytes of JSON buffered before they are sent, when streaming a list.
+STREAM_FLUSH_SIZE = 64 * 1024
 
 
 async def build_image_list(handler):
     """
-    Build the list of environments shown in the admin page. Used both by
-    EnvironmentsHandler.get (HTML render) and by the JSON GET on
-    api/environments consumed by the auto-refresh polling.
-    """
-    if handler.use_binderhub:
-        return await handler.get_images_from_db()
-
-    images = await list_images()
-    containers = await list_containers()
-    all_images = images + containers
+    Build the list of environments shown in the admin page, embedded in the
+    HTML render of EnvironmentsHandler.get. The JSON GET on api/environments
+    consumed by the auto-refresh polling streams it (see `write_image_list`).
 
-    db_context = handler.settings.get("db_context")
-    image_db_manager = handler.settings.get("image_db_manager")
-    if db_context and image_db_manager:
-        all_images = await _enrich_with_db(all_images, db_context, image_db_manager)
-
-    return all_images
+    The environments are listed from the database, which the reconciler keeps
+    in line with Docker for local builds.
+    """
+    return await handler.get_images_from_db()
 
 
-async def _enrich_with_db(images, db_context, image_db_manager):
+async def write_image_list(handler, flush_size: int = STREAM_FLUSH_SIZE):
     """
-    Enrich Docker images with their DB uid, and append FAILED or BUILDING
-    images that are only in the DB (no Docker image/container yet).
+    Write the list of environments as the JSON ``{"images": [...]}``, as it
+    is read from the database: the response is flushed every ``flush_size``
+    bytes, so the memory used stays flat however many environments there are.
+    A list shorter than ``flush_size`` is sent at once, with its ETag.
     """
-    async with db_context() as db:
-        all_db_entries = await image_db_manager.read_all(db)
-
-    db_by_name = {entry.name: entry for entry in all_db_entries}
-    docker_names = {img["image_name"] for img in images}
-
-    # Add uid + buildargs to images that have a matching DB entry. The
-    # buildargs are only persisted in the DB (no Docker label), so they
-    # need to be backfilled here for the rebuild dialog to pre-fill them.
-    for image in images:
-        entry = db_by_name.get(image["image_name"])
-        if entry:
-            image["uid"] = str(entry.uid)
-            if entry.image_meta.buildargs:
-                image["buildargs"] = entry.image_meta.buildargs
-
-    extra = [
-        dict(
-            image_name=entry.name,
-            uid=str(entry.uid),
-            status=entry.status,
-            **entry.image_meta.model_dump(),
-        )
-        for entry in all_db_entries
-        if entry.status in (BuildStatusType.FAILED, BuildStatusType.BUILDING)
-        and entry.name not in docker_names
-    ]
-
-    return images + extra
+    handler.set_header("content-type", "application/json")
+    handler.write('{"images": [')
+    buffered = 0
+    separator = ""
+    async for images in handler.stream_images_from_db():
+        if not images:
+            continue
+        chunk = separator + ", ".join(json.dumps(image) for image in images)
+        handler.write(chunk)
+        separator = ", "
+        buffered += len(chunk)
+        if buffered >= flush_size:
+            await handler.flush()
+            buffered = 0
+    handler.finish("]}")
 
 
 class EnvironmentsHandler(BaseHandler):
@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+from tornado.log import app_log
+
+# Path at which a mirror is bind-mounted inside the repo2docker container.
+MIRROR_MOUNT = "/tljh-git-mirror"
+
+# Bound for a single clone/fetch. A hung remote must not hold a build slot
+# forever; the build then falls back to a direct clone by repo2docker.
+GIT_TIMEOUT = 30 * 60
+
+
+class GitCacheError(Exception):
+    """Raised when a mirror cannot be created or refreshed."""
+
+
+def _credential_env(username: Optional[str], password: Optional[str]) -> Dict:
+    """Return the environment passing HTTP basic-auth to git.
+
+    The credentials are handed over through ``GIT_CONFIG_*`` variables so
+    they never appear on the git command line (visible in ``ps``) nor in the
+    mirror's ``config`` file on disk.
+    """
+    env = {"GIT_TERMINAL_PROMPT": "0"}
+    if username and password:
+        token = base64.b64encode(f"{username}:{password}".encode()).decode()
+        env.update(
+            {
+                "GIT_CONFIG_COUNT": "1",
+                "GIT_CONFIG_KEY_0": "http.extraHeader",
+                "GIT_CONFIG_VALUE_0": f"Authorization: Basic {token}",
+            }
+        )
+    return env
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class GitMirrorCache:
+    """
+    Bare git mirrors of the built repositories, kept in ``cache_dir``.
+
+    Each build refreshes the mirror of its repository with an incremental
+    fetch, then hands the mirror to repo2docker so that only new objects are
+    transferred over the network. Mirrors are evicted least-recently-used
+    first once the cache grows beyond ``max_size`` bytes (0 means unbounded).
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 0, log=None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.log = log or app_log
+        self._locks: Dict[Path, asyncio.Lock] = {}
+        self._in_use: Dict[Path, int] = {}
+
+    def mirror_path(self, repo: str) -> Path:
+        """Return the mirror location for ``repo`` (credential-free URL)."""
+        digest = hashlib.sha256(repo.encode()).hexdigest()[:24]
+        return self.cache_dir / f"{digest}.git"
+
+    @asynccontextmanager
+    async def mirror(
+        self,
+        repo: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> AsyncIterator[Path]:
+        """
+        Refresh the mirror of ``repo`` and yield its path.
+
+        The mirror is protected from eviction until the context exits, so it
+        stays available while the build container clones from it. The fetch
+        always runs, even for a cached mirror, so access to a private
+        repository is re-checked on every build.
+        """
+        path = await self.sync(repo, username, password)
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            self._in_use[path] -= 1
+            if not self._in_use[path]:
+                del self._in_use[path]
+
+    async def sync(
+        self,
+        repo: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> Path:
+        """Create or incrementally update the mirror of ``repo``."""
+        path = self.mirror_path(repo)
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        env = _credential_env(username, password)
+        secrets = [s for s in (username, password, env.get("GIT_CONFIG_VALUE_0")) if s]
+        async with lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            if path.exists():
+                await self._git(
+                    ["-C", str(path), "fetch", "--prune", "--quiet", "origin"],
+                    env,
+                    secrets,
+                )
+            else:
+                # Clone next to the final location and rename, so that an
+                # interrupted clone never leaves a half-populated mirror.
+                tmp = Path(tempfile.mkdtemp(dir=self.cache_dir, suffix=".tmp"))
+                try:
+                    await self._git(
+                        ["clone", "--mirror", "--quiet", repo, str(tmp)],
+                        env,
+                        secrets,
+                    )
+                    tmp.rename(path)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+            os.utime(path)
+        await self.evict(keep=path)
+        return path
+
+    async def evict(self, keep: Optional[Path] = None) -> List[Path]:
+        """Remove least-recently-used mirrors until the cache fits its budget.
+
+        Mirrors in use by a running build and ``keep`` are never removed.
+        """
+        if not self.max_size:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._evict, keep)
+
+    def _evict(self, keep: Optional[Path]) -> List[Path]:
+        mirrors = []
+        for path in self.cache_dir.glob("*.git"):
+            try:
+                mirrors.append((path.stat().st_mtime, path, _dir_size(path)))
+            except OSError:
+                continue
+        total = sum(size for _, _, size in mirrors)
+        removed = []
+        for _, path, size in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            if (
+                path == keep
+                or path in self._in_use
+                or (path in self._locks and self._locks[path].locked())
+            ):
+                continue
+            self.log.info("Evicting git mirror %s (%d bytes)", path, size)
+            shutil.rmtree(path, ignore_errors=True)
+            self._locks.pop(path, None)
+            total -= size
+            removed.append(path)
+        return removed
+
+    async def _git(self, args: List[str], env: Dict, secrets: List[str]) -> None:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "git",
+                *args,
+                env={**os.environ, **env},
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            # git is missing or cannot be run: the build clones directly.
+            raise GitCacheError(f"cannot run git: {e}") from e
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), GIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise GitCacheError(f"git timed out after {GIT_TIMEOUT}s")
+        if proc.returncode != 0:
+            message = stderr.decode("utf-8", errors="replace").strip()
+            for secret in secrets:
+                message = message.replace(secret, "[redacted]")
+            raise GitCacheError(message or f"git exited with {proc.returncode}")
@@ -0,0 +1,121 @@
+from typing import Dict, Optional
+
+import httpx
+from tornado.log import app_log
+
+from .metrics import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_WAITING_REQUESTS,
+)
+
+DEFAULT_CLIENT_OPTIONS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 5.0,
+    "http2": False,
+    "timeout": 30.0,
+    "connect_timeout": 10.0,
+    "route_timeouts": {},
+}
+
+
+class ServiceClient(httpx.AsyncClient):
+    """
+    HTTP client for a service the tljh_repo2docker service talks to.
+
+    ``route_timeouts`` maps a kind of request (e.g. ``spawn``) to its timeout
+    in seconds; the other requests use the timeout of the client.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        route_timeouts: Optional[Dict[str, float]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.name = name
+        self.route_timeouts = route_timeouts or {}
+
+    def route_timeout(self, route: str) -> httpx.Timeout:
+        """Return the timeout of the requests of kind ``route``."""
+        if route not in self.route_timeouts:
+            return self.timeout
+        return httpx.Timeout(self.route_timeouts[route], connect=self.timeout.connect)
+
+    def pool_stats(self) -> Dict[str, int]:
+        """
+        Count the active and idle connections and the waiting requests.
+
+        The pool is only reachable through private attributes of httpx and
+        httpcore, which may change between releases: without them, no
+        connection and no waiting request are reported.
+        """
+        try:
+            pool = self._transport._pool
+            connections = list(pool.connections)
+            idle = sum(1 for connection in connections if connection.is_idle())
+            waiting = sum(1 for request in pool._requests if request.is_queued())
+        except AttributeError:
+            return {"active": 0, "idle": 0, "waiting": 0}
+        return {"active": len(connections) - idle, "idle": idle, "waiting": waiting}
+
+
+def make_client(
+    name: str,
+    options: Optional[Dict] = None,
+    route_timeouts: Optional[Dict[str, float]] = None,
+    log=None,
+    **kwargs,
+) -> ServiceClient:
+    """
+    Create the HTTP client of a service and export its pool metrics.
+
+    Args:
+        name: The name of the client in the metrics.
+        options: Overrides of `DEFAULT_CLIENT_OPTIONS`.
+        route_timeouts: The default timeouts per route, updated with the
+        ``route_timeouts`` of ``options``.
+        **kwargs: Extra arguments of the client (``base_url``, ``headers``...).
+
+    Raises:
+        ValueError: If ``options`` has an unknown key.
+    """
+    log = log or app_log
+    options = options or {}
+    unknown = set(options) - set(DEFAULT_CLIENT_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown HTTP client options for {name}: {sorted(unknown)}")
+    options = {**DEFAULT_CLIENT_OPTIONS, **options}
+
+    http2 = options["http2"]
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log.warning("HTTP/2 requires the h2 package, %s uses HTTP/1.1", name)
+            http2 = False
+
+    client = ServiceClient(
+        name,
+        route_timeouts={**(route_timeouts or {}), **options["route_timeouts"]},
+        limits=httpx.Limits(
+            max_connections=options["max_connections"],
+            max_keepalive_connections=options["max_keepalive_connections"],
+            keepalive_expiry=options["keepalive_expiry"],
+        ),
+        timeout=httpx.Timeout(options["timeout"], connect=options["connect_timeout"]),
+        http2=http2,
+        **kwargs,
+    )
+
+    HTTP_POOL_MAX_CONNECTIONS.labels(client=name).set(options["max_connections"])
+    for state in ("active", "idle"):
+        HTTP_POOL_CONNECTIONS.labels(client=name, state=state).set_function(
+            lambda state=state: client.pool_stats()[state]
+        )
+    HTTP_POOL_WAITING_REQUESTS.labels(client=name).set_function(
+        lambda: client.pool_stats()["waiting"]
+    )
+    return client
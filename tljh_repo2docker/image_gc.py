@@ -0,0 +1,266 @@
+import json
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from aiodocker import DockerError
+from tornado import web
+from tornado.log import app_log
+
+from .base import BaseHandler, require_admin_role
+from .database.schemas import BuildStatusType
+from .docker import list_images, on_each_host
+from .docker_hosts import DockerHost
+from .metrics import (
+    IMAGE_DISK_USAGE_BYTES,
+    IMAGE_GC_RECLAIMED_BYTES,
+    IMAGE_GC_REMOVED_IMAGES,
+)
+
+
+def utcnow_iso() -> str:
+    """The current time, as recorded in ``image_meta.last_used``."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def _disk_usage(docker) -> Dict:
+    # aiodocker has no wrapper for the data usage endpoint.
+    return await docker._query_json("system/df")
+
+
+def _tags(image: Dict) -> List[str]:
+    return [t for t in image.get("RepoTags") or [] if t != "<none>:<none>"]
+
+
+def _unique_size(image: Dict) -> int:
+    """Bytes freed by removing ``image``: the layers it shares are kept."""
+    return image.get("Size", 0) - max(image.get("SharedSize", 0), 0)
+
+
+class ImageCollector:
+    """
+    Reclaim the disk space used by environment images.
+
+    Each round removes the dangling images left by rebuilds. Then, on each
+    Docker host whose image layers use more than ``disk_budget`` bytes, it
+    removes the least recently used environments until the host fits its
+    budget again. Environments that are pinned, building, or in use by a
+    container are never removed.
+
+    An environment is used when a server is started from it, either through
+    the service (recorded right away) or by the spawner (seen as a running
+    container at the next round). Environments never used fall back to the
+    creation date of their image.
+    """
+
+    def __init__(
+        self,
+        hosts: Optional[List[DockerHost]] = None,
+        db_context=None,
+        image_db_manager=None,
+        disk_budget: int = 0,
+        pinned: Optional[List[str]] = None,
+        log=None,
+    ) -> None:
+        self.hosts = hosts
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.disk_budget = disk_budget
+        self.pinned = set(pinned or [])
+        self.log = log or app_log
+
+    async def running(self) -> Set[str]:
+        """Return the images of the running containers."""
+        results = await on_each_host(self.hosts, lambda d: d.containers.list())
+        return {c.get("Image") for _, containers in results for c in containers}
+
+    async def record_running(self) -> Set[str]:
+        """Mark the environments of the running containers as used now."""
+        names = await self.running()
+        if self.db_context and self.image_db_manager:
+            async with self.db_context() as db:
+                await self.image_db_manager.record_usage(db, list(names), utcnow_iso())
+        return names
+
+    async def plan(self, in_use: Optional[Set[str]] = None) -> Dict:
+        """
+        Return what a round would remove, without changing anything.
+
+        Args:
+            in_use: The images of the running containers, listed if `None`.
+
+        Returns:
+            A report with, for each Docker host, its ``usage`` and the
+            ``dangling`` and ``evict`` images to remove with their estimated
+            size, plus the total ``reclaimable`` bytes.
+        """
+        if in_use is None:
+            in_use = await self.running()
+        entries = {}
+        if self.db_context and self.image_db_manager:
+            async with self.db_context() as db:
+                entries = {
+                    e.name: e
+                    for e in await self.image_db_manager.read_all(db, primary=True)
+                }
+        results = await on_each_host(self.hosts, _disk_usage)
+        hosts = [
+            self._plan_host(host, usage, entries, in_use) for host, usage in results
+        ]
+        return {
+            "hosts": hosts,
+            "reclaimable": sum(host["reclaimable"] for host in hosts),
+        }
+
+    def _plan_host(self, host: DockerHost, df: Dict, entries: Dict, in_use: Set[str]):
+        images = [
+            image
+            for image in df.get("Images") or []
+            if "tljh_repo2docker.image_name" in (image.get("Labels") or {})
+        ]
+        usage = df.get("LayersSize") or 0
+        IMAGE_DISK_USAGE_BYTES.labels(docker_host=host.name).set(usage)
+
+        dangling = [image for image in images if not _tags(image)]
+        remaining = usage - sum(_unique_size(image) for image in dangling)
+
+        candidates = []
+        for image in images:
+            if not _tags(image):
+                continue
+            labels = image["Labels"]
+            name = labels["tljh_repo2docker.image_name"]
+            entry = entries.get(name)
+            if (
+                name in in_use
+                or image.get("Containers", 0) > 0
+                or name in self.pinned
+                or labels.get("tljh_repo2docker.display_name") in self.pinned
+                or (entry and entry.status == BuildStatusType.BUILDING)
+            ):
+                continue
+            last_used = image.get("Created", 0)
+            if entry and entry.image_meta.last_used:
+                last_used = datetime.fromisoformat(
+                    entry.image_meta.last_used
+                ).timestamp()
+            candidates.append((last_used, name, image))
+
+        evict = []
+        for last_used, name, image in sorted(candidates, key=lambda c: c[0]):
+            if not self.disk_budget or remaining <= self.disk_budget:
+                break
+            size = _unique_size(image)
+            evict.append(
+                {
+                    "image_name": name,
+                    "size": size,
+                    "last_used": datetime.fromtimestamp(
+                        last_used, timezone.utc
+                    ).isoformat(),
+                }
+            )
+            remaining -= size
+
+        return {
+            "docker_host": host.name,
+            "usage": usage,
+            "budget": self.disk_budget,
+            "dangling": [
+                {
+                    "id": image["Id"],
+                    "image_name": image["Labels"]["tljh_repo2docker.image_name"],
+                    "size": _unique_size(image),
+                }
+                for image in dangling
+            ],
+            "evict": evict,
+            "reclaimable": usage - remaining,
+        }
+
+    async def collect(self, dry_run: bool = False) -> Dict:
+        """
+        Run a round of the collector.
+
+        Args:
+            dry_run: Only report what would be removed.
+
+        Returns:
+            The report of `plan`.
+        """
+        if dry_run:
+            return await self.plan()
+        # Only a real round records the usage the next rounds are based on.
+        report = await self.plan(await self.record_running())
+
+        hosts = {host.name: host for host in self.hosts or [DockerHost()]}
+        evicted = set()
+        for host_report in report["hosts"]:
+            host = hosts[host_report["docker_host"]]
+            async with host.docker() as docker:
+                for image in host_report["dangling"]:
+                    await self._remove(docker, host, image["id"], image, "dangling")
+                for image in host_report["evict"]:
+                    name = image["image_name"]
+                    if await self._remove(docker, host, name, image, "evicted"):
+                        evicted.add(name)
+
+        if evicted and self.db_context and self.image_db_manager:
+            # Forget the environments that are now gone from every host.
+            remaining = {image["image_name"] for image in await list_images(self.hosts)}
+            async with self.db_context() as db:
+                for name in evicted - remaining:
+                    entry = await self.image_db_manager.read_by_image_name(
+                        db, name, primary=True
+                    )
+                    if entry is not None:
+                        await self.image_db_manager.delete(db, entry.uid)
+        return report
+
+    async def _remove(self, docker, host, ref, image, reason) -> bool:
+        try:
+            await docker.images.delete(ref)
+        except DockerError as e:
+            self.log.info("Keeping image %s on %s: %s", ref, host, e.message)
+            return False
+        self.log.info(
+            "Removed %s image %s from %s (%d bytes)", reason, ref, host, image["size"]
+        )
+        IMAGE_GC_RECLAIMED_BYTES.labels(docker_host=host.name, reason=reason).inc(
+            image["size"]
+        )
+        IMAGE_GC_REMOVED_IMAGES.labels(docker_host=host.name, reason=reason).inc()
+        return True
+
+    async def run(self) -> None:
+        """Run a round, logging instead of raising, for a periodic callback."""
+        try:
+            await self.collect()
+        except Exception:
+            self.log.exception("Failed to collect the environment images")
+
+
+class ImageCollectorHandler(BaseHandler):
+    """
+    Report on (GET, dry run) or run (POST) the image collector
+    """
+
+    @property
+    def collector(self) -> ImageCollector:
+        collector = self.settings.get("image_collector")
+        if collector is None:
+            raise web.HTTPError(404, "The image collector is not available")
+        return collector
+
+    @web.authenticated
+    @require_admin_role
+    async def get(self):
+        report = await self.collector.collect(dry_run=True)
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps(report))
+
+    @web.authenticated
+    @require_admin_role
+    async def post(self):
+        report = await self.collector.collect()
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps(report))
@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from aiodocker import DockerError
+from tornado.log import app_log
+
+from .database.schemas import BuildStatusType
+from .docker import list_images, on_each_host
+from .docker_hosts import DockerHost
+from .image_gc import utcnow_iso
+
+# Starts the single-user server code far enough to import it, then exits.
+WARM_COMMAND = ["jupyterhub-singleuser", "--help"]
+WARM_TIMEOUT = 120
+
+
+class ImageWarmer:
+    """
+    Keep the most used environment images warm in the page cache of their
+    Docker hosts.
+
+    The first start of a large image is slow because its files are read
+    from disk, most of it while importing the single-user server. At each
+    round, the warmer marks the environments of the running containers as
+    used, ranks the built environments by the last use recorded in the
+    database, and runs a short-lived container importing the server from
+    the ``size`` most recently used images. It only runs on the hosts that
+    hold an image but have no container running from it: the files of an
+    image in use are already cached. An image is never pulled onto a host,
+    and there is no pool of containers to adopt: a server is still created
+    when it starts. Each selected image is warmed once per cold host, so
+    there is no per-image sizing either.
+    """
+
+    def __init__(
+        self,
+        hosts: Optional[List[DockerHost]] = None,
+        db_context=None,
+        image_db_manager=None,
+        size: int = 3,
+        log=None,
+    ) -> None:
+        self.hosts = hosts
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.size = size
+        self.log = log or app_log
+
+    async def running(self) -> Dict[str, Set[str]]:
+        """Return the names of the hosts running a container of each image."""
+        results = await on_each_host(self.hosts, lambda d: d.containers.list())
+        running = {}
+        for host, containers in results:
+            for container in containers:
+                if "tljh_repo2docker.warmer" in (container.get("Labels") or {}):
+                    continue
+                running.setdefault(container.get("Image"), set()).add(host.name)
+        return running
+
+    async def most_used(self, in_use: Set[str]) -> List[str]:
+        """
+        Mark the environments of ``in_use`` as used now, then return the
+        names of the built environments to keep warm, most recently used
+        first. The environments never used are left out.
+        """
+        async with self.db_context() as db:
+            if in_use:
+                await self.image_db_manager.record_usage(db, list(in_use), utcnow_iso())
+            entries = await self.image_db_manager.read_by_status(
+                db, BuildStatusType.BUILT
+            )
+        used = [
+            (datetime.fromisoformat(entry.image_meta.last_used), entry.name)
+            for entry in entries
+            if entry.image_meta.last_used
+        ]
+        return [name for _, name in sorted(used, reverse=True)[: self.size]]
+
+    async def warm(self) -> None:
+        """Run one round: warm the most used images where they are cold."""
+        running = await self.running()
+        hosts_by_image = {
+            image["image_name"]: image.get("docker_hosts")
+            for image in await list_images(self.hosts)
+        }
+        hosts = {host.name: host for host in self.hosts or [DockerHost()]}
+        for name in await self.most_used(set(running)):
+            if name not in hosts_by_image:
+                continue
+            # The local daemon, unnamed, is not listed in `docker_hosts`.
+            holders = hosts_by_image[name] or [""]
+            cold = [h for h in holders if h in hosts and h not in running.get(name, ())]
+            await asyncio.gather(*(self.warm_image(hosts[h], name) for h in cold))
+
+    async def warm_image(self, host: DockerHost, image: str) -> None:
+        """Read the server code of ``image`` on ``host`` into the page cache."""
+        config = {
+            "Image": image,
+            "Cmd": WARM_COMMAND,
+            "Labels": {"tljh_repo2docker.warmer": image},
+            "HostConfig": {
+                "NetworkMode": "none",
+                # Stay out of the way of the running servers.
+                "CpuShares": 128,
+            },
+        }
+        try:
+            async with host.docker() as docker:
+                container = await docker.containers.run(config=config)
+                try:
+                    await asyncio.wait_for(container.wait(), WARM_TIMEOUT)
+                finally:
+                    await container.delete(force=True)
+        except (DockerError, OSError, asyncio.TimeoutError) as e:
+            self.log.warning("Failed to warm %s on %s: %s", image, host, e)
+
+    async def run(self) -> None:
+        """Run a round, logging instead of raising, for a periodic callback."""
+        try:
+            await self.warm()
+        except Exception:
+            self.log.exception("Failed to warm the environment images")
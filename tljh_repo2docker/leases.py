@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Set
+from uuid import UUID
+
+from tornado.log import app_log
+
+from .build_jobs import BuildJobs
+
+# Seconds a build stays owned by a replica of the service which stopped
+# renewing its lease. The leases are renewed three times per period.
+DEFAULT_LEASE_TTL = 60
+
+
+def utcnow() -> datetime:
+    """The current time, as stored in the lease columns (naive UTC)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def lease_expired(entry, now: Optional[datetime] = None) -> bool:
+    """Whether no replica holds the lease of the build of ``entry``."""
+    return entry.lease_expires is None or entry.lease_expires < (now or utcnow())
+
+
+class BuildLeases:
+    """
+    Leases of the builds driven by this replica of the service.
+
+    Each build in progress is owned by the replica holding its lease: the
+    replica which started it, or which took it over. The owner renews the
+    leases of its builds while they run. When a replica dies, its leases
+    expire, and the other replicas take its builds over (see
+    `TljhRepo2Docker._cleanup_stale_builds`).
+
+    A replica which could not renew a lease in time may find that another
+    one took the build over: it then abandons its own run of the build,
+    without touching the build container nor the entry.
+    """
+
+    def __init__(
+        self,
+        owner: str,
+        db_context,
+        image_db_manager,
+        build_jobs: BuildJobs,
+        ttl: int = DEFAULT_LEASE_TTL,
+        log=None,
+    ) -> None:
+        self.owner = owner
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.build_jobs = build_jobs
+        self.ttl = ttl
+        self.log = log or app_log
+        self._lost: Set[UUID] = set()
+
+    def expires(self) -> datetime:
+        """The expiry of a lease taken or renewed now."""
+        return utcnow() + timedelta(seconds=self.ttl)
+
+    def values(self) -> dict:
+        """The lease columns of a build started by this replica."""
+        return {"lease_owner": self.owner, "lease_expires": self.expires()}
+
+    def lost(self, uid: UUID) -> bool:
+        """Whether another replica took over the build of ``uid``."""
+        return uid in self._lost
+
+    def claimable(self, entry, now: Optional[datetime] = None) -> bool:
+        """Whether the build of ``entry`` may be taken over by this replica."""
+        return entry.lease_owner == self.owner or lease_expired(entry, now)
+
+    async def claim(self, uids: List[UUID]) -> List[UUID]:
+        """
+        Take the leases of the builds of ``uids``, if they are free.
+
+        Returns:
+            The uids of the builds this replica now owns.
+        """
+        claimed = []
+        now, expires = utcnow(), self.expires()
+        async with self.db_context() as db:
+            for uid in uids:
+                if await self.image_db_manager.claim(db, uid, self.owner, now, expires):
+                    claimed.append(uid)
+        return claimed
+
+    async def renew(self) -> None:
+        """
+        Renew the leases of the builds running in this process, and abandon
+        the builds taken over by another replica.
+        """
+        uids = list(self.build_jobs)
+        self._lost &= set(uids)
+        if not uids:
+            return
+        async with self.db_context() as db:
+            taken_over = await self.image_db_manager.renew_leases(
+                db, uids, self.owner, self.expires()
+            )
+        for uid in set(taken_over) - self._lost:
+            self.log.warning("Build %s was taken over by another replica", uid)
+            self._lost.add(uid)
+            await self.build_jobs.cancel(uid)
+
+    async def run(self) -> None:
+        try:
+            await self.renew()
+        except Exception:
+            self.log.exception("Failed to renew the leases of the builds")
@@ -1,9 +1,13 @@
 import asyncio
 import json
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional, Set
 from uuid import UUID
 
 from tornado import web
 from tornado.iostream import StreamClosedError
+from tornado.log import app_log
 
 from .base import BaseHandler, require_admin_role
 from .database.schemas import BuildStatusType
@@ -11,20 +15,355 @@ from .database.schemas import BuildStatusType
 TIME_OUT = 3600
 POLL_INTERVAL = 3
 
+# Seconds between the reads of a build log when the changes of every replica
+# are notified: the reads then only catch a lost notification.
+NOTIFIED_POLL_INTERVAL = 30
 
-class LogsHandler(BaseHandler):
+# Seconds between the comments sent on a quiet log stream, so that proxies do
+# not close it.
+HEARTBEAT_INTERVAL = 15
+
+# Events queued for a client of a log stream. A client that falls this far
+# behind is disconnected instead of buffering the log in memory.
+SUBSCRIBER_QUEUE_SIZE = 256
+
+TERMINAL_PHASES = {
+    BuildStatusType.BUILT: "built",
+    BuildStatusType.FAILED: "error",
+    BuildStatusType.CANCELLED: "error",
+}
+
+
+class TooManyStreamsError(Exception):
+    """Raised when a user follows more build logs than allowed."""
+
+
+class Subscription:
+    """
+    A client of a build log stream, with its queue of events.
+
+    ``offset`` is the length of the log the client already has. A `None`
+    event ends the stream.
+    """
+
+    def __init__(
+        self, user: str, offset: int = 0, on_drop: Optional[Callable] = None
+    ) -> None:
+        self.user = user
+        self.offset = offset
+        self.on_drop = on_drop
+        self.queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def send_log(self, log: str) -> bool:
+        """Queue the part of ``log`` the client does not have yet."""
+        if len(log) <= self.offset:
+            return True
+        sent = self.send({"phase": "log", "message": log[self.offset :]})
+        self.offset = len(log)
+        return sent
+
+    def send(self, event: Optional[Dict]) -> bool:
+        """Queue ``event``, or return `False` if the client is too slow."""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def close(self) -> None:
+        """End the stream, dropping the queued events if it is full."""
+        if not self.send(None):
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class BuildLogWatcher:
+    """
+    Follow the log of a build in the database and fan it out to the clients
+    streaming it. Each poll only reads the part of the log added since the
+    previous one. The watcher stops when the build is over, or when its last
+    client leaves.
+
+    With a ``notifier``, the log is read as soon as a change of the build is
+    notified, and only polled every `NOTIFIED_POLL_INTERVAL` if the notifier
+    reaches the other replicas of the service.
+    """
+
+    def __init__(
+        self,
+        uid: UUID,
+        db_context,
+        image_db_manager,
+        log: str = "",
+        logger=None,
+        notifier=None,
+    ) -> None:
+        self.uid = uid
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.log = log
+        self.logger = logger or app_log
+        self.notifier = notifier
+        self.subscribers: Set[Subscription] = set()
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        # The length of the log as last notified, which the read replica may
+        # not have yet.
+        self._notified_offset = 0
+
+    def add(self, subscription: Subscription) -> None:
+        self.subscribers.add(subscription)
+        self._send_log(subscription)
+
+    def _send_log(self, subscription: Subscription) -> None:
+        if not subscription.send_log(self.log):
+            self.drop(subscription)
+
+    def publish(self, event: Dict) -> None:
+        for subscription in list(self.subscribers):
+            if not subscription.send(event):
+                self.drop(subscription)
+
+    def drop(self, subscription: Subscription) -> None:
+        """Disconnect a client that does not keep up with the log."""
+        self.logger.warning(
+            "Dropping a slow client of the build log of %s (%s)",
+            self.uid,
+            subscription.user,
+        )
+        self.subscribers.discard(subscription)
+        subscription.close()
+        if subscription.on_drop is not None:
+            subscription.on_drop()
+
+    def on_change(self, event: Dict) -> None:
+        """Wake the watcher up, unless the change is a part of the log it has."""
+        offset = event.get("offset")
+        if offset is not None:
+            self._notified_offset = max(self._notified_offset, offset)
+            if offset <= len(self.log) and event.get("status") is None:
+                return
+        self._changed.set()
+
+    def _poll_interval(self) -> float:
+        if self.notifier is None or self.notifier.polls:
+            return POLL_INTERVAL
+        if self._notified_offset > len(self.log):
+            # Notified of a part of the log the read replica does not have yet.
+            return POLL_INTERVAL
+        return NOTIFIED_POLL_INTERVAL
+
+    async def _wait(self) -> float:
+        """Wait for a change, or for the next poll. Return the time waited."""
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._changed.wait(), self._poll_interval())
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+        return time.monotonic() - start
+
+    async def run(self) -> None:
+        elapsed = 0
+        if self.notifier is not None:
+            self.notifier.add_listener(self.uid, self.on_change)
+        try:
+            while self.subscribers:
+                if elapsed >= TIME_OUT:
+                    self.publish({"phase": "error", "message": "Build timed out"})
+                    return
+                elapsed += await self._wait()
+                # Only the new part of the log is read.
+                async with self.db_context() as db:
+                    delta = await self.image_db_manager.read_log_since(
+                        db, self.uid, len(self.log)
+                    )
+                if delta is None:
+                    self.publish({"phase": "error", "message": "Image not found"})
+                    return
+                self.log += delta.log
+                for subscription in list(self.subscribers):
+                    self._send_log(subscription)
+                if delta.status in TERMINAL_PHASES:
+                    # The clients have the whole log by now.
+                    self.publish(
+                        {"phase": TERMINAL_PHASES[delta.status], "message": ""}
+                    )
+                    return
+        except Exception:
+            self.logger.exception("Failed to follow the build log of %s", self.uid)
+        finally:
+            if self.notifier is not None:
+                self.notifier.remove_listener(self.uid, self.on_change)
+            for subscription in self.subscribers:
+                subscription.close()
+            self.subscribers.clear()
+
+
+class BuildLogWatchers:
+    """
+    The watchers of the builds followed by clients of this process: a single
+    watcher reads the log of a build, however many clients stream it.
+
+    ``max_streams_per_user`` caps the log streams a user may hold at the same
+    time (0 for no limit).
+    """
+
+    def __init__(
+        self,
+        db_context=None,
+        image_db_manager=None,
+        max_streams_per_user: int = 0,
+        log=None,
+        notifier=None,
+    ) -> None:
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.notifier = notifier
+        self.max_streams_per_user = max_streams_per_user
+        self.log = log or app_log
+        self._watchers: Dict[UUID, BuildLogWatcher] = {}
+        self._streams: Counter = Counter()
+
+    def __contains__(self, uid: UUID) -> bool:
+        return uid in self._watchers
+
+    def subscribe(
+        self, image, user: str, on_drop: Optional[Callable] = None
+    ) -> Subscription:
+        """
+        Subscribe to the log of a build in progress.
+
+        Args:
+            image: The entry of the image, whose log the client already has.
+            user: The name of the user following the log.
+            on_drop: Called if the client is disconnected for being too slow.
+
+        Returns:
+            The subscription, to `unsubscribe` when the stream ends.
+
+        Raises:
+            TooManyStreamsError: If the user holds too many log streams.
+        """
+        if (
+            self.max_streams_per_user
+            and self._streams[user] >= self.max_streams_per_user
+        ):
+            raise TooManyStreamsError(
+                f"{user} already follows {self._streams[user]} build logs"
+            )
+        log = image.log or ""
+        watcher = self._watchers.get(image.uid)
+        if watcher is None or watcher.task.done():
+            watcher = BuildLogWatcher(
+                image.uid,
+                self.db_context,
+                self.image_db_manager,
+                log,
+                self.log,
+                notifier=self.notifier,
+            )
+            self._watchers[image.uid] = watcher
+            watcher.task = asyncio.ensure_future(watcher.run())
+            watcher.task.add_done_callback(lambda _: self._done(watcher))
+        subscription = Subscription(user, offset=len(log), on_drop=on_drop)
+        watcher.add(subscription)
+        self._streams[user] += 1
+        return subscription
+
+    def unsubscribe(self, image_uid: UUID, subscription: Subscription) -> None:
+        self._streams[subscription.user] -= 1
+        if self._streams[subscription.user] <= 0:
+            del self._streams[subscription.user]
+        watcher = self._watchers.get(image_uid)
+        if watcher is not None:
+            watcher.subscribers.discard(subscription)
+
+    def _done(self, watcher: BuildLogWatcher) -> None:
+        if self._watchers.get(watcher.uid) is watcher:
+            del self._watchers[watcher.uid]
+
+
+class BuildLogStreamHandler(BaseHandler):
+    """
+    Base handler streaming the log of a build as server-sent events.
+    """
+
+    _subscription = None
+
+    async def stream_log(self, image) -> None:
+        """
+        Send the log of ``image``, then follow it until the build is over if
+        it is in progress.
+        """
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+
+        log = image.log or ""
+        if image.status in TERMINAL_PHASES:
+            await self._emit({"phase": TERMINAL_PHASES[image.status], "message": log})
+            return
+
+        watchers: BuildLogWatchers = self.settings["log_watchers"]
+        try:
+            subscription = watchers.subscribe(
+                image,
+                self.current_user.get("name", "unknown"),
+                on_drop=self.request.connection.close,
+            )
+        except TooManyStreamsError as e:
+            raise web.HTTPError(429, str(e))
+        self._subscription = subscription
+        try:
+            await self._emit({"phase": "log", "message": log})
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(), HEARTBEAT_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    await self._emit_heartbeat()
+                    continue
+                if event is None:
+                    return
+                await self._emit(event)
+                if event["phase"] != "log":
+                    return
+        finally:
+            watchers.unsubscribe(image.uid, subscription)
+
+    def on_connection_close(self):
+        # Wake up the stream to let it go.
+        if self._subscription is not None:
+            self._subscription.close()
+
+    async def _emit(self, msg):
+        try:
+            self.write(f"data: {json.dumps(msg)}\n\n")
+            await self.flush()
+        except StreamClosedError:
+            self.log.warning("Stream closed while handling %s", self.request.uri)
+            raise web.Finish()
+
+    async def _emit_heartbeat(self):
+        try:
+            self.write(": heartbeat\n\n")
+            await self.flush()
+        except StreamClosedError:
+            raise web.Finish()
+
+
+class LogsHandler(BuildLogStreamHandler):
     """
     Expose a handler to follow the build logs.
-    Reads from the database (polling for BUILDING, immediate for BUILT/FAILED).
+    Reads from the database (following the shared log watcher for BUILDING,
+    immediate for BUILT/FAILED).
     Accepts both a UUID or an image name as the identifier.
     """
 
     @web.authenticated
     @require_admin_role
     async def get(self, name):
-        self.set_header("Content-Type", "text/event-stream")
-        self.set_header("Cache-Control", "no-cache")
-
         db_context = self.settings.get("db_context")
         image_db_manager = self.settings.get("image_db_manager")
 
@@ -35,41 +374,7 @@ class LogsHandler(BaseHandler):
         if not image:
             raise web.HTTPError(404, f"No logs for image: {name}")
 
-        status = image.status
-
-        if status == BuildStatusType.FAILED:
-            await self._emit({"phase": "error", "message": image.log or ""})
-            return
-
-        if status == BuildStatusType.BUILT:
-            await self._emit({"phase": "built", "message": image.log or ""})
-            return
-
-        # BUILDING: send what we have, then poll for new lines
-        current_log_length = len(image.log or "")
-        await self._emit({"phase": "log", "message": image.log or ""})
-
-        elapsed = 0
-        while elapsed < TIME_OUT:
-            elapsed += POLL_INTERVAL
-            await asyncio.sleep(POLL_INTERVAL)
-            image = await self._lookup(name, db_context, image_db_manager)
-            if not image:
-                await self._emit({"phase": "error", "message": "Image not found"})
-                return
-            log = image.log or ""
-            if len(log) > current_log_length:
-                await self._emit({"phase": "log", "message": log[current_log_length:]})
-                current_log_length = len(log)
-            status = image.status
-            if status == BuildStatusType.FAILED:
-                await self._emit({"phase": "error", "message": log})
-                return
-            if status == BuildStatusType.BUILT:
-                await self._emit({"phase": "built", "message": log})
-                return
-
-        await self._emit({"phase": "error", "message": "Build timed out"})
+        await self.stream_log(image)
 
     async def _lookup(self, name, db_context, image_db_manager):
         """Look up an image by UUID or image name."""
@@ -78,11 +383,3 @@ class LogsHandler(BaseHandler):
                 return await image_db_manager.read(db, UUID(name))
             except ValueError:
                 return await image_db_manager.read_by_image_name(db, name)
-
-    async def _emit(self, msg):
-        try:
-            self.write(f"data: {json.dumps(msg)}\n\n")
-            await self.flush()
-        except StreamClosedError:
-            self.log.warning("Stream closed while handling %s", self.request.uri)
-            raise web.Finish()
@@ -0,0 +1,71 @@
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram
+from prometheus_client import generate_latest
+from tornado import web
+
+from .base import BaseHandler, require_admin_role
+
+IMAGE_GC_RECLAIMED_BYTES = Counter(
+    "tljh_repo2docker_image_gc_reclaimed_bytes",
+    "Disk space reclaimed by the image collector, estimated from the image sizes",
+    ["docker_host", "reason"],
+)
+
+IMAGE_GC_REMOVED_IMAGES = Counter(
+    "tljh_repo2docker_image_gc_removed_images",
+    "Images removed by the image collector",
+    ["docker_host", "reason"],
+)
+
+IMAGE_DISK_USAGE_BYTES = Gauge(
+    "tljh_repo2docker_image_disk_usage_bytes",
+    "Disk space used by the image layers of a Docker host",
+    ["docker_host"],
+)
+
+RECONCILER_DRIFT = Counter(
+    "tljh_repo2docker_reconciler_drift",
+    "Differences between the database and Docker fixed by the reconciler",
+    ["kind"],
+)
+
+HTTP_POOL_CONNECTIONS = Gauge(
+    "tljh_repo2docker_http_pool_connections",
+    "Connections of the pool of an HTTP client, by state (active or idle)",
+    ["client", "state"],
+)
+
+HTTP_POOL_MAX_CONNECTIONS = Gauge(
+    "tljh_repo2docker_http_pool_max_connections",
+    "Maximum number of connections of the pool of an HTTP client",
+    ["client"],
+)
+
+HTTP_POOL_WAITING_REQUESTS = Gauge(
+    "tljh_repo2docker_http_pool_waiting_requests",
+    "Requests of an HTTP client waiting for a connection of its pool",
+    ["client"],
+)
+
+
+DB_WRITE_SECONDS = Histogram(
+    "tljh_repo2docker_db_write_seconds",
+    "Time from queueing a database write to its commit, with serialize_db_writes",
+)
+
+DB_WRITE_BATCH_SIZE = Histogram(
+    "tljh_repo2docker_db_write_batch_size",
+    "Writes committed in a single transaction, with serialize_db_writes",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Expose the service metrics in the Prometheus format
+    """
+
+    @web.authenticated
+    @require_admin_role
+    async def get(self):
+        self.set_header("content-type", CONTENT_TYPE_LATEST)
+        self.finish(generate_latest(REGISTRY))
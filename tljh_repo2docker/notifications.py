@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .dbutil import async_to_sync_url
+
+# Channel of the PostgreSQL notifications of the changes of the environments.
+CHANNEL = "tljh_repo2docker_images"
+
+# Seconds between two attempts to reconnect the listening connection.
+RECONNECT_DELAY = 5
+
+# Key of `AsyncSession.info` holding the changes to dispatch once the
+# transaction is committed.
+PENDING = "tljh_repo2docker.changes"
+
+# A change of an environment: ``uid`` (`None` for any environment),
+# ``status`` (`None` if unchanged, "deleted" once deleted) and ``offset``
+# (the length of its build log, `None` if unchanged).
+Change = Dict[str, Any]
+
+Listener = Callable[[Change], None]
+
+
+def change(uid=None, status=None, offset: Optional[int] = None) -> Change:
+    """Build the event of a change, serializable in JSON."""
+    return {
+        "uid": str(uid) if uid is not None else None,
+        "status": getattr(status, "value", status),
+        "offset": offset,
+    }
+
+
+@sa.event.listens_for(Session, "after_commit")
+def _dispatch_pending(session: Session) -> None:
+    pending: List[Tuple["ChangeNotifier", Change]] = session.info.pop(PENDING, [])
+    for notifier, event in pending:
+        notifier.dispatch(event)
+
+
+@sa.event.listens_for(Session, "after_transaction_end")
+def _drop_pending(session: Session, transaction) -> None:
+    # Rolled back: the changes did not happen.
+    if transaction.parent is None:
+        session.info.pop(PENDING, None)
+
+
+class ChangeNotifier:
+    """
+    Tell the listeners of this process about the changes of the
+    environments, once committed.
+
+    The changes made by other processes are not seen: the listeners keep
+    polling the database (`polls` is `True`). See `PostgresNotifier` for
+    the notifications between the replicas of the service.
+    """
+
+    def __init__(self, log=None) -> None:
+        self.log = log or logging.getLogger(__name__)
+        self._listeners: Dict[Optional[str], Set[Listener]] = {}
+
+    @property
+    def polls(self) -> bool:
+        """Whether the listeners must poll for the changes of other processes."""
+        return True
+
+    def add_listener(self, uid: Optional[UUID], listener: Listener) -> None:
+        """
+        Call ``listener`` with the changes of the environment ``uid``, or of
+        every environment if ``uid`` is `None`.
+        """
+        key = str(uid) if uid is not None else None
+        self._listeners.setdefault(key, set()).add(listener)
+
+    def remove_listener(self, uid: Optional[UUID], listener: Listener) -> None:
+        key = str(uid) if uid is not None else None
+        listeners = self._listeners.get(key, set())
+        listeners.discard(listener)
+        if not listeners:
+            self._listeners.pop(key, None)
+
+    async def publish(self, db: AsyncSession, event: Change) -> None:
+        """
+        Publish ``event`` when the transaction of ``db`` is committed.
+
+        Args:
+            db: The session making the change.
+            event: The change, built with `change`.
+        """
+        db.info.setdefault(PENDING, []).append((self, event))
+
+    def dispatch(self, event: Change) -> None:
+        """Call the listeners of ``event``."""
+        listeners = set(self._listeners.get(None, ()))
+        if event["uid"] is None:
+            for uid_listeners in self._listeners.values():
+                listeners.update(uid_listeners)
+        else:
+            listeners.update(self._listeners.get(event["uid"], ()))
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                self.log.exception("Failed to notify a change of %s", event["uid"])
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresNotifier(ChangeNotifier):
+    """
+    Tell the listeners of every replica of the service about the changes of
+    the environments, with PostgreSQL LISTEN/NOTIFY.
+
+    The changes are sent with ``pg_notify`` in the transaction making them,
+    so PostgreSQL delivers them on commit, to every listening connection,
+    the one of this process included. While the listening connection is
+    down, the listeners poll the database.
+    """
+
+    def __init__(self, async_db_url: str, log=None) -> None:
+        super().__init__(log=log)
+        self.dsn = async_to_sync_url(async_db_url)
+        self._connected = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def polls(self) -> bool:
+        return not self._connected
+
+    async def publish(self, db: AsyncSession, event: Change) -> None:
+        await db.execute(sa.select(sa.func.pg_notify(CHANNEL, json.dumps(event))))
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._listen())
+
+    async def _listen(self) -> None:
+        import asyncpg
+
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+                await connection.add_listener(CHANNEL, self._on_notification)
+                self._connected = True
+                self.log.info("Listening to the changes of the environments")
+                await lost.wait()
+            except asyncio.CancelledError:
+                if connection is not None:
+                    await connection.close()
+                raise
+            except Exception:
+                self.log.warning(
+                    "Failed to listen to the changes of the environments",
+                    exc_info=True,
+                )
+            if self._connected:
+                self._connected = False
+                # The changes made meanwhile are lost: have every listener
+                # read the database again.
+                self.dispatch(change())
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            self.log.warning("Ignoring the notification %r", payload)
+            return
+        self.dispatch(event)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._connected = False
+
+
+def make_notifier(async_db_url: str, log=None) -> ChangeNotifier:
+    """Return the notifier fitting the database: LISTEN/NOTIFY on PostgreSQL."""
+    if async_db_url.startswith("postgresql"):
+        return PostgresNotifier(async_db_url, log=log)
+    return ChangeNotifier(log=log)
@@ -0,0 +1,272 @@
+import ast
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+from uuid import UUID, uuid4
+
+from aiodocker import DockerError
+from tornado import web
+from tornado.log import app_log
+
+from .base import BaseHandler, require_admin_role
+from .database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    ImageMetadataType,
+)
+from .docker import _collect_images, _list_r2d_images, on_each_host
+from .docker_hosts import DockerHost
+from .leases import lease_expired
+from .metrics import RECONCILER_DRIFT
+
+# Seconds a build container may exist before its environment entry records
+# it: younger containers are never treated as orphans.
+ORPHAN_GRACE_PERIOD = 60
+
+DRIFT_KINDS = ("import", "missing", "interrupted", "orphaned")
+
+INTERRUPTED_NOTE = "\n[Build interrupted: the build container is gone]\n"
+
+
+def _node_selector(label: str) -> Dict:
+    """Parse the node selector label, written as a Python dict."""
+    try:
+        node_selector = ast.literal_eval(label or "{}")
+    except (ValueError, SyntaxError):
+        return {}
+    return node_selector if isinstance(node_selector, dict) else {}
+
+
+def _entry_from_image(image: Dict) -> DockerImageCreateSchema:
+    """Create the entry of an environment image from its labels."""
+    build_info = None
+    if len(image.get("docker_hosts", [])) == 1:
+        build_info = {"docker_host": image["docker_hosts"][0]}
+    return DockerImageCreateSchema(
+        uid=uuid4(),
+        name=image["image_name"],
+        status=BuildStatusType.BUILT,
+        log="",
+        image_meta=ImageMetadataType(
+            display_name=image["display_name"],
+            repo=image["repo"],
+            ref=image["ref"],
+            creation_date=image["creation_date"],
+            owner=image["owner"],
+            cpu_limit=image["cpu_limit"],
+            # The label has the unit, the entry the number of GB.
+            mem_limit=image["mem_limit"].removesuffix("G"),
+            node_selector=_node_selector(image["node_selector"]),
+            build_info=build_info,
+        ),
+    )
+
+
+async def _snapshot(docker):
+    return await asyncio.gather(
+        _list_r2d_images(docker),
+        docker.containers.list(
+            all=True, filters=json.dumps({"label": ["repo2docker.build"]})
+        ),
+    )
+
+
+class Reconciler:
+    """
+    Keep the environment entries of the database in line with Docker, which
+    changes behind the service (``docker rmi``, a crash during a build...).
+
+    Each round lists the images and build containers of every Docker host
+    once, then:
+
+    - creates the entries of the environment images the database does not
+      know, like the ones built by older versions of the service, but for
+      the images replaced by a rebuild (``build_info.cache_from``);
+    - forgets the built environments whose image is gone from every host;
+    - marks as FAILED the builds in progress whose container is gone;
+    - removes the build containers that no build in progress owns.
+
+    The database is then the source of the list of environments. Entries are
+    only forgotten or marked as FAILED when every Docker host answered.
+    """
+
+    def __init__(
+        self,
+        hosts: Optional[List[DockerHost]] = None,
+        db_context=None,
+        image_db_manager=None,
+        build_jobs=None,
+        log=None,
+    ) -> None:
+        self.hosts = hosts
+        self.db_context = db_context
+        self.image_db_manager = image_db_manager
+        self.build_jobs = build_jobs
+        self.log = log or app_log
+
+    async def plan(self) -> Dict:
+        """
+        Compare the database with Docker, without changing anything.
+
+        Returns:
+            A drift report with the environment images to ``import``, the
+            ``missing`` and ``interrupted`` entries, the ``orphaned``
+            build containers, and whether every Docker host answered
+            (``complete``).
+        """
+        hosts = list(self.hosts or [DockerHost()])
+        results = await on_each_host(hosts, _snapshot)
+        complete = len(results) == len(hosts)
+        images = _collect_images([(host, images) for host, (images, _) in results])
+        containers = [
+            (host, container)
+            for host, (_, host_containers) in results
+            for container in host_containers
+        ]
+        async with self.db_context() as db:
+            entries = await self.image_db_manager.read_all(
+                db, with_log=False, primary=True
+            )
+
+        known = {entry.name for entry in entries}
+        # The previous images of the rebuilt environments, kept on the hosts
+        # for the layer cache of the build, or while they are in use.
+        replaced = {
+            name
+            for entry in entries
+            for name in (entry.image_meta.build_info or {}).get("cache_from", [])
+        }
+        image_names = {image["image_name"] for image in images}
+        building = [e for e in entries if e.status == BuildStatusType.BUILDING]
+        container_ids = {container["Id"] for _, container in containers}
+
+        report = {
+            "complete": complete,
+            "import": [
+                image for image in images if image["image_name"] not in known | replaced
+            ],
+            "missing": [],
+            "interrupted": [],
+            "orphaned": [],
+        }
+        if complete:
+            report["missing"] = [
+                {"uid": str(entry.uid), "image_name": entry.name}
+                for entry in entries
+                if entry.status == BuildStatusType.BUILT
+                and entry.name not in image_names
+            ]
+            report["interrupted"] = [
+                {"uid": str(entry.uid), "image_name": entry.name}
+                for entry in building
+                if entry.container_id not in container_ids
+                and (self.build_jobs is None or entry.uid not in self.build_jobs)
+                # Not driven by another replica of the service.
+                and lease_expired(entry)
+            ]
+
+        building_containers = {entry.container_id for entry in building}
+        building_names = {entry.name for entry in building}
+        now = time.time()
+        for host, container in containers:
+            image_name = container["Labels"].get("repo2docker.build")
+            if (
+                container["Id"] in building_containers
+                or image_name in building_names
+                or now - container.get("Created", now) < ORPHAN_GRACE_PERIOD
+            ):
+                continue
+            report["orphaned"].append(
+                {
+                    "id": container["Id"],
+                    "image_name": image_name,
+                    "docker_host": host.name,
+                }
+            )
+        return report
+
+    async def reconcile(self, dry_run: bool = False) -> Dict:
+        """
+        Run a round of the reconciler.
+
+        Args:
+            dry_run: Only report the drift.
+
+        Returns:
+            The report of `plan`.
+        """
+        report = await self.plan()
+        if dry_run:
+            return report
+
+        async with self.db_context() as db:
+            for image in report["import"]:
+                await self.image_db_manager.create(db, _entry_from_image(image))
+            for entry in report["missing"]:
+                await self.image_db_manager.delete(db, UUID(entry["uid"]))
+            if report["interrupted"]:
+                await self.image_db_manager.mark_status(
+                    db,
+                    where={
+                        "uid": [UUID(entry["uid"]) for entry in report["interrupted"]],
+                        "status": BuildStatusType.BUILDING,
+                    },
+                    set=BuildStatusType.FAILED,
+                    append_log=INTERRUPTED_NOTE,
+                )
+
+        hosts = {host.name: host for host in self.hosts or [DockerHost()]}
+        for orphan in report["orphaned"]:
+            host = hosts[orphan["docker_host"]]
+            try:
+                async with host.docker() as docker:
+                    await docker.containers.container(orphan["id"]).delete(force=True)
+            except DockerError as e:
+                self.log.info("Keeping container %s: %s", orphan["id"], e.message)
+
+        drift = {kind: len(report[kind]) for kind in DRIFT_KINDS}
+        for kind, count in drift.items():
+            RECONCILER_DRIFT.labels(kind=kind).inc(count)
+        if not any(drift.values()):
+            return report
+        self.log.warning(
+            "Reconciled the environments with Docker: %d imported, %d missing, "
+            "%d interrupted, %d orphaned build containers",
+            *drift.values(),
+        )
+        return report
+
+    async def run(self) -> None:
+        """Run a round, logging instead of raising, for a periodic callback."""
+        try:
+            await self.reconcile()
+        except Exception:
+            self.log.exception("Failed to reconcile the environments with Docker")
+
+
+class ReconcilerHandler(BaseHandler):
+    """
+    Report on (GET, dry run) or run (POST) the reconciler
+    """
+
+    @property
+    def reconciler(self) -> Reconciler:
+        reconciler = self.settings.get("reconciler")
+        if reconciler is None:
+            raise web.HTTPError(404, "The reconciler is not available")
+        return reconciler
+
+    @web.authenticated
+    @require_admin_role
+    async def get(self):
+        report = await self.reconciler.reconcile(dry_run=True)
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps(report))
+
+    @web.authenticated
+    @require_admin_role
+    async def post(self):
+        report = await self.reconciler.reconcile()
+        self.set_header("content-type", "application/json")
+        self.finish(json.dumps(report))
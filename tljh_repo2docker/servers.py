@@ -4,7 +4,7 @@ from typing import Dict, List
 from tornado import web
 
 from .base import BaseHandler
-from .docker import list_images
+from .database.schemas import BuildStatusType
 
 
 class ServersHandler(BaseHandler):
@@ -14,14 +14,13 @@ class ServersHandler(BaseHandler):
 
     @web.authenticated
     async def get(self):
-        images = []
-        if self.use_binderhub:
-            images = await self.get_images_from_db()
-        else:
-            try:
-                images = await list_images()
-            except ValueError:
-                pass
+        # The images found on the Docker hosts are imported by the
+        # reconciler, so the database lists them in both modes.
+        images = [
+            image
+            for image in await self.get_images_from_db()
+            if image["status"] == BuildStatusType.BUILT
+        ]
 
         user_data = await self.fetch_user()
 
@@ -7,6 +7,7 @@ from tljh_repo2docker.docker import get_image_metadata
 
 from .base import BaseHandler
 from .database.schemas import BuildStatusType
+from .image_gc import utcnow_iso
 from typing import List, Dict
 
 
@@ -58,7 +59,9 @@ class ServersAPIHandler(BaseHandler):
                 image_name = image.name
                 image_metadata = image.image_meta.model_dump()
         else:
-            image_metadata = await get_image_metadata(image_name)
+            image_metadata = await get_image_metadata(
+                image_name, self.settings.get("docker_hosts")
+            )
 
         post_data = {"image": image_name, "metadata": image_metadata}
         path = ""
@@ -67,14 +70,29 @@ class ServersAPIHandler(BaseHandler):
         else:
             path = url_path_join("users", user_name, "server")
         try:
-            response = await self.client.post(path, json=post_data, timeout=10)
+            response = await self.client.post(
+                path, json=post_data, timeout=self.client.route_timeout("spawn")
+            )
             response.raise_for_status()
-            return response
         except Exception:
             self.log.exception(
                 "Failed to start server %r for user %r", server_name, user_name
             )
             raise web.HTTPError(500, "Server error")
+        await self._record_usage(image_name)
+        return response
+
+    async def _record_usage(self, image_name):
+        """Record that the environment of ``image_name`` was just used."""
+        db_context = self.settings.get("db_context")
+        image_db_manager = self.settings.get("image_db_manager")
+        if not db_context or not image_db_manager:
+            return
+        try:
+            async with db_context() as db:
+                await image_db_manager.record_usage(db, [image_name], utcnow_iso())
+        except Exception:
+            self.log.exception("Failed to record the usage of %s", image_name)
 
     @web.authenticated
     async def delete(self):
@@ -0,0 +1,144 @@
+import json
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import httpx
+import pytest
+
+from tljh_repo2docker import binderhub_builder
+from tljh_repo2docker.binderhub_builder import BinderHubBuild
+from tljh_repo2docker.database.schemas import BuildStatusType
+from tljh_repo2docker.http_clients import make_client
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(binderhub_builder, "RECONNECT_DELAY", 0)
+
+
+def _event(phase, message="", **kwargs):
+    return f"data: {json.dumps(dict(phase=phase, message=message, **kwargs))}\n\n"
+
+
+class DroppedStream(httpx.AsyncByteStream):
+    """Yield some events, then fail like a connection reset by a proxy."""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event.encode()
+        raise httpx.ReadError("Connection reset")
+
+
+def _transport(responses):
+    """Answer each request with the next of ``responses``."""
+    responses = iter(responses)
+
+    def handler(request):
+        events, dropped = next(responses)
+        if dropped:
+            return httpx.Response(200, stream=DroppedStream(events))
+        return httpx.Response(200, content="".join(events).encode())
+
+    return httpx.MockTransport(handler)
+
+
+class FakeManager:
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, db, obj_in, fetch=True, where=None):
+        self.updates.append(obj_in)
+
+
+@asynccontextmanager
+async def fake_db_context():
+    yield None
+
+
+def _build(responses):
+    manager = FakeManager()
+    build = BinderHubBuild(
+        make_client(
+            "binderhub",
+            route_timeouts={"build": 120},
+            transport=_transport(responses),
+        ),
+        "http://binder/build/gh/org/repo/HEAD",
+        {"build_only": "true"},
+        uuid4(),
+        "python",
+        fake_db_context,
+        manager,
+    )
+    return build, manager
+
+
+async def test_reconnect_skips_replayed_messages():
+    build, manager = _build(
+        [
+            ([_event("building", "Step 1\n"), _event("building", "Step 2\n")], True),
+            (
+                [
+                    _event("waiting", "Waiting for build to start...\n"),
+                    _event("building", "Step 1\n"),
+                    _event("building", "Step 2\n"),
+                    _event("building", "Step 2\n"),
+                    _event("unknown", "ignored"),
+                    _event("built", "Built image\n", imageName="registry/python:1"),
+                ],
+                False,
+            ),
+        ]
+    )
+
+    await build.run()
+
+    final = manager.updates[-1]
+    assert final.status == BuildStatusType.BUILT
+    assert final.name == "registry/python:1"
+    assert final.log == (
+        "Step 1\nStep 2\nWaiting for build to start...\nStep 2\nBuilt image\n"
+    )
+
+
+async def test_failed_phase_ends_the_build():
+    build, manager = _build([([_event("failed", "Build failed\n")], False)])
+
+    await build.run()
+
+    assert manager.updates[-1].status == BuildStatusType.FAILED
+    assert manager.updates[-1].log == "Build failed\n"
+
+
+async def test_reconnects_until_the_build_ends():
+    # More drops than the backoff doubles for: the stream is still reopened.
+    build, manager = _build(
+        [([_event("building", "Step 1\n")], True)]
+        + [([], True)] * 12
+        + [([_event("built", "Built image\n", imageName="python:1")], False)]
+    )
+
+    await build.run()
+
+    final = manager.updates[-1]
+    assert final.status == BuildStatusType.BUILT
+    assert final.name == "python:1"
+    assert final.log == "Step 1\nBuilt image\n"
+
+
+async def test_lost_stream_marks_the_build_failed(monkeypatch):
+    monkeypatch.setattr(binderhub_builder, "BUILD_STREAM_TIMEOUT", 0)
+    # The build endpoint is not called again once the stream is given up:
+    # BinderHub would start a new build.
+    build, manager = _build([([_event("building", "Step 1\n")], True)])
+
+    await build.run()
+
+    final = manager.updates[-1]
+    assert final.status == BuildStatusType.FAILED
+    assert (
+        final.log == "Step 1\n\n[Lost the connection to BinderHub: Connection reset]\n"
+    )
@@ -0,0 +1,44 @@
+import asyncio
+from uuid import uuid4
+
+from tljh_repo2docker.build_jobs import BuildJobs
+
+
+async def test_start_tracks_running_build():
+    jobs = BuildJobs()
+    uid = uuid4()
+    done = asyncio.Event()
+
+    task = jobs.start(uid, done.wait())
+    assert uid in jobs
+    assert jobs.get(uid) is task
+
+    done.set()
+    await task
+    await asyncio.sleep(0)
+    assert uid not in jobs
+
+
+async def test_cancel_waits_for_cleanup():
+    jobs = BuildJobs()
+    uid = uuid4()
+    cleaned_up = []
+
+    async def build():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            await asyncio.sleep(0)
+            cleaned_up.append(True)
+            raise
+
+    jobs.start(uid, build())
+    await asyncio.sleep(0)
+    assert await jobs.cancel(uid) is True
+    assert cleaned_up == [True]
+    assert uid not in jobs
+
+
+async def test_cancel_unknown_build():
+    jobs = BuildJobs()
+    assert await jobs.cancel(uuid4()) is False
@@ -1,3 +1,4 @@
+import json
 from uuid import UUID, uuid4
 
 import pytest
@@ -16,7 +17,7 @@ from ..utils import (
 )
 
 
-def _insert_image_row(*, uid, name, status, display_name=None, repo="https://example.com/repo", ref="HEAD"):
+def _insert_image_row(*, uid, name, status, display_name=None, repo="https://example.com/repo", ref="HEAD", **meta):
     """Insert an image row directly in the sqlite DB used by the test service."""
     engine = sa.create_engine("sqlite:///test_tljh_repo2docker.sqlite")
     with engine.begin() as conn:
@@ -35,6 +36,7 @@ def _insert_image_row(*, uid, name, status, display_name=None, repo="https://exa
                     "cpu_limit": "",
                     "mem_limit": "",
                     "node_selector": {},
+                    **meta,
                 },
             )
         )
@@ -189,6 +191,31 @@ async def test_rebuild_with_mismatched_name_returns_400(app, minimal_repo):
     assert r.status_code == 400
 
 
+@pytest.mark.asyncio
+async def test_rebuild_keeps_the_recorded_usage(app, minimal_repo):
+    uid = uuid4()
+    _insert_image_row(
+        uid=uid,
+        name="used:HEAD",
+        display_name="used",
+        status=BuildStatusType.BUILT,
+        repo=minimal_repo,
+        last_used="2025-01-01T00:00:00+00:00",
+    )
+    r = await add_environment(
+        app,
+        repo=minimal_repo,
+        name="used",
+        ref="HEAD",
+        uid=str(uid),
+    )
+    assert r.status_code == 200
+
+    image_meta = _read_image_row(uid).image_meta
+    assert image_meta["last_used"] == "2025-01-01T00:00:00+00:00"
+    assert image_meta["build_info"]["cache_from"] == ["used:HEAD"]
+
+
 @pytest.mark.asyncio
 async def test_rebuild_while_building_returns_409(app, minimal_repo):
     uid = uuid4()
@@ -264,9 +291,9 @@ async def test_get_environments_returns_json(app, minimal_repo, image_name):
 
 @pytest.mark.asyncio
 async def test_get_environments_serializes_db_only_entries(app):
-    # DB-only rows (no matching Docker image) exercise the _enrich_with_db
-    # `extra` branch. They carry an enum status and image_meta fields that
-    # must all be JSON-serializable.
+    # DB-only rows (no matching Docker image) are listed from the database.
+    # They carry an enum status and image_meta fields that must all be
+    # JSON-serializable.
     failed_uid = uuid4()
     building_uid = uuid4()
     _insert_image_row(
@@ -294,3 +321,47 @@ async def test_get_environments_serializes_db_only_entries(app):
     assert by_name["failed-only"]["uid"] == str(failed_uid)
     assert by_name["building-only"]["status"] == BuildStatusType.BUILDING.value
     assert by_name["building-only"]["uid"] == str(building_uid)
+
+
+@pytest.mark.asyncio
+async def test_cancel_build(app, minimal_repo, image_name):
+    name, ref = image_name.split(":")
+    r = await add_environment(app, repo=minimal_repo, name=name, ref=ref)
+    assert r.status_code == 200
+    uid = r.json()["uid"]
+
+    r = await api_request(app, "environments", uid, "cancel", method="post")
+    assert r.status_code == 200
+
+    # The entry and its log are kept, only the status changes.
+    row = _read_image_row(UUID(uid))
+    assert row is not None
+    assert row.status == BuildStatusType.CANCELLED.value
+    assert "Build cancelled" in row.log
+
+    # No build container is left behind.
+    async with Docker() as docker:
+        containers = await docker.containers.list(
+            filters=json.dumps({"label": [f"repo2docker.build={image_name}"]})
+        )
+    assert containers == []
+
+
+@pytest.mark.asyncio
+async def test_cancel_not_building_returns_409(app, minimal_repo):
+    uid = uuid4()
+    _insert_image_row(
+        uid=uid,
+        name="done:HEAD",
+        display_name="done",
+        status=BuildStatusType.BUILT,
+        repo=minimal_repo,
+    )
+    r = await api_request(app, "environments", str(uid), "cancel", method="post")
+    assert r.status_code == 409
+
+
+@pytest.mark.asyncio
+async def test_cancel_unknown_uid_returns_404(app):
+    r = await api_request(app, "environments", str(uuid4()), "cancel", method="post")
+    assert r.status_code == 404
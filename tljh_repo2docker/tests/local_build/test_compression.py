@@ -0,0 +1,126 @@
+import gzip
+import json
+import zlib
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from tornado import httputil, web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from tljh_repo2docker.compression import (
+    ContentEncoding,
+    PrecompressedStaticFileHandler,
+    choose_encoding,
+)
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, deflate", ("br", "gzip")) == "gzip"
+    assert choose_encoding("gzip;q=0.5, br", ("br", "gzip")) == "br"
+    assert choose_encoding("br;q=0.5, gzip", ("br", "gzip")) == "gzip"
+    assert choose_encoding("gzip;q=0, *", ("gzip",)) is None
+    assert choose_encoding("*", ("br", "gzip")) == "br"
+    assert choose_encoding("", ("gzip",)) is None
+
+
+def _transform(min_length=1024):
+    request = SimpleNamespace(headers=httputil.HTTPHeaders({"Accept-Encoding": "gzip"}))
+    return ContentEncoding(request, min_length=min_length)
+
+
+def _headers(content_type):
+    return httputil.HTTPHeaders({"Content-Type": content_type})
+
+
+def test_small_response_is_not_compressed():
+    body = json.dumps({"images": []}).encode()
+
+    _, headers, chunk = _transform().transform_first_chunk(
+        200, _headers("application/json"), body, True
+    )
+
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+    assert chunk == body
+
+
+def test_large_response_is_compressed():
+    body = json.dumps({"images": ["python:HEAD"] * 200}).encode()
+
+    _, headers, chunk = _transform().transform_first_chunk(
+        200, _headers("application/json"), body, True
+    )
+
+    assert headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(chunk) == body
+
+
+def test_binary_response_is_not_compressed():
+    body = b"\x89PNG" * 1024
+
+    _, headers, chunk = _transform().transform_first_chunk(
+        200, _headers("image/png"), body, True
+    )
+
+    assert "Content-Encoding" not in headers
+    assert chunk == body
+
+
+def test_event_stream_flushes_each_event():
+    transform = _transform()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    events = [f'data: {{"phase": "log", "message": "Step {i}"}}\n\n' for i in range(3)]
+
+    _, headers, chunk = transform.transform_first_chunk(
+        200, _headers("text/event-stream"), events[0].encode(), False
+    )
+    assert headers["Content-Encoding"] == "gzip"
+    # Each event can be read as soon as it is sent.
+    assert decompressor.decompress(chunk) == events[0].encode()
+    for event in events[1:]:
+        chunk = transform.transform_chunk(event.encode(), False)
+        assert decompressor.decompress(chunk) == event.encode()
+    decompressor.decompress(transform.transform_chunk(b"", True))
+    assert decompressor.eof
+
+
+@pytest.fixture
+async def static_url(tmp_path):
+    bundle = b"console.log('tljh-repo2docker');\n" * 100
+    (tmp_path / "app.js").write_bytes(bundle)
+    (tmp_path / "app.js.gz").write_bytes(gzip.compress(bundle))
+    (tmp_path / "app.3f9a2c1b.js").write_bytes(bundle)
+    app = web.Application(
+        [(r"/static/(.*)", PrecompressedStaticFileHandler, {"path": str(tmp_path)})]
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    yield f"http://127.0.0.1:{port}/static/"
+    server.stop()
+
+
+async def test_static_serves_precompressed_variant(static_url):
+    async with httpx.AsyncClient() as client:
+        r = await client.get(static_url + "app.js", headers={"Accept-Encoding": "gzip"})
+        plain = await client.get(
+            static_url + "app.js", headers={"Accept-Encoding": "identity"}
+        )
+
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert r.headers["Content-Type"] == "text/javascript"
+    assert r.text == plain.text
+    assert "Content-Encoding" not in plain.headers
+    assert "immutable" not in r.headers.get("Cache-Control", "")
+
+
+async def test_static_versioned_files_are_immutable(static_url):
+    async with httpx.AsyncClient() as client:
+        versioned = await client.get(static_url + "app.js?v=abc")
+        hashed = await client.get(static_url + "app.3f9a2c1b.js")
+
+    for r in (versioned, hashed):
+        assert r.status_code == 200
+        assert "immutable" in r.headers["Cache-Control"]
@@ -1,6 +1,8 @@
 from uuid import uuid4
 
 import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     async_sessionmaker,
@@ -8,7 +10,7 @@ from sqlalchemy.ext.asyncio import (
 )
 
 from tljh_repo2docker.database.manager import ImagesDatabaseManager
-from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.model import BaseSQL, DockerImageSQL
 from tljh_repo2docker.database.schemas import (
     BuildStatusType,
     DockerImageCreateSchema,
@@ -92,6 +94,20 @@ async def test_read_all(db_session):
     assert len(all_images) == 3
 
 
+async def test_read_all_without_log(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+    await manager.update(
+        db_session, DockerImageUpdateSchema(uid=schema.uid, log="some log")
+    )
+
+    (entry,) = await manager.read_all(db_session, with_log=False)
+    assert entry.uid == schema.uid
+    assert entry.image_meta.display_name == "test-image"
+    assert entry.log == ""
+
+
 async def test_update_status(db_session):
     manager = ImagesDatabaseManager()
     schema = _make_schema()
@@ -138,6 +154,24 @@ async def test_update_log_accumulation(db_session):
     assert "line3" in updated.log
 
 
+async def test_read_log_since(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+    await manager.update(
+        db_session, DockerImageUpdateSchema(uid=schema.uid, log="Step 1\nStép 2\n")
+    )
+
+    delta = await manager.read_log_since(db_session, schema.uid, 7)
+    assert delta.status == BuildStatusType.BUILDING.value
+    assert delta.log == "Stép 2\n"
+    assert delta.length == 14
+
+    delta = await manager.read_log_since(db_session, schema.uid, 14)
+    assert delta.log == ""
+    assert await manager.read_log_since(db_session, uuid4(), 0) is None
+
+
 async def test_update_missing_returns_none(db_session):
     """Updating a deleted row must not resurrect it from a partial payload."""
     manager = ImagesDatabaseManager()
@@ -153,6 +187,137 @@ async def test_update_missing_returns_none(db_session):
     assert await manager.read(db_session, missing_uid) is None
 
 
+async def test_update_returns_updated_entry(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+
+    updated = await manager.update(
+        db_session,
+        DockerImageUpdateSchema(uid=schema.uid, status=BuildStatusType.BUILT),
+    )
+
+    assert updated.uid == schema.uid
+    assert updated.name == schema.name
+    assert updated.status == BuildStatusType.BUILT.value
+
+
+async def test_update_without_returning(db_session, monkeypatch):
+    """Databases without UPDATE ... RETURNING read the entry again."""
+    monkeypatch.setattr(db_session.get_bind().dialect, "update_returning", False)
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+
+    updated = await manager.update(
+        db_session, DockerImageUpdateSchema(uid=schema.uid, log="some log")
+    )
+    assert updated.log == "some log"
+    assert (
+        await manager.update(
+            db_session, DockerImageUpdateSchema(uid=uuid4(), log="late log line")
+        )
+        is None
+    )
+
+
+async def test_update_without_fetch(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+
+    assert (
+        await manager.update(
+            db_session,
+            DockerImageUpdateSchema(uid=schema.uid, log="some log"),
+            fetch=False,
+        )
+        is True
+    )
+    assert (await manager.read(db_session, schema.uid)).log == "some log"
+    assert (
+        await manager.update(
+            db_session,
+            DockerImageUpdateSchema(uid=uuid4(), log="late log line"),
+            fetch=False,
+        )
+        is None
+    )
+
+
+async def test_read_by_status(db_session):
+    manager = ImagesDatabaseManager()
+    building = _make_schema()
+    await manager.create(db_session, building)
+    await manager.create(db_session, _make_schema(status=BuildStatusType.BUILT))
+
+    entries = await manager.read_by_status(db_session, BuildStatusType.BUILDING)
+    assert [e.uid for e in entries] == [building.uid]
+
+
+async def test_mark_status(db_session):
+    manager = ImagesDatabaseManager()
+    interrupted = [_make_schema() for _ in range(3)]
+    for schema in interrupted:
+        await manager.create(db_session, schema)
+    await manager.update(
+        db_session, DockerImageUpdateSchema(uid=interrupted[0].uid, log="Step 1\n")
+    )
+    resumed = _make_schema()
+    built = _make_schema(status=BuildStatusType.BUILT)
+    await manager.create(db_session, resumed)
+    await manager.create(db_session, built)
+
+    marked = await manager.mark_status(
+        db_session,
+        where={
+            "uid": [s.uid for s in interrupted] + [built.uid],
+            "status": BuildStatusType.BUILDING,
+        },
+        set=BuildStatusType.FAILED,
+        append_log="[interrupted]\n",
+    )
+
+    assert marked == 3
+    first = await manager.read(db_session, interrupted[0].uid)
+    assert first.status == BuildStatusType.FAILED.value
+    assert first.log == "Step 1\n[interrupted]\n"
+    assert (await manager.read(db_session, interrupted[1].uid)).log == (
+        "[interrupted]\n"
+    )
+    assert (await manager.read(db_session, resumed.uid)).status == (
+        BuildStatusType.BUILDING.value
+    )
+    assert not (await manager.read(db_session, built.uid)).log
+
+
+async def test_mark_status_unknown_column(db_session):
+    with pytest.raises(ValueError):
+        await ImagesDatabaseManager().mark_status(
+            db_session, where={"nope": 1}, set=BuildStatusType.FAILED
+        )
+
+
+async def test_update_image_meta_merges_fields(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+
+    updated = await manager.update_image_meta(
+        db_session, schema.uid, build_info={"layers_reused": 12}
+    )
+    assert updated is True
+
+    fetched = await manager.read(db_session, schema.uid)
+    assert fetched.image_meta.build_info == {"layers_reused": 12}
+    assert fetched.image_meta.display_name == "test-image"
+
+
+async def test_update_image_meta_missing_returns_false(db_session):
+    manager = ImagesDatabaseManager()
+    assert await manager.update_image_meta(db_session, uuid4(), pinned=True) is False
+
+
 async def test_delete(db_session):
     manager = ImagesDatabaseManager()
     schema = _make_schema()
@@ -183,3 +348,42 @@ async def test_failed_image_has_log(db_session):
     assert fetched is not None
     assert fetched.status == BuildStatusType.FAILED.value
     assert "Error" in fetched.log
+
+
+async def test_record_usage(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+
+    count = await manager.record_usage(
+        db_session, [schema.name, "missing:HEAD"], "2026-10-19T08:00:00+00:00"
+    )
+    assert count == 1
+
+    fetched = await manager.read(db_session, schema.uid)
+    assert fetched.image_meta.last_used == "2026-10-19T08:00:00+00:00"
+    assert fetched.image_meta.display_name == "test-image"
+
+
+async def test_read_log_since_counts_characters(db_session):
+    manager = ImagesDatabaseManager()
+    schema = _make_schema()
+    await manager.create(db_session, schema)
+    log = "Étape 1 ✓\n🐍 Step 2\n"
+    await manager.update(db_session, DockerImageUpdateSchema(uid=schema.uid, log=log))
+
+    offset = 0
+    for chunk in (log[:10], log[10:]):
+        delta = await manager.read_log_since(db_session, schema.uid, offset)
+        assert delta.log == log[offset:]
+        assert delta.length == len(log)
+        offset += len(chunk)
+    delta = await manager.read_log_since(db_session, schema.uid, offset)
+    assert delta.log == "" and delta.length == len(log)
+
+
+def test_log_length_counts_characters_on_every_dialect():
+    statement = sa.select(sa.func.char_length(DockerImageSQL.log))
+    assert "char_length" in str(statement.compile(dialect=mysql.dialect()))
+    assert "char_length" in str(statement.compile(dialect=postgresql.dialect()))
+    assert "length(images.log)" in str(statement.compile(dialect=sqlite.dialect()))
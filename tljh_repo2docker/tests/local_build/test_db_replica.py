@@ -0,0 +1,112 @@
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    DockerImageUpdateSchema,
+    ImageMetadataType,
+)
+
+
+async def _db_context(url):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            yield session
+
+    context.engine = engine
+    return context
+
+
+@pytest.fixture
+async def databases(tmp_path):
+    """A primary and a replica which never receives the writes: a lagging one."""
+    primary = await _db_context(f"sqlite+aiosqlite:///{tmp_path / 'primary.sqlite'}")
+    replica = await _db_context(f"sqlite+aiosqlite:///{tmp_path / 'replica.sqlite'}")
+    yield primary, replica
+    await primary.engine.dispose()
+    await replica.engine.dispose()
+
+
+def _schema(name="python:HEAD"):
+    return DockerImageCreateSchema(
+        uid=uuid4(),
+        name=name,
+        status=BuildStatusType.BUILDING,
+        log="",
+        image_meta=ImageMetadataType(
+            display_name=name.split(":")[0],
+            repo="https://github.com/org/repo",
+            ref="HEAD",
+            creation_date="01/01/2025",
+            owner="admin",
+            cpu_limit="",
+            mem_limit="",
+            node_selector={},
+        ),
+    )
+
+
+async def test_lists_are_read_from_the_replica(databases):
+    primary, replica = databases
+    manager = ImagesDatabaseManager(read_context=replica)
+    async with primary() as db:
+        await manager.create(db, _schema())
+
+        assert await manager.read_all(db) == []
+        assert len(await manager.read_all(db, primary=True)) == 1
+
+
+async def test_own_writes_are_read_from_the_primary(databases):
+    primary, replica = databases
+    manager = ImagesDatabaseManager(read_context=replica)
+    other = ImagesDatabaseManager(read_context=replica)
+    schema = _schema()
+    async with primary() as db:
+        await manager.create(db, schema)
+        await manager.update(
+            db, DockerImageUpdateSchema(uid=schema.uid, log="Step 1\n"), fetch=False
+        )
+
+        assert (await manager.read(db, schema.uid)).log == "Step 1\n"
+        assert (await manager.read_log_since(db, schema.uid, 0)).log == "Step 1\n"
+        # Another process did not write the entry: its reads go to the replica.
+        assert await other.read(db, schema.uid) is None
+
+
+async def test_read_your_writes_window_expires(databases):
+    primary, replica = databases
+    manager = ImagesDatabaseManager(read_context=replica, read_your_writes_window=0)
+    schema = _schema()
+    async with primary() as db:
+        await manager.create(db, schema)
+
+        assert await manager.read(db, schema.uid) is None
+        assert await manager.read(db, schema.uid, primary=True) is not None
+
+
+async def test_without_replica_reads_use_the_session(databases):
+    primary, _ = databases
+    manager = ImagesDatabaseManager()
+    schema = _schema()
+    async with primary() as db:
+        await manager.create(db, schema)
+
+        assert await manager.read(db, schema.uid) is not None
+        assert len(await manager.read_all(db)) == 1
+        assert manager._written == {}
@@ -0,0 +1,117 @@
+import asyncio
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from tornado.web import HTTPError
+
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    DockerImageUpdateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.database.writer import DatabaseWriter
+
+
+@pytest.fixture
+async def db_context():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    sessions = []
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            sessions.append(session)
+            yield session
+
+    context.sessions = sessions
+    yield context
+    await engine.dispose()
+
+
+def _schema(uid=None):
+    return DockerImageCreateSchema(
+        uid=uid or uuid4(),
+        name="python:HEAD",
+        status=BuildStatusType.BUILDING,
+        log="",
+        image_meta=ImageMetadataType(
+            display_name="python",
+            repo="https://github.com/org/repo",
+            ref="HEAD",
+            creation_date="01/01/2025",
+            owner="admin",
+            cpu_limit="",
+            mem_limit="",
+            node_selector={},
+        ),
+    )
+
+
+async def test_concurrent_writes_are_batched(db_context):
+    writer = DatabaseWriter(db_context)
+    manager = ImagesDatabaseManager(writer=writer)
+    schemas = [_schema() for _ in range(20)]
+    async with db_context() as db:
+        await asyncio.gather(*(manager.create(db, s) for s in schemas))
+        results = await asyncio.gather(
+            *(
+                manager.update(
+                    db, DockerImageUpdateSchema(uid=s.uid, log=f"log {i}"), fetch=False
+                )
+                for i, s in enumerate(schemas)
+            )
+        )
+    await writer.close()
+
+    assert results == [True] * 20
+    # One session for the caller, and a few for the batches of the writer.
+    assert len(db_context.sessions) < 10
+    async with db_context() as db:
+        for i, s in enumerate(schemas):
+            assert (await manager.read(db, s.uid)).log == f"log {i}"
+
+
+async def test_failed_write_only_fails_its_caller(db_context):
+    writer = DatabaseWriter(db_context)
+    manager = ImagesDatabaseManager(writer=writer)
+    existing = _schema()
+    async with db_context() as db:
+        await manager.create(db, existing)
+        new = _schema()
+        created, duplicate = await asyncio.gather(
+            manager.create(db, new),
+            manager.create(db, _schema(uid=existing.uid)),
+            return_exceptions=True,
+        )
+    await writer.close()
+
+    assert created.uid == new.uid
+    assert isinstance(duplicate, HTTPError) and duplicate.status_code == 409
+    async with db_context() as db:
+        assert await manager.read(db, new.uid) is not None
+
+
+async def test_close_commits_queued_writes(db_context):
+    writer = DatabaseWriter(db_context)
+    manager = ImagesDatabaseManager(writer=writer)
+    schema = _schema()
+    async with db_context() as db:
+        task = asyncio.ensure_future(manager.create(db, schema))
+        await asyncio.sleep(0)
+    await writer.close()
+
+    assert task.done()
+    async with db_context() as db:
+        assert await manager.read(db, schema.uid) is not None
@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import text
+
+from tljh_repo2docker.dbutil import async_session_context_factory, db_engine_options
+
+
+def test_default_profile():
+    options, pragmas = db_engine_options("sqlite+aiosqlite:///db.sqlite")
+    assert options == {"connect_args": {"timeout": 30, "check_same_thread": False}}
+    assert pragmas == {"journal_mode": "WAL"}
+
+    options, pragmas = db_engine_options("postgresql+asyncpg://hub@db/hub")
+    assert options == {} and pragmas == {}
+
+
+def test_performance_profile_with_overrides():
+    options, pragmas = db_engine_options(
+        "mysql+aiomysql://hub@db/hub", "performance", {"pool_size": 5}
+    )
+    assert options["pool_size"] == 5
+    assert options["pool_pre_ping"]
+    assert pragmas == {}
+
+    options, pragmas = db_engine_options(
+        "sqlite+aiosqlite:///db.sqlite",
+        "performance",
+        sqlite_pragmas={"synchronous": "FULL"},
+    )
+    assert pragmas["synchronous"] == "FULL"
+    assert pragmas["journal_mode"] == "WAL"
+
+
+def test_performance_profile_driver_options():
+    options, _ = db_engine_options("postgresql+asyncpg://hub@db/hub", "performance")
+    assert options["connect_args"] == {"server_settings": {"jit": "off"}}
+    assert options["pool_size"] == 20
+
+    # server_settings would fail to connect with another driver.
+    options, _ = db_engine_options("postgresql+psycopg://hub@db/hub", "performance")
+    assert "connect_args" not in options
+    assert options["pool_size"] == 20
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        db_engine_options("sqlite+aiosqlite:///db.sqlite", "fastest")
+    with pytest.raises(ValueError):
+        db_engine_options(
+            "sqlite+aiosqlite:///db.sqlite",
+            sqlite_pragmas={"synchronous=OFF; DROP TABLE images; --": 1},
+        )
+
+
+async def test_sqlite_pragmas_are_set(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}"
+    db_context = async_session_context_factory(
+        url, *db_engine_options(url, "performance")
+    )
+    async with db_context() as db:
+        assert (await db.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+        # NORMAL
+        assert (await db.execute(text("PRAGMA synchronous"))).scalar() == 1
+        assert (await db.execute(text("PRAGMA busy_timeout"))).scalar() == 5000
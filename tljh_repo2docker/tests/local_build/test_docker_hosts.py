@@ -0,0 +1,208 @@
+import pytest
+from aiodocker import DockerError
+from tornado import web
+
+from tljh_repo2docker.docker import delete_image, get_image_metadata, list_images
+from tljh_repo2docker.docker_hosts import (
+    DockerHost,
+    DockerHostPool,
+    HostUsage,
+    NoDockerHostError,
+    host_resources,
+    rank_hosts,
+)
+
+
+def _image(name, size=100):
+    return {
+        "Size": size,
+        "Labels": {
+            "repo2docker.repo": "https://github.com/org/repo",
+            "repo2docker.ref": "HEAD",
+            "tljh_repo2docker.image_name": name,
+            "tljh_repo2docker.display_name": name.split(":")[0],
+            "tljh_repo2docker.mem_limit": "",
+            "tljh_repo2docker.cpu_limit": "",
+        },
+    }
+
+
+class FakeImages:
+    def __init__(self, images):
+        self.images = images
+        self.deleted = []
+
+    async def list(self, filters=None):
+        if '"reference"' in (filters or ""):
+            return [
+                i
+                for i in self.images
+                if i["Labels"]["tljh_repo2docker.image_name"] in filters
+            ]
+        return self.images
+
+    async def delete(self, name):
+        if not any(
+            i["Labels"]["tljh_repo2docker.image_name"] == name for i in self.images
+        ):
+            raise DockerError(404, {"message": "No such image"})
+        self.deleted.append(name)
+
+    async def inspect(self, name):
+        for image in self.images:
+            if image["Labels"]["tljh_repo2docker.image_name"] == name:
+                return {"Config": {"Labels": image["Labels"]}}
+        raise DockerError(404, {"message": "No such image"})
+
+
+class FakeContainers:
+    async def list(self, filters=None):
+        return []
+
+
+class FakeSystem:
+    async def info(self):
+        return {"NCPU": 8, "MemTotal": 32 * 1024**3}
+
+
+class FakeDocker:
+    def __init__(self, images, reachable=True):
+        self.images = FakeImages(images)
+        self.containers = FakeContainers()
+        self.system = FakeSystem()
+        self.reachable = reachable
+
+    async def __aenter__(self):
+        if not self.reachable:
+            raise DockerError(900, {"message": "Cannot connect to Docker Engine"})
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeHost(DockerHost):
+    def __init__(self, name, images=(), reachable=True, **kwargs):
+        super().__init__(name, **kwargs)
+        self.client = FakeDocker(list(images), reachable)
+
+    def docker(self):
+        return self.client
+
+
+async def test_list_images_across_hosts():
+    hosts = [
+        FakeHost("a", [_image("python:HEAD"), _image("r:HEAD")]),
+        FakeHost("b", [_image("python:HEAD")]),
+        FakeHost("c", reachable=False),
+    ]
+
+    images = {i["image_name"]: i for i in await list_images(hosts)}
+
+    assert set(images) == {"python:HEAD", "r:HEAD"}
+    assert images["python:HEAD"]["docker_hosts"] == ["a", "b"]
+    assert images["r:HEAD"]["docker_hosts"] == ["a"]
+
+
+async def test_single_unreachable_host_raises():
+    with pytest.raises(DockerError):
+        await list_images([FakeHost("a", reachable=False)])
+
+
+async def test_get_image_metadata_across_hosts():
+    hosts = [FakeHost("a"), FakeHost("b", [_image("python:HEAD")])]
+
+    metadata = await get_image_metadata("python:HEAD", hosts)
+    assert metadata["display_name"] == "python"
+    assert metadata["docker_hosts"] == ["b"]
+
+    with pytest.raises(web.HTTPError):
+        await get_image_metadata("missing:HEAD", hosts)
+
+
+async def test_delete_image_on_every_host():
+    hosts = [
+        FakeHost("a", [_image("python:HEAD")]),
+        FakeHost("b"),
+        FakeHost("c", [_image("python:HEAD")]),
+    ]
+
+    assert await delete_image("python:HEAD", hosts)
+    assert hosts[0].client.images.deleted == ["python:HEAD"]
+    assert hosts[2].client.images.deleted == ["python:HEAD"]
+    assert not await delete_image("missing:HEAD", hosts)
+
+
+async def test_choose_least_builds():
+    a, b = FakeHost("a"), FakeHost("b")
+    pool = DockerHostPool([a, b])
+
+    with a.building():
+        assert await pool.choose() is b
+    assert await pool.choose() is a
+
+
+async def test_choose_matches_node_selector():
+    a = FakeHost("a", labels={"gpu": "false"})
+    b = FakeHost("b", labels={"gpu": "true"})
+    pool = DockerHostPool([a, b])
+
+    assert await pool.choose({"gpu": "true"}) is b
+    with pytest.raises(NoDockerHostError):
+        await pool.choose({"gpu": "many"})
+
+
+async def test_choose_prefers_previous_host():
+    a, b = FakeHost("a"), FakeHost("b")
+    pool = DockerHostPool([a, b])
+
+    with a.building():
+        assert await pool.choose(prefer="a") is a
+        assert await pool.choose(prefer="gone") is b
+
+
+async def test_choose_least_disk():
+    hosts = [
+        FakeHost("a", [_image("python:HEAD", 300)]),
+        FakeHost("b", reachable=False),
+        FakeHost("c", [_image("python:HEAD", 100), _image("r:HEAD", 100)]),
+    ]
+    pool = DockerHostPool(hosts, strategy="least-disk")
+
+    assert await pool.choose() is hosts[2]
+
+
+def test_pool_rejects_unnamed_hosts():
+    with pytest.raises(ValueError):
+        DockerHostPool([DockerHost(), DockerHost()])
+
+
+async def test_host_resources():
+    host = FakeHost("a", [_image("python:HEAD")])
+
+    resources = await host_resources(host, "python:HEAD")
+    assert resources["cpus"] == 8
+    assert resources["memory"] == 32 * 1024**3
+    assert resources["labels"]["tljh_repo2docker.image_name"] == "python:HEAD"
+
+    assert await host_resources(host, "missing:HEAD") is None
+    assert await host_resources(FakeHost("b", reachable=False), "python:HEAD") is None
+
+
+def test_rank_hosts_by_headroom():
+    a, b = DockerHost("a"), DockerHost("b")
+    small = {"cpus": 4, "memory": 16 * 1024**3}
+    large = {"cpus": 16, "memory": 64 * 1024**3}
+    usage = HostUsage()
+
+    assert rank_hosts([(a, small), (b, large)], usage, 2, 4 * 1024**3) == [b, a]
+
+    # Memory is the scarcest resource left on b.
+    usage.add("jupyter-alice", "b", 1, 60 * 1024**3)
+    assert rank_hosts([(a, small), (b, large)], usage, 2, 4 * 1024**3) == [a, b]
+
+    # Recording a server again replaces it.
+    usage.add("jupyter-alice", "b", 1, 1024**3)
+    assert usage.committed("b") == (1, 1024**3)
+    usage.remove("jupyter-alice")
+    assert usage.committed("b") == (0, 0)
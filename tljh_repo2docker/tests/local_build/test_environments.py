@@ -0,0 +1,129 @@
+import json
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import httpx
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from tljh_repo2docker.base import BaseHandler
+from tljh_repo2docker.database.manager import STREAM_BATCH_SIZE, ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.environments import write_image_list
+
+
+class ImageListHandler(BaseHandler):
+    """The JSON list of `BuildHandler.get`, without the Hub authentication."""
+
+    async def get(self):
+        self.settings["flushes"].append(0)
+        await write_image_list(self, flush_size=int(self.get_argument("flush_size")))
+
+    def flush(self, include_footers=False):
+        # Counts the flush of `finish` too.
+        self.settings["flushes"][-1] += 1
+        return super().flush(include_footers)
+
+
+@pytest.fixture
+async def db_context(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            yield session
+
+    yield context
+    await engine.dispose()
+
+
+async def _add(db_context, manager, count):
+    async with db_context() as db:
+        for i in range(count):
+            await manager.create(
+                db,
+                DockerImageCreateSchema(
+                    uid=uuid4(),
+                    name=f"env-{i}:HEAD",
+                    status=BuildStatusType.BUILT,
+                    log="Step 1\n",
+                    image_meta=ImageMetadataType(
+                        display_name=f"env-{i}",
+                        repo="https://github.com/org/repo",
+                        ref="HEAD",
+                        creation_date="01/01/2025",
+                        owner="admin",
+                        cpu_limit="",
+                        mem_limit="",
+                        node_selector={},
+                    ),
+                ),
+            )
+
+
+@pytest.fixture
+async def server(db_context):
+    manager = ImagesDatabaseManager()
+    settings = dict(db_context=db_context, image_db_manager=manager, flushes=[])
+    app = web.Application([(r"/images", ImageListHandler)], **settings)
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    yield app, f"http://127.0.0.1:{port}/images"
+    server.stop()
+
+
+async def test_stream_all_matches_read_all(db_context):
+    manager = ImagesDatabaseManager()
+    await _add(db_context, manager, 7)
+
+    async with db_context() as db:
+        batches = [images async for images in manager.stream_all(db, batch_size=3)]
+        assert [len(images) for images in batches] == [3, 3, 1]
+        assert sum(batches, []) == await manager.read_all(db, with_log=False)
+        with_log = [images async for images in manager.stream_all(db, with_log=True)]
+        assert sum(with_log, []) == await manager.read_all(db)
+
+
+async def test_list_is_streamed(server, db_context):
+    app, url = server
+    handler = app.settings
+    # More than a batch of rows of the server-side cursor.
+    await _add(db_context, handler["image_db_manager"], STREAM_BATCH_SIZE + 50)
+    async with db_context() as db:
+        images = await handler["image_db_manager"].read_all(db, with_log=False)
+    expected = {"images": [ImageListHandler._image_dict(image) for image in images]}
+
+    async with httpx.AsyncClient() as client:
+        streamed = await client.get(url, params={"flush_size": 1024})
+        buffered = await client.get(url, params={"flush_size": 10**9})
+
+    # The same document, sent in several chunks rather than at once.
+    assert streamed.text == buffered.text == json.dumps(expected)
+    assert streamed.headers["content-type"] == "application/json"
+    assert handler["flushes"][0] > 2
+    assert handler["flushes"][1] == 1
+    assert "etag" in buffered.headers
+
+
+async def test_empty_list(server):
+    _, url = server
+    async with httpx.AsyncClient() as client:
+        r = await client.get(url, params={"flush_size": 1024})
+    assert r.json() == {"images": []}
@@ -0,0 +1,93 @@
+import subprocess
+
+import pytest
+
+from tljh_repo2docker.git_cache import GitCacheError, GitMirrorCache
+
+
+def _git(*args, cwd=None):
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    repo = tmp_path / "upstream"
+    repo.mkdir()
+    _git("init", "-q", "-b", "main", cwd=repo)
+    (repo / "README.md").write_text("hello\n")
+    _git("add", ".", cwd=repo)
+    _git("commit", "-q", "-m", "first", cwd=repo)
+    return repo
+
+
+async def test_sync_creates_mirror(tmp_path, upstream):
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    path = await cache.sync(str(upstream))
+
+    assert path == cache.mirror_path(str(upstream))
+    assert _git("rev-parse", "main", cwd=path) == _git(
+        "rev-parse", "HEAD", cwd=upstream
+    )
+
+
+async def test_sync_fetches_new_commits(tmp_path, upstream):
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    path = await cache.sync(str(upstream))
+
+    (upstream / "notebook.ipynb").write_text("{}\n")
+    _git("add", ".", cwd=upstream)
+    _git("commit", "-q", "-m", "second", cwd=upstream)
+
+    assert await cache.sync(str(upstream)) == path
+    assert _git("rev-parse", "main", cwd=path) == _git(
+        "rev-parse", "HEAD", cwd=upstream
+    )
+
+
+async def test_credentials_not_persisted(tmp_path, upstream):
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    path = await cache.sync(str(upstream), "alice", "s3cret-token")
+
+    config = (path / "config").read_text()
+    assert "s3cret-token" not in config
+    assert "alice" not in config
+
+
+async def test_sync_error_redacts_credentials(tmp_path):
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    with pytest.raises(GitCacheError) as e:
+        await cache.sync(str(tmp_path / "missing"), "alice", "s3cret-token")
+    assert "s3cret-token" not in str(e.value)
+    assert not list((tmp_path / "cache").iterdir())
+
+
+async def test_sync_error_without_git(tmp_path, upstream, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    with pytest.raises(GitCacheError, match="cannot run git"):
+        await cache.sync(str(upstream))
+    assert not list((tmp_path / "cache").iterdir())
+
+
+async def test_evicts_least_recently_used(tmp_path, upstream):
+    other = tmp_path / "other"
+    _git("clone", "-q", str(upstream), str(other))
+
+    cache = GitMirrorCache(str(tmp_path / "cache"), max_size=1)
+    async with cache.mirror(str(upstream)) as first:
+        # The mirror in use survives even though the cache is over budget.
+        second = await cache.sync(str(other))
+        assert first.exists()
+        assert second.exists()
+
+    # Syncing again evicts the least recently used mirror, but never the
+    # one just refreshed.
+    await cache.sync(str(other))
+    assert not first.exists()
+    assert second.exists()
@@ -0,0 +1,65 @@
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+from tljh_repo2docker.http_clients import make_client
+
+
+def test_make_client_options():
+    client = make_client(
+        "test-options",
+        {"max_connections": 4, "timeout": 5, "route_timeouts": {"stop": 60}},
+        route_timeouts={"spawn": 10, "stop": 20},
+    )
+
+    assert client.timeout == httpx.Timeout(5, connect=10)
+    assert client.route_timeout("spawn") == httpx.Timeout(10, connect=10)
+    assert client.route_timeout("stop") == httpx.Timeout(60, connect=10)
+    assert client.route_timeout("other") == client.timeout
+    assert (
+        REGISTRY.get_sample_value(
+            "tljh_repo2docker_http_pool_max_connections", {"client": "test-options"}
+        )
+        == 4
+    )
+
+
+def test_make_client_rejects_unknown_options():
+    with pytest.raises(ValueError):
+        make_client("test-unknown", {"max_conections": 4})
+
+
+async def test_pool_metrics():
+    client = make_client("test-pool")
+    labels = {"client": "test-pool"}
+
+    assert client.pool_stats() == {"active": 0, "idle": 0, "waiting": 0}
+    assert (
+        REGISTRY.get_sample_value(
+            "tljh_repo2docker_http_pool_connections", dict(labels, state="active")
+        )
+        == 0
+    )
+    assert (
+        REGISTRY.get_sample_value("tljh_repo2docker_http_pool_waiting_requests", labels)
+        == 0
+    )
+    await client.aclose()
+
+
+async def test_pool_stats_without_httpcore_internals():
+    client = make_client("test-mock", transport=httpx.MockTransport(lambda r: None))
+    assert client.pool_stats() == {"active": 0, "idle": 0, "waiting": 0}
+    await client.aclose()
+
+    client = make_client("test-internals")
+    # As if a release of httpcore renamed its queue of requests.
+    del client._transport._pool._requests
+    assert client.pool_stats() == {"active": 0, "idle": 0, "waiting": 0}
+    assert (
+        REGISTRY.get_sample_value(
+            "tljh_repo2docker_http_pool_waiting_requests", {"client": "test-internals"}
+        )
+        == 0
+    )
+    await client.aclose()
@@ -0,0 +1,154 @@
+from contextlib import asynccontextmanager
+
+from aiodocker import DockerError
+
+from tljh_repo2docker.docker_hosts import DockerHost
+from tljh_repo2docker.image_gc import ImageCollector
+
+GB = 1024**3
+
+
+def _image(name, size, shared=0, created=0, tags=None, containers=0):
+    return {
+        "Id": f"sha256:{name}",
+        "RepoTags": [name] if tags is None else tags,
+        "Created": created,
+        "Size": size,
+        "SharedSize": shared,
+        "Containers": containers,
+        "Labels": {
+            "tljh_repo2docker.image_name": name,
+            "tljh_repo2docker.display_name": name.split(":")[0],
+        },
+    }
+
+
+class FakeImages:
+    def __init__(self):
+        self.deleted = []
+
+    async def delete(self, ref):
+        if ref == "busy:HEAD":
+            raise DockerError(409, {"message": "image is being used"})
+        self.deleted.append(ref)
+
+    async def list(self, filters=None):
+        return []
+
+
+class FakeContainers:
+    def __init__(self, running):
+        self.running = running
+
+    async def list(self, filters=None):
+        return [{"Image": image} for image in self.running]
+
+
+class FakeDocker:
+    def __init__(self, df, running):
+        self.df = df
+        self.images = FakeImages()
+        self.containers = FakeContainers(running)
+
+    async def _query_json(self, path, **kwargs):
+        assert path == "system/df"
+        return self.df
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeHost(DockerHost):
+    def __init__(self, name, images, layers_size, running=()):
+        super().__init__(name)
+        self.client = FakeDocker(
+            {"LayersSize": layers_size, "Images": images}, list(running)
+        )
+
+    def docker(self):
+        return self.client
+
+
+def _host():
+    return FakeHost(
+        "a",
+        [
+            _image("old:HEAD", 3 * GB, shared=1 * GB, created=100),
+            _image("older:HEAD", 2 * GB, created=50),
+            _image("pinned:HEAD", 4 * GB, created=10),
+            _image("running:HEAD", 4 * GB, created=20),
+            _image("recent:HEAD", 2 * GB, created=900),
+            _image("python:HEAD", 1 * GB, created=30, tags=[]),
+        ],
+        layers_size=15 * GB,
+        running=["running:HEAD"],
+    )
+
+
+async def test_plan_evicts_least_recently_used():
+    host = _host()
+    collector = ImageCollector([host], disk_budget=10 * GB, pinned=["pinned"])
+
+    report = await collector.collect(dry_run=True)
+
+    [host_report] = report["hosts"]
+    assert host_report["usage"] == 15 * GB
+    assert [i["image_name"] for i in host_report["dangling"]] == ["python:HEAD"]
+    # 14 GB left after the dangling image: evict until under 10 GB.
+    assert [i["image_name"] for i in host_report["evict"]] == [
+        "older:HEAD",
+        "old:HEAD",
+    ]
+    assert report["reclaimable"] == 5 * GB
+    assert host.client.images.deleted == []
+
+
+async def test_collect_without_budget_only_removes_dangling():
+    host = _host()
+    collector = ImageCollector([host])
+
+    report = await collector.collect()
+
+    assert report["hosts"][0]["evict"] == []
+    assert host.client.images.deleted == ["sha256:python:HEAD"]
+
+
+async def test_collect_keeps_images_docker_refuses_to_remove():
+    host = FakeHost("a", [_image("busy:HEAD", 2 * GB)], layers_size=2 * GB)
+    collector = ImageCollector([host], disk_budget=1 * GB)
+
+    report = await collector.collect()
+
+    assert [i["image_name"] for i in report["hosts"][0]["evict"]] == ["busy:HEAD"]
+    assert host.client.images.deleted == []
+
+
+class FakeManager:
+    def __init__(self):
+        self.usage = []
+
+    async def read_all(self, db, primary=False):
+        return []
+
+    async def record_usage(self, db, image_names, last_used):
+        self.usage.append(sorted(image_names))
+
+
+@asynccontextmanager
+async def fake_db_context():
+    yield None
+
+
+async def test_dry_run_does_not_record_usage():
+    manager = FakeManager()
+    collector = ImageCollector([_host()], fake_db_context, manager)
+
+    report = await collector.collect(dry_run=True)
+    assert "running:HEAD" not in [i["image_name"] for i in report["hosts"][0]["evict"]]
+    assert manager.usage == []
+
+    await collector.collect()
+    assert manager.usage == [["running:HEAD"]]
@@ -0,0 +1,171 @@
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.docker_hosts import DockerHost
+from tljh_repo2docker.image_warmer import ImageWarmer
+
+
+def _image(name):
+    return {
+        "Labels": {
+            "repo2docker.repo": "https://github.com/org/repo",
+            "repo2docker.ref": "HEAD",
+            "tljh_repo2docker.image_name": name,
+            "tljh_repo2docker.display_name": name.split(":")[0],
+            "tljh_repo2docker.mem_limit": "",
+            "tljh_repo2docker.cpu_limit": "",
+        },
+    }
+
+
+@pytest.fixture
+async def db_context():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            yield session
+
+    yield context
+    await engine.dispose()
+
+
+async def _add(db_context, manager, name, last_used=None, status=None):
+    async with db_context() as db:
+        await manager.create(
+            db,
+            DockerImageCreateSchema(
+                uid=uuid4(),
+                name=name,
+                status=status or BuildStatusType.BUILT,
+                log="",
+                image_meta=ImageMetadataType(
+                    display_name=name.split(":")[0],
+                    repo="https://github.com/org/repo",
+                    ref="HEAD",
+                    creation_date="01/01/2025",
+                    owner="admin",
+                    cpu_limit="",
+                    mem_limit="",
+                    node_selector={},
+                    last_used=last_used,
+                ),
+            ),
+        )
+
+
+class FakeContainer:
+    async def wait(self):
+        return {"StatusCode": 0}
+
+    async def delete(self, force=False):
+        pass
+
+
+class FakeContainers:
+    def __init__(self, running):
+        self.running = running
+        self.warmed = []
+
+    async def list(self, filters=None):
+        return [{"Image": image, "Labels": {}} for image in self.running]
+
+    async def run(self, config):
+        self.warmed.append(config["Image"])
+        return FakeContainer()
+
+
+class FakeImages:
+    def __init__(self, images):
+        self.images = images
+
+    async def list(self, filters=None):
+        return self.images
+
+
+class FakeDocker:
+    def __init__(self, images, running):
+        self.images = FakeImages(images)
+        self.containers = FakeContainers(running)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeHost(DockerHost):
+    def __init__(self, name, images, running=()):
+        super().__init__(name)
+        self.client = FakeDocker([_image(i) for i in images], list(running))
+
+    def docker(self):
+        return self.client
+
+
+async def test_most_used_ranks_the_recorded_usage(db_context):
+    manager = ImagesDatabaseManager()
+    await _add(db_context, manager, "python:HEAD", "2025-01-01T00:00:00+00:00")
+    await _add(db_context, manager, "r:HEAD", "2025-03-01T00:00:00+00:00")
+    await _add(db_context, manager, "julia:HEAD")
+    await _add(db_context, manager, "scipy:HEAD")
+    await _add(
+        db_context,
+        manager,
+        "broken:HEAD",
+        "2025-06-01T00:00:00+00:00",
+        status=BuildStatusType.FAILED,
+    )
+    warmer = ImageWarmer(db_context=db_context, image_db_manager=manager, size=2)
+
+    # A running server is recorded as a use, and kept after a restart.
+    assert await warmer.most_used({"julia:HEAD"}) == ["julia:HEAD", "r:HEAD"]
+    assert await warmer.most_used(set()) == ["julia:HEAD", "r:HEAD"]
+    warmer.size = 5
+    assert await warmer.most_used(set()) == ["julia:HEAD", "r:HEAD", "python:HEAD"]
+
+
+async def test_warm_used_images_where_they_are_cold(db_context):
+    manager = ImagesDatabaseManager()
+    await _add(db_context, manager, "python:HEAD")
+    await _add(db_context, manager, "r:HEAD", "2025-01-01T00:00:00+00:00")
+    a = FakeHost("a", ["python:HEAD", "r:HEAD"], running=["python:HEAD"] * 3)
+    b = FakeHost("b", ["python:HEAD"], running=["other:latest"])
+    warmer = ImageWarmer([a, b], db_context, manager, size=2)
+
+    await warmer.warm()
+
+    # python is running on a: only b reads it from disk.
+    assert a.client.containers.warmed == ["r:HEAD"]
+    assert b.client.containers.warmed == ["python:HEAD"]
+
+
+async def test_warm_on_the_local_host(db_context):
+    manager = ImagesDatabaseManager()
+    await _add(db_context, manager, "python:HEAD", "2025-01-01T00:00:00+00:00")
+    await _add(db_context, manager, "gone:HEAD", "2025-02-01T00:00:00+00:00")
+    local = FakeHost("", ["python:HEAD"])
+    warmer = ImageWarmer([local], db_context, manager)
+
+    await warmer.warm()
+
+    assert local.client.containers.warmed == ["python:HEAD"]
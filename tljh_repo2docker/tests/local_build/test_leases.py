@@ -0,0 +1,178 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from tljh_repo2docker.app import TljhRepo2Docker
+from tljh_repo2docker.build_jobs import BuildJobs
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    FINISHED_STATUSES,
+    BuildStatusType,
+    DockerImageCreateSchema,
+    DockerImageUpdateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.leases import BuildLeases, lease_expired, utcnow
+
+
+@pytest.fixture
+async def db_context():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            yield session
+
+    yield context
+    await engine.dispose()
+
+
+def _leases(db_context, owner, build_jobs=None, ttl=60):
+    if build_jobs is None:
+        build_jobs = BuildJobs()
+    return BuildLeases(owner, db_context, ImagesDatabaseManager(), build_jobs, ttl=ttl)
+
+
+async def _add(db_context, status=BuildStatusType.BUILDING, **lease):
+    uid = uuid4()
+    async with db_context() as db:
+        await ImagesDatabaseManager().create(
+            db,
+            DockerImageCreateSchema(
+                uid=uid,
+                name="python:HEAD",
+                status=status,
+                log="",
+                image_meta=ImageMetadataType(
+                    display_name="python",
+                    repo="https://github.com/org/repo",
+                    ref="HEAD",
+                    creation_date="01/01/2025",
+                    owner="admin",
+                    cpu_limit="",
+                    mem_limit="",
+                    node_selector={},
+                ),
+                **lease,
+            ),
+        )
+    return uid
+
+
+async def _read(db_context, uid):
+    async with db_context() as db:
+        return await ImagesDatabaseManager().read(db, uid)
+
+
+async def test_only_one_replica_takes_a_build_over(db_context):
+    a, b = _leases(db_context, "a"), _leases(db_context, "b")
+    orphaned = await _add(db_context)
+    driven = await _add(db_context, **a.values())
+    built = await _add(db_context, BuildStatusType.BUILT)
+
+    assert await a.claim([orphaned, driven, built]) == [orphaned, driven]
+    assert await b.claim([orphaned, driven, built]) == []
+
+    entry = await _read(db_context, orphaned)
+    assert entry.lease_owner == "a"
+    assert not lease_expired(entry)
+    assert not b.claimable(entry) and a.claimable(entry)
+
+
+async def test_expired_lease_is_taken_over(db_context):
+    a, b = _leases(db_context, "a"), _leases(db_context, "b")
+    uid = await _add(
+        db_context, lease_owner="a", lease_expires=utcnow() - timedelta(seconds=1)
+    )
+
+    assert b.claimable(await _read(db_context, uid))
+    assert await b.claim([uid]) == [uid]
+    assert await a.claim([uid]) == []
+
+
+async def test_finished_build_releases_its_lease(db_context):
+    a = _leases(db_context, "a")
+    uid = await _add(db_context, **a.values())
+    manager = ImagesDatabaseManager()
+    rebuild = DockerImageUpdateSchema(uid=uid, status=BuildStatusType.BUILDING)
+
+    async with db_context() as db:
+        # Compare-and-set: the build is not over yet.
+        assert (
+            await manager.update(db, rebuild, where={"status": FINISHED_STATUSES})
+            is None
+        )
+        assert await manager.update(
+            db,
+            DockerImageUpdateSchema(uid=uid, status=BuildStatusType.BUILT),
+            where={"status": BuildStatusType.BUILDING},
+        )
+        entry = await manager.read(db, uid)
+        assert entry.lease_owner is None and entry.lease_expires is None
+        assert await manager.update(
+            db, rebuild, fetch=False, where={"status": FINISHED_STATUSES}
+        )
+
+
+async def test_renew_abandons_builds_taken_over(db_context):
+    build_jobs = BuildJobs()
+    a = _leases(db_context, "a", build_jobs, ttl=0)
+    running = await _add(db_context, **a.values())
+    taken_over = await _add(db_context, **a.values())
+    finished = await _add(db_context, BuildStatusType.BUILT)
+    tasks = {
+        uid: build_jobs.start(uid, asyncio.sleep(60))
+        for uid in (running, taken_over, finished)
+    }
+    assert await _leases(db_context, "b").claim([taken_over]) == [taken_over]
+
+    a.ttl = 60
+    await a.renew()
+
+    assert a.lost(taken_over) and tasks[taken_over].cancelled()
+    assert not a.lost(running) and not tasks[running].done()
+    # The build is over, and winding down.
+    assert not tasks[finished].done()
+    entry = await _read(db_context, running)
+    assert entry.lease_expires > utcnow() + timedelta(seconds=30)
+    for task in tasks.values():
+        task.cancel()
+
+
+async def test_takeover_waits_for_the_schema(db_context):
+    service = TljhRepo2Docker()
+    db_ready = asyncio.get_running_loop().create_future()
+    service.app = SimpleNamespace(
+        settings={
+            "db_ready": db_ready,
+            "build_leases": _leases(db_context, "replica-a"),
+            "build_jobs": BuildJobs(),
+        }
+    )
+    service.db_context = db_context
+    service.image_db_manager = ImagesDatabaseManager()
+    service.init_build_leases()
+    startup = asyncio.ensure_future(service._on_startup())
+    await asyncio.sleep(0)
+    assert not service.leases_callback.is_running()
+
+    db_ready.set_result(None)
+    await startup
+    try:
+        assert service.leases_callback.is_running()
+    finally:
+        service.leases_callback.stop()
@@ -0,0 +1,179 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+from tljh_repo2docker import logs
+from tljh_repo2docker.database.schemas import BuildStatusType
+from tljh_repo2docker.logs import BuildLogWatchers, TooManyStreamsError
+from tljh_repo2docker.notifications import ChangeNotifier, change
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(logs, "POLL_INTERVAL", 0.01)
+
+
+class FakeManager:
+    def __init__(self, image):
+        self.image = image
+        self.reads = 0
+
+    async def read_log_since(self, db, uid, offset):
+        self.reads += 1
+        return SimpleNamespace(
+            status=self.image.status,
+            log=self.image.log[offset:],
+            length=len(self.image.log),
+        )
+
+
+@asynccontextmanager
+async def fake_db_context():
+    yield None
+
+
+def _image(log="", status=BuildStatusType.BUILDING):
+    return SimpleNamespace(uid=uuid4(), log=log, status=status)
+
+
+async def _events(subscription):
+    events = []
+    while True:
+        event = await asyncio.wait_for(subscription.queue.get(), 1)
+        if event is None:
+            return events
+        events.append(event)
+
+
+async def test_watcher_is_shared_between_clients():
+    image = _image("Step 1\n")
+    manager = FakeManager(image)
+    watchers = BuildLogWatchers(fake_db_context, manager)
+
+    alice = watchers.subscribe(image, "alice")
+    image.log = "Step 1\nStep 2\n"
+    await asyncio.sleep(0.05)
+    # Bob joins late, with the log he read from the database.
+    bob = watchers.subscribe(SimpleNamespace(**vars(image)), "bob")
+    image.log = "Step 1\nStep 2\nStep 3\n"
+    await asyncio.sleep(0.05)
+    image.status = BuildStatusType.BUILT
+
+    alice_events, bob_events = await asyncio.gather(_events(alice), _events(bob))
+
+    assert "".join(e["message"] for e in alice_events[:-1]) == "Step 2\nStep 3\n"
+    assert "".join(e["message"] for e in bob_events[:-1]) == "Step 3\n"
+    for events in (alice_events, bob_events):
+        assert events[-1] == {"phase": "built", "message": ""}
+    await asyncio.sleep(0)
+    assert image.uid not in watchers
+
+
+async def test_end_of_build_does_not_repeat_the_log():
+    image = _image("Step 1\n")
+    watchers = BuildLogWatchers(fake_db_context, FakeManager(image))
+
+    alice = watchers.subscribe(image, "alice")
+    image.log += "Step 2\n"
+    await asyncio.sleep(0.05)
+    # The end of the log is read together with the final status.
+    image.log += "Build failed\n"
+    image.status = BuildStatusType.FAILED
+    events = await _events(alice)
+
+    assert events == [
+        {"phase": "log", "message": "Step 2\n"},
+        {"phase": "log", "message": "Build failed\n"},
+        {"phase": "error", "message": ""},
+    ]
+
+
+async def test_watcher_stops_without_clients():
+    image = _image()
+    manager = FakeManager(image)
+    watchers = BuildLogWatchers(fake_db_context, manager)
+
+    subscription = watchers.subscribe(image, "alice")
+    await asyncio.sleep(0.05)
+    watchers.unsubscribe(image.uid, subscription)
+    await asyncio.sleep(0.05)
+    reads = manager.reads
+    await asyncio.sleep(0.05)
+
+    assert manager.reads == reads
+    assert image.uid not in watchers
+
+
+async def test_streams_per_user_are_capped():
+    image = _image()
+    watchers = BuildLogWatchers(
+        fake_db_context, FakeManager(image), max_streams_per_user=2
+    )
+
+    first = watchers.subscribe(image, "alice")
+    watchers.subscribe(image, "alice")
+    with pytest.raises(TooManyStreamsError):
+        watchers.subscribe(image, "alice")
+    watchers.subscribe(image, "bob")
+
+    watchers.unsubscribe(image.uid, first)
+    watchers.subscribe(image, "alice")
+
+
+async def test_slow_client_is_dropped(monkeypatch):
+    monkeypatch.setattr(logs, "SUBSCRIBER_QUEUE_SIZE", 2)
+    image = _image()
+    watchers = BuildLogWatchers(fake_db_context, FakeManager(image))
+    dropped = []
+
+    slow = watchers.subscribe(image, "alice", on_drop=lambda: dropped.append(True))
+    for i in range(4):
+        image.log += f"Step {i}\n"
+        await asyncio.sleep(0.03)
+
+    assert dropped == [True]
+    # The stream ends without queueing the rest of the log.
+    assert len(await _events(slow)) < 4
+    assert image.uid not in watchers
+
+
+class ReplicatedNotifier(ChangeNotifier):
+    """A notifier reaching every replica: the watchers stop polling."""
+
+    polls = False
+
+
+async def test_notified_change_wakes_the_watcher(monkeypatch):
+    monkeypatch.setattr(logs, "NOTIFIED_POLL_INTERVAL", 60)
+    image = _image("Step 1\n")
+    manager = FakeManager(image)
+    notifier = ReplicatedNotifier()
+    watchers = BuildLogWatchers(fake_db_context, manager, notifier=notifier)
+
+    alice = watchers.subscribe(image, "alice")
+    await asyncio.sleep(0.05)
+    assert manager.reads == 0
+
+    # A part of the log the watcher has already: no read.
+    notifier.dispatch(change(image.uid, offset=len(image.log)))
+    await asyncio.sleep(0.05)
+    assert manager.reads == 0
+
+    image.log += "Step 2\n"
+    notifier.dispatch(change(image.uid, offset=len(image.log)))
+    await asyncio.sleep(0.05)
+    assert manager.reads == 1
+
+    image.status = BuildStatusType.BUILT
+    notifier.dispatch(change(image.uid, status=image.status))
+    events = await _events(alice)
+
+    assert events == [
+        {"phase": "log", "message": "Step 2\n"},
+        {"phase": "built", "message": ""},
+    ]
+    await asyncio.sleep(0)
+    assert notifier._listeners == {}
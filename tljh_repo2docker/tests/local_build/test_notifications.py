@@ -0,0 +1,139 @@
+import json
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    DockerImageUpdateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.notifications import (
+    ChangeNotifier,
+    PostgresNotifier,
+    change,
+    make_notifier,
+)
+
+
+@pytest.fixture
+async def db_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with maker() as session:
+        yield session
+    await engine.dispose()
+
+
+def _schema():
+    return DockerImageCreateSchema(
+        uid=uuid4(),
+        name="python:HEAD",
+        status=BuildStatusType.BUILDING,
+        log="",
+        image_meta=ImageMetadataType(
+            display_name="python",
+            repo="https://github.com/org/repo",
+            ref="HEAD",
+            creation_date="01/01/2025",
+            owner="admin",
+            cpu_limit="",
+            mem_limit="",
+            node_selector={},
+        ),
+    )
+
+
+async def test_writes_notify_their_changes(db_session):
+    notifier = ChangeNotifier()
+    manager = ImagesDatabaseManager(notifier=notifier)
+    schema = _schema()
+    events, everything = [], []
+    notifier.add_listener(schema.uid, events.append)
+    notifier.add_listener(None, everything.append)
+
+    await manager.create(db_session, schema)
+    await manager.update(
+        db_session, DockerImageUpdateSchema(uid=schema.uid, log="Step 1\n")
+    )
+    await manager.mark_status(
+        db_session, where={"uid": [schema.uid]}, set=BuildStatusType.FAILED
+    )
+    await manager.delete(db_session, schema.uid)
+    # Not an existing entry: nothing changed.
+    await manager.delete(db_session, uuid4())
+
+    uid = str(schema.uid)
+    assert events == [
+        {"uid": uid, "status": "building", "offset": 0},
+        {"uid": uid, "status": None, "offset": 7},
+        {"uid": uid, "status": "failed", "offset": None},
+        {"uid": uid, "status": "deleted", "offset": None},
+    ]
+    assert everything == events
+
+
+async def test_changes_are_notified_on_commit(db_session):
+    notifier = ChangeNotifier()
+    schema = _schema()
+    events = []
+    notifier.add_listener(schema.uid, events.append)
+
+    await db_session.execute(text("SELECT 1"))
+    await notifier.publish(db_session, change(schema.uid, offset=3))
+    assert events == []
+    await db_session.rollback()
+    await db_session.commit()
+    assert events == []
+
+    await notifier.publish(db_session, change(schema.uid, offset=3))
+    await db_session.commit()
+    assert events == [change(schema.uid, offset=3)]
+
+
+async def test_listeners_are_isolated():
+    notifier = ChangeNotifier()
+    uid = uuid4()
+    events = []
+
+    def failing(event):
+        raise RuntimeError("boom")
+
+    notifier.add_listener(uid, failing)
+    notifier.add_listener(uid, events.append)
+    notifier.dispatch(change(uid))
+    # A change of every environment reaches the listeners of each of them.
+    notifier.dispatch(change())
+
+    assert events == [change(uid), change()]
+    notifier.remove_listener(uid, failing)
+    notifier.remove_listener(uid, events.append)
+    assert notifier._listeners == {}
+
+
+def test_postgres_notifications():
+    notifier = make_notifier("postgresql+asyncpg://hub:secret@db/hub")
+    assert isinstance(notifier, PostgresNotifier)
+    assert notifier.dsn == "postgresql://hub:secret@db/hub"
+    # Not listening yet.
+    assert notifier.polls
+    assert type(make_notifier("sqlite+aiosqlite:///db.sqlite")) is ChangeNotifier
+
+    uid = uuid4()
+    events = []
+    notifier.add_listener(uid, events.append)
+    notifier._on_notification(None, 42, "channel", json.dumps(change(uid, "built")))
+    notifier._on_notification(None, 42, "channel", "not json")
+
+    assert events == [change(uid, "built")]
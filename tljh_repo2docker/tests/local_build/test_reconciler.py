@@ -0,0 +1,250 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from tljh_repo2docker.build_jobs import BuildJobs
+from tljh_repo2docker.database.manager import ImagesDatabaseManager
+from tljh_repo2docker.database.model import BaseSQL
+from tljh_repo2docker.database.schemas import (
+    BuildStatusType,
+    DockerImageCreateSchema,
+    ImageMetadataType,
+)
+from tljh_repo2docker.docker_hosts import DockerHost
+from tljh_repo2docker.reconciler import Reconciler
+
+
+def _image(name):
+    return {
+        "Labels": {
+            "repo2docker.repo": "https://github.com/org/repo",
+            "repo2docker.ref": "HEAD",
+            "tljh_repo2docker.image_name": name,
+            "tljh_repo2docker.display_name": name.split(":")[0],
+            "tljh_repo2docker.creation_date": "01/01/2025",
+            "tljh_repo2docker.owner": "admin",
+            "tljh_repo2docker.mem_limit": "2G",
+            "tljh_repo2docker.cpu_limit": "1",
+            "tljh_repo2docker.node_selector": "{'disk': 'ssd'}",
+        }
+    }
+
+
+def _container(container_id, image_name, age=3600):
+    return {
+        "Id": container_id,
+        "Labels": {"repo2docker.build": image_name},
+        "Created": int(time.time() - age),
+    }
+
+
+class FakeContainer:
+    def __init__(self, containers, container_id):
+        self.containers = containers
+        self.container_id = container_id
+
+    async def delete(self, force=False):
+        self.containers.deleted.append(self.container_id)
+
+
+class FakeContainers:
+    def __init__(self, containers):
+        self._containers = containers
+        self.deleted = []
+
+    async def list(self, **kwargs):
+        return self._containers
+
+    def container(self, container_id):
+        return FakeContainer(self, container_id)
+
+
+class FakeImages:
+    def __init__(self, images):
+        self._images = images
+
+    async def list(self, **kwargs):
+        return self._images
+
+
+class FakeDocker:
+    def __init__(self, images, containers):
+        self.images = FakeImages(images)
+        self.containers = FakeContainers(containers)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeHost(DockerHost):
+    def __init__(self, name, images=(), containers=()):
+        super().__init__(name)
+        self.client = FakeDocker(list(images), list(containers))
+
+    def docker(self):
+        return self.client
+
+
+class UnreachableHost(DockerHost):
+    def docker(self):
+        raise OSError("Connection refused")
+
+
+@pytest.fixture
+async def db_context():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(BaseSQL.metadata.create_all)
+    maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def context():
+        async with maker() as session:
+            yield session
+
+    yield context
+    await engine.dispose()
+
+
+async def _add(db_context, name, status, container_id=None):
+    uid = uuid4()
+    async with db_context() as db:
+        await ImagesDatabaseManager().create(
+            db,
+            DockerImageCreateSchema(
+                uid=uid,
+                name=name,
+                status=status,
+                log="Step 1\n",
+                container_id=container_id,
+                image_meta=ImageMetadataType(
+                    display_name=name.split(":")[0],
+                    repo="https://github.com/org/repo",
+                    ref="HEAD",
+                    creation_date="01/01/2025",
+                    owner="admin",
+                    cpu_limit="",
+                    mem_limit="",
+                    node_selector={},
+                ),
+            ),
+        )
+    return uid
+
+
+async def _entries(db_context):
+    async with db_context() as db:
+        entries = await ImagesDatabaseManager().read_all(db)
+    return {entry.name: entry for entry in entries}
+
+
+async def test_reconcile(db_context):
+    await _add(db_context, "built:HEAD", BuildStatusType.BUILT)
+    await _add(db_context, "removed:HEAD", BuildStatusType.BUILT)
+    await _add(db_context, "failed:HEAD", BuildStatusType.FAILED)
+    await _add(db_context, "crashed:HEAD", BuildStatusType.BUILDING, "gone")
+    await _add(db_context, "building:HEAD", BuildStatusType.BUILDING, "abc")
+    running = await _add(db_context, "starting:HEAD", BuildStatusType.BUILDING)
+    build_jobs = BuildJobs()
+    build = build_jobs.start(running, asyncio.sleep(60))
+    host = FakeHost(
+        "a",
+        images=[_image("built:HEAD"), _image("legacy:HEAD")],
+        containers=[
+            _container("abc", "building:HEAD"),
+            _container("def", "starting:HEAD"),
+            _container("old", "deleted:HEAD"),
+            _container("new", "deleted:HEAD", age=0),
+        ],
+    )
+    reconciler = Reconciler([host], db_context, ImagesDatabaseManager(), build_jobs)
+
+    report = await reconciler.reconcile()
+
+    assert report["complete"]
+    assert [image["image_name"] for image in report["import"]] == ["legacy:HEAD"]
+    assert [entry["image_name"] for entry in report["missing"]] == ["removed:HEAD"]
+    assert [e["image_name"] for e in report["interrupted"]] == ["crashed:HEAD"]
+    assert report["orphaned"] == [
+        {"id": "old", "image_name": "deleted:HEAD", "docker_host": "a"}
+    ]
+    assert host.client.containers.deleted == ["old"]
+
+    entries = await _entries(db_context)
+    assert "removed:HEAD" not in entries
+    assert entries["failed:HEAD"].status == BuildStatusType.FAILED.value
+    assert entries["crashed:HEAD"].status == BuildStatusType.FAILED.value
+    assert entries["crashed:HEAD"].log.startswith("Step 1\n\n[Build interrupted")
+    assert entries["building:HEAD"].status == BuildStatusType.BUILDING.value
+    assert entries["starting:HEAD"].status == BuildStatusType.BUILDING.value
+    legacy = entries["legacy:HEAD"]
+    assert legacy.status == BuildStatusType.BUILT.value
+    assert legacy.image_meta.mem_limit == "2"
+    assert legacy.image_meta.node_selector == {"disk": "ssd"}
+    assert legacy.image_meta.build_info == {"docker_host": "a"}
+
+    # Nothing left to fix.
+    report = await reconciler.reconcile()
+    assert not any(report[kind] for kind in ("import", "missing", "interrupted"))
+    build.cancel()
+
+
+async def test_reconcile_dry_run(db_context):
+    await _add(db_context, "removed:HEAD", BuildStatusType.BUILT)
+    reconciler = Reconciler(
+        [FakeHost("a", images=[_image("legacy:HEAD")])],
+        db_context,
+        ImagesDatabaseManager(),
+    )
+
+    report = await reconciler.reconcile(dry_run=True)
+
+    assert report["import"] and report["missing"]
+    assert list(await _entries(db_context)) == ["removed:HEAD"]
+
+
+async def test_unreachable_host_keeps_entries(db_context):
+    await _add(db_context, "elsewhere:HEAD", BuildStatusType.BUILT)
+    await _add(db_context, "crashed:HEAD", BuildStatusType.BUILDING, "gone")
+    reconciler = Reconciler(
+        [FakeHost("a"), UnreachableHost("b")], db_context, ImagesDatabaseManager()
+    )
+
+    report = await reconciler.reconcile()
+
+    assert not report["complete"]
+    assert report["missing"] == report["interrupted"] == []
+    entries = await _entries(db_context)
+    assert entries["elsewhere:HEAD"].status == BuildStatusType.BUILT.value
+    assert entries["crashed:HEAD"].status == BuildStatusType.BUILDING.value
+
+
+async def test_replaced_image_is_not_imported(db_context):
+    # A rebuild of python:v1 on a new ref: the previous image is kept for
+    # the layer cache while the entry already has its new name.
+    uid = await _add(db_context, "python:v2", BuildStatusType.BUILDING, "abc")
+    async with db_context() as db:
+        await ImagesDatabaseManager().update_image_meta(
+            db, uid, build_info={"cache_from": ["python:v1"]}
+        )
+    host = FakeHost(
+        "a",
+        images=[_image("python:v1"), _image("other:HEAD")],
+        containers=[_container("abc", "python:v2")],
+    )
+    reconciler = Reconciler([host], db_context, ImagesDatabaseManager())
+
+    report = await reconciler.plan()
+
+    assert [image["image_name"] for image in report["import"]] == ["other:HEAD"]
@@ -0,0 +1,89 @@
+import json
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+from tljh_repo2docker import dbutil
+from tljh_repo2docker.dbutil import _alembic, head_revision, upgrade_if_needed
+
+# Seconds to import the service, with a wide margin for slow CI runners.
+IMPORT_BUDGET = 5
+
+
+def test_service_imports_within_budget():
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import tljh_repo2docker.app\n"
+        "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", script])
+    elapsed, modules = json.loads(output)
+
+    assert elapsed < IMPORT_BUDGET
+    # The build backends are imported when the handlers are created.
+    for module in ("builder", "binderhub_builder", "binderhub_log"):
+        assert f"tljh_repo2docker.{module}" not in modules
+    assert "jupyterhub.app" not in modules
+
+
+def test_migrations_run_in_process(tmp_path):
+    db_file = tmp_path / "tljh_repo2docker.sqlite"
+    db_url = f"sqlite+aiosqlite:///{db_file}"
+
+    upgrade_if_needed(db_url)
+    # Up-to-date: nothing to do.
+    upgrade_if_needed(db_url)
+    with sqlite3.connect(db_file) as connection:
+        revision = connection.execute("SELECT version_num FROM alembic_version")
+        assert revision.fetchall() == [(head_revision(),)]
+
+    _alembic(db_url, ["downgrade", "base"])
+    with sqlite3.connect(db_file) as connection:
+        tables = connection.execute("SELECT name FROM sqlite_master")
+        assert ("images",) not in tables.fetchall()
+
+
+AUTOCOMMIT_MIGRATION = """
+revision = "f00dfeed0001"
+down_revision = "{head}"
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    # As ALTER TYPE ... ADD VALUE on PostgreSQL.
+    with op.get_context().autocommit_block():
+        op.execute("CREATE TABLE autocommitted (id INTEGER)")
+
+
+def downgrade():
+    op.execute("DROP TABLE autocommitted")
+"""
+
+
+def test_migrations_may_leave_the_transaction(tmp_path, monkeypatch):
+    alembic_dir = tmp_path / "alembic"
+    shutil.copytree(
+        dbutil.ALEMBIC_DIR, alembic_dir, ignore=shutil.ignore_patterns("__pycache__")
+    )
+    (alembic_dir / "versions" / "f00dfeed0001_autocommit.py").write_text(
+        AUTOCOMMIT_MIGRATION.format(head=head_revision())
+    )
+    monkeypatch.setattr(dbutil, "ALEMBIC_DIR", alembic_dir)
+    head_revision.cache_clear()
+    db_file = tmp_path / "tljh_repo2docker.sqlite"
+    try:
+        upgrade_if_needed(f"sqlite+aiosqlite:///{db_file}")
+        assert head_revision() == "f00dfeed0001"
+    finally:
+        head_revision.cache_clear()
+
+    with sqlite3.connect(db_file) as connection:
+        revision = connection.execute("SELECT version_num FROM alembic_version")
+        assert revision.fetchall() == [("f00dfeed0001",)]
+        tables = connection.execute("SELECT name FROM sqlite_master")
+        assert ("autocommitted",) in tables.fetchall()